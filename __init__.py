@@ -1,43 +1,74 @@
+from . import instrumentation
 from . import referenceHandler
 from . import absoluteReadCountDictOperations
 from . import generalDictOperations
 from . import percentReadCountDictOperations
+from . import readCountMatrixOperations
+from . import countTableReader
 from . import plotting
 from . import reportGeneration
+from . import scoreHistory
+from . import scoreMemo
+from . import binaryResult
+from . import multiTargetScoring
+from . import countArchive
+from . import batchRunner
 
 
-__all__ = ["referenceHandler",
+__all__ = ["instrumentation",
+           "referenceHandler",
            "absoluteReadCountDictOperations",
            "generalDictOperations",
            "percentReadCountDictOperations",
+           "readCountMatrixOperations",
+           "countTableReader",
            "plotting",
-           "reportGeneration"]
+           "reportGeneration",
+           "scoreHistory",
+           "scoreMemo",
+           "binaryResult",
+           "multiTargetScoring",
+           "countArchive",
+           "batchRunner"]
 
 
 class MiqScoreCalculator(object):
     '''
     Takes in an expected values dictionary with percentages.
     Can take in a percent tolerance in standard and a floor value for miq score
+    With bootstrapReplicates set, every result from calculateMiq also gets a percentile confidenceInterval (see bootstrapMiq).
+    bootstrapSeed makes those intervals reproducible: each sample's resamples are seeded from it and the sample ID.
     '''
-    def __init__(self, standardReference: referenceHandler.StandardReference, analysisMethod:str, percentToleranceInStandard:[int, float]=0, floor:[int, float]=0):
+    def __init__(self, standardReference: referenceHandler.StandardReference, analysisMethod:str, percentToleranceInStandard:[int, float]=0, floor:[int, float]=0, bootstrapReplicates:int=0, confidenceLevel:float=0.95, bootstrapSeed:int=None):
+        if bootstrapReplicates < 0:
+            raise ValueError("Bootstrap replicates can not be negative. Got %s" %bootstrapReplicates)
+        if not 0 < confidenceLevel < 1:
+            raise ValueError("Confidence level must be between 0 and 1. Got %s" %confidenceLevel)
         self.standardReference = standardReference
         self.analysisMethod = analysisMethod
         if not analysisMethod in standardReference.analysisMethods:
             raise ValueError("Analysis method %s not found in analysis methods for the chosen standard. Valud methods: %s" %(analysisMethod, standardReference.analysisMethods))
         self.percentToleranceInStandard = percentToleranceInStandard
         self.floor = floor
-        self.expectedReadSources = []
-        for source in standardReference.expectedValues[analysisMethod]:
-            if standardReference.expectedValues[analysisMethod][source]:
-                self.expectedReadSources.append(source)
+        self.expectedReadSources = standardReference.compiledReference.expectedReadSources(analysisMethod)
+        self.expectedReadSourceIndex = {readSource: column for column, readSource in enumerate(self.expectedReadSources)}
+        self.bootstrapReplicates = bootstrapReplicates
+        self.confidenceLevel = confidenceLevel
+        self.bootstrapSeed = bootstrapSeed
 
-    def calculateMiq(self, sampleData:dict, sampleID:str=None):
-        '''Sample Data should come in as absolute counts'''
+    def calculateMiq(self, sampleData:dict, sampleID:str=None, compact:bool=False):
+        '''Sample Data should come in as absolute counts.  With compact=True a CompactMiqScoreData is returned instead of a MiqScoreData (same scores).'''
         import statistics
+        if compact:
+            return self.calculateCompactMiq(sampleData, sampleID)
+        profile = instrumentation.startProfile(sampleID)
+        laps = instrumentation.startLaps("calculateMiq", profile)
         sampleData = referenceHandler.convertKeysToStandardIdentifiers(sampleData, self.standardReference)
+        laps.lap("convertKeysToStandardIdentifiers")
         referenceReads, nonreferenceReads = generalDictOperations.separateReferenceAndNonreferenceReads(sampleData, self.expectedReadSources)
         samplePercentages = absoluteReadCountDictOperations.convertDictToPercentages(referenceReads)
         samplePercentOfExpected = percentReadCountDictOperations.calculateObservedPercentOfExpected(samplePercentages, self.standardReference.expectedValues[self.analysisMethod])
+        laps.lap("percentOfExpected")
         rawPercentOfExpected = []
         for readSource in samplePercentages:
             rawPercentOfExpected.append(samplePercentOfExpected[readSource])
@@ -58,7 +89,642 @@ class MiqScoreCalculator(object):
             filteredMiqScore =  miqScore
         else:
             filteredMiqScore =  max([miqScore, self.floor])
-        return MiqScoreData(filteredMiqScore, miqScore, referenceReads, nonreferenceReads, samplePercentages, samplePercentOfExpected, self.percentToleranceInStandard, self.analysisMethod, self.standardReference, sampleID)
+        laps.lap("score")
+        miqResult = MiqScoreData(filteredMiqScore, miqScore, referenceReads, nonreferenceReads, samplePercentages, samplePercentOfExpected, self.percentToleranceInStandard, self.analysisMethod, self.standardReference, sampleID)
+        miqResult.profile = profile
+        laps.lap("makeMiqScoreData")
+        if self.bootstrapReplicates:
+            miqResult.confidenceInterval = self.bootstrapReferenceCounts([referenceReads.get(readSource, 0) for readSource in self.expectedReadSources], random=self.makeBootstrapRandom(sampleID))[0]
+            laps.lap("bootstrap")
+        laps.finish()
+        return miqResult
+
+    @instrumentation.timed("calculateCompactMiq")
+    def calculateCompactMiq(self, sampleData:dict, sampleID:str=None):
+        '''
+        Scores a sample without building the intermediate dictionaries and returns a CompactMiqScoreData.
+        The arithmetic (including the order reads are summed in) follows calculateMiq, so scores are identical.
+        '''
+        import numpy
+        aliasLookup = self.standardReference.compiledReference.aliasLookup
+        referenceCounts = [0] * len(self.expectedReadSources)
+        observedColumns = {}  # columns in the order they were first seen, which is the order calculateMiq sums them in
+        nonreferenceReads = {}
+        for rawName in sampleData:
+            readSource = aliasLookup.get(rawName, rawName)
+            if readSource in self.expectedReadSourceIndex:
+                column = self.expectedReadSourceIndex[readSource]
+                observedColumns[column] = True
+                referenceCounts[column] += sampleData[rawName]
+            else:
+                nonreferenceReads[readSource] = nonreferenceReads.get(readSource, 0) + sampleData[rawName]
+        readSum = 0
+        for column in observedColumns:
+            readSum += referenceCounts[column]
+        filteredMiqScore, miqScore = self.scoreReferenceCounts(referenceCounts, readSum)
+        result = CompactMiqScoreData(filteredMiqScore, miqScore, self.expectedReadSources, numpy.array(referenceCounts, dtype=numpy.float64), readSum, tuple(nonreferenceReads), numpy.array(list(nonreferenceReads.values()), dtype=numpy.float64), self.percentToleranceInStandard, self.analysisMethod, self.standardReference, sampleID)
+        if self.bootstrapReplicates:
+            result.confidenceInterval = self.bootstrapReferenceCounts(result.referenceCounts, random=self.makeBootstrapRandom(sampleID))[0]
+        return result
+
+    def scoreReferenceCounts(self, referenceCounts:[list, tuple], readSum:[int, float]):
+        '''
+        Scores reference read counts given in the order of expectedReadSources with readSum as their total.  Returns (miqScore, rawMiqScore).
+        '''
+        expectedValues = self.standardReference.expectedValues[self.analysisMethod]
+        squaredErrors = []
+        for readSource, count in zip(self.expectedReadSources, referenceCounts):
+            if readSum == 0:
+                percentage = count
+            else:
+                percentage = (count / readSum) * 100
+            if percentage:
+                unadjustedPercentError = 100 - (percentage / expectedValues[readSource]) * 100
+            else:
+                unadjustedPercentError = 100
+            if self.percentToleranceInStandard:
+                if abs(unadjustedPercentError) <= self.percentToleranceInStandard:
+                    squaredErrors.append(0)
+                else:
+                    squaredErrors.append((abs(unadjustedPercentError) - self.percentToleranceInStandard) ** 2)
+            else:
+                squaredErrors.append(unadjustedPercentError ** 2)
+        miqScore = 100 - readCountMatrixOperations.calculateExactMean(squaredErrors) ** 0.5  # correctly rounded like statistics.mean, without Fractions
+        if self.floor is None:
+            filteredMiqScore = miqScore
+        else:
+            filteredMiqScore = max([miqScore, self.floor])
+        return filteredMiqScore, miqScore
+
+    @instrumentation.timed("calculateMiqBatch")
+    def calculateMiqBatch(self, samples, readSources:[list, tuple]=None, sampleIDs:[list, tuple]=None):
+        '''
+        Scores many samples at once.  Samples can be a samples x read sources matrix of absolute counts (readSources naming each column, aliases allowed) or an iterable of count dictionaries like those taken by calculateMiq.
+        Scores are identical to those from calculateMiq on the same counts, fractional counts included (a row of a matrix scores like a dictionary made in column order). Returns a MiqScoreBatch.
+        '''
+        import numpy
+        if readSources is None:
+            countMatrix, readSources, columnOrders = readCountMatrixOperations.buildCountMatrixWithColumnOrders(samples, self.standardReference, self.expectedReadSources)
+        else:
+            countMatrix = numpy.asarray(samples, dtype=numpy.float64)
+            if not countMatrix.ndim == 2 or not countMatrix.shape[1] == len(readSources):
+                raise ValueError("Count matrix must be samples x read sources with one column per read source. Got shape %s for %s read sources" %(countMatrix.shape, len(readSources)))
+            columnOrders = [range(len(readSources))] * countMatrix.shape[0]  # a row scores like calculateMiq on a dictionary made in column order
+        referenceColumnOrders = readCountMatrixOperations.getReferenceColumnOrders(columnOrders, readSources, self.expectedReadSources, self.standardReference)
+        countMatrix, readSources = readCountMatrixOperations.convertColumnsToStandardIdentifiers(countMatrix, readSources, self.standardReference)
+        if sampleIDs is None:
+            sampleIDs = [None] * countMatrix.shape[0]
+        elif not len(sampleIDs) == countMatrix.shape[0]:
+            raise ValueError("Got %s sample IDs for %s samples" %(len(sampleIDs), countMatrix.shape[0]))
+        referenceReads, nonreferenceReads, nonreferenceReadSources = readCountMatrixOperations.separateReferenceAndNonreferenceColumns(countMatrix, readSources, self.expectedReadSources)
+        compiledReference = self.standardReference.compiledReference
+        expectedPercentages = compiledReference.expectedValueVectors[self.analysisMethod][compiledReference.expectedReadSourceIndices[self.analysisMethod]]
+        readSums = readCountMatrixOperations.calculateReadSums(referenceReads, referenceColumnOrders)
+        samplePercentages = readCountMatrixOperations.convertMatrixToPercentages(referenceReads, readSums)
+        samplePercentOfExpected = readCountMatrixOperations.calculateObservedPercentOfExpected(samplePercentages, expectedPercentages)
+        adjustedPercentErrors = readCountMatrixOperations.calculateAdjustedPercentErrors(samplePercentOfExpected, self.percentToleranceInStandard)
+        rawMiqScores = readCountMatrixOperations.calculateRawMiqScores(adjustedPercentErrors)
+        miqScores = readCountMatrixOperations.applyFloor(rawMiqScores, self.floor)
+        return MiqScoreBatch(miqScores, rawMiqScores, self.expectedReadSources, referenceReads, nonreferenceReadSources, nonreferenceReads, samplePercentages, samplePercentOfExpected, self.percentToleranceInStandard, self.analysisMethod, self.standardReference, list(sampleIDs))
+
+    def makeBootstrapRandom(self, sampleID:str=None):
+        '''Random generator for one sample's bootstrap, seeded from bootstrapSeed and the sample ID when a seed was given'''
+        import zlib
+        import numpy
+        if self.bootstrapSeed is None:
+            return numpy.random.default_rng()
+        return numpy.random.default_rng([self.bootstrapSeed, zlib.crc32(str(sampleID).encode())])
+
+    def bootstrapReferenceCounts(self, referenceCountMatrix, replicates:int=None, confidenceLevel:float=None, random=None):
+        '''
+        Percentile bootstrap of MIQ scores for a samples x read sources matrix (or a single vector) of reference read counts in the
+        order of expectedReadSources.  Each sample is resampled replicates times from a multinomial with its own read total and
+        proportions, and all resamples are scored together in NumPy with the same tolerance and floor as calculateMiq.
+        Replicates and confidence level default to the calculator's settings (2000 and 0.95 if bootstrapping is off).
+        random can be a numpy Generator or a list with one per sample.  Returns a list with one MiqScoreInterval per sample.
+        '''
+        import numpy
+        if not replicates:
+            replicates = self.bootstrapReplicates or 2000
+        if confidenceLevel is None:
+            confidenceLevel = self.confidenceLevel
+        if not 0 < confidenceLevel < 1:
+            raise ValueError("Confidence level must be between 0 and 1. Got %s" %confidenceLevel)
+        referenceCountMatrix = numpy.atleast_2d(numpy.asarray(referenceCountMatrix, dtype=numpy.float64))
+        if not referenceCountMatrix.shape[1] == len(self.expectedReadSources):
+            raise ValueError("Reference count matrix needs one column per expected read source (%s). Got %s" %(len(self.expectedReadSources), referenceCountMatrix.shape[1]))
+        resamples = readCountMatrixOperations.drawMultinomialResamples(referenceCountMatrix, replicates, random)
+        miqScores, rawMiqScores = self.scoreResampledReferenceCounts(resamples)
+        tail = (1 - confidenceLevel) / 2
+        rawLimits = numpy.quantile(rawMiqScores, [tail, 1 - tail], axis=1)
+        limits = numpy.quantile(miqScores, [tail, 1 - tail], axis=1)
+        rawStandardErrors = rawMiqScores.std(axis=1, ddof=1) if replicates > 1 else numpy.zeros(len(rawMiqScores))
+        readTotals = referenceCountMatrix.sum(axis=1)
+        return [MiqScoreInterval(float(limits[0, row]), float(limits[1, row]), float(rawLimits[0, row]), float(rawLimits[1, row]), float(rawStandardErrors[row]), confidenceLevel, replicates, float(readTotals[row])) for row in range(referenceCountMatrix.shape[0])]
+
+    def scoreResampledReferenceCounts(self, referenceCountResamples):
+        '''
+        Scores an array of reference read counts with read sources (in the order of expectedReadSources) along the last axis, all
+        in NumPy with the calculator's tolerance and floor.  Returns (miqScores, rawMiqScores) arrays with the last axis removed.
+        Scores can differ from calculateMiq in the last bit, so this is for resampled counts rather than reported scores.
+        '''
+        compiledReference = self.standardReference.compiledReference
+        expectedPercentages = compiledReference.expectedValueVectors[self.analysisMethod][compiledReference.expectedReadSourceIndices[self.analysisMethod]]
+        samplePercentages = readCountMatrixOperations.convertMatrixToPercentages(referenceCountResamples)
+        samplePercentOfExpected = readCountMatrixOperations.calculateObservedPercentOfExpected(samplePercentages, expectedPercentages)
+        adjustedPercentErrors = readCountMatrixOperations.calculateAdjustedPercentErrors(samplePercentOfExpected, self.percentToleranceInStandard)
+        rawMiqScores = readCountMatrixOperations.calculateVectorizedRawMiqScores(adjustedPercentErrors)
+        return readCountMatrixOperations.applyFloor(rawMiqScores, self.floor), rawMiqScores
+
+    def bootstrapMiq(self, sampleData:dict, sampleID:str=None, replicates:int=None, confidenceLevel:float=None):
+        '''Percentile bootstrap interval (a MiqScoreInterval) for one sample's absolute counts, as taken by calculateMiq'''
+        aliasLookup = self.standardReference.compiledReference.aliasLookup
+        referenceCounts = [0] * len(self.expectedReadSources)
+        for rawName in sampleData:
+            column = self.expectedReadSourceIndex.get(aliasLookup.get(rawName, rawName))
+            if column is not None:
+                referenceCounts[column] += sampleData[rawName]
+        return self.bootstrapReferenceCounts(referenceCounts, replicates, confidenceLevel, self.makeBootstrapRandom(sampleID))[0]
+
+    @instrumentation.timed("bootstrapMiqBatch")
+    def bootstrapMiqBatch(self, miqScoreBatch, replicates:int=None, confidenceLevel:float=None, chunkSize:int=16):
+        '''
+        Bootstrap intervals for every sample in a MiqScoreBatch, in batch order.  Samples are resampled chunkSize at a time to bound
+        memory (chunkSize x replicates x read sources values).
+        '''
+        intervals = []
+        for start in range(0, len(miqScoreBatch), chunkSize):
+            random = None
+            if self.bootstrapSeed is not None:
+                random = [self.makeBootstrapRandom(sampleID) for sampleID in miqScoreBatch.sampleIDs[start:start + chunkSize]]
+            intervals.extend(self.bootstrapReferenceCounts(miqScoreBatch.referenceReadCounts[start:start + chunkSize], replicates, confidenceLevel, random))
+        return intervals
+
+    @instrumentation.timed("calculateRarefactionCurve")
+    def calculateRarefactionCurve(self, sampleData:dict, depths:[list, tuple]=None, replicates:int=200, confidenceLevel:float=None, sampleID:str=None, seed:int=None):
+        '''
+        Shows how a sample's MIQ score depends on read depth.  At each depth, replicates subsamples of that many reads are drawn
+        without replacement from all of the sample's reads (reference and nonreference, split as calculateMiq does), and every
+        subsample is scored in one batch.  Depths default to 20 geometrically spaced depths up to the sample's read total.
+        Subsampling is seeded from seed, or from the calculator's bootstrapSeed and the sample ID.  Returns a RarefactionCurve.
+        '''
+        import numpy
+        if confidenceLevel is None:
+            confidenceLevel = self.confidenceLevel
+        if not 0 < confidenceLevel < 1:
+            raise ValueError("Confidence level must be between 0 and 1. Got %s" %confidenceLevel)
+        if replicates < 1:
+            raise ValueError("Rarefaction needs at least one replicate per depth. Got %s" %replicates)
+        sampleData = referenceHandler.convertKeysToStandardIdentifiers(sampleData, self.standardReference)
+        referenceReads, nonreferenceReads = generalDictOperations.separateReferenceAndNonreferenceReads(sampleData, self.expectedReadSources)
+        readCounts = [referenceReads[readSource] for readSource in self.expectedReadSources]
+        readCounts.append(sum(nonreferenceReads.values()))  # nonreference reads only matter in total, so they are drawn as one group
+        readTotal = int(numpy.rint(readCounts).sum())
+        if depths is None:
+            depths = readCountMatrixOperations.makeRarefactionDepths(readTotal)
+        depths = sorted(set(int(depth) for depth in depths))
+        for depth in depths:
+            if depth <= 0 or depth > readTotal:
+                raise ValueError("Rarefaction depths must be between 1 and the %s reads in the sample. Got %s" %(readTotal, depth))
+        if seed is None:
+            random = self.makeBootstrapRandom(sampleID)
+        else:
+            random = numpy.random.default_rng(seed)
+        subsamples = readCountMatrixOperations.drawHypergeometricSubsamples(readCounts, depths, replicates, random)
+        miqScores, rawMiqScores = self.scoreResampledReferenceCounts(subsamples[:, :, :-1])
+        tail = (1 - confidenceLevel) / 2
+        limits = numpy.quantile(miqScores, [tail, 1 - tail], axis=1)
+        fullDepthScore = self.scoreReferenceCounts(readCounts[:-1], sum(referenceReads.values()))[0]
+        return RarefactionCurve(depths, miqScores.mean(axis=1), miqScores.std(axis=1), limits[0], limits[1], rawMiqScores.mean(axis=1), fullDepthScore, readTotal, replicates, confidenceLevel, sampleID)
+
+    def makeAccumulator(self):
+        '''Returns an empty MiqScoreAccumulator for scoring counts as they arrive'''
+        return MiqScoreAccumulator(self)
+
+
+class MemoizedMiqScoreCalculator(MiqScoreCalculator):
+    '''
+    MiqScoreCalculator that looks samples up in a scoreMemo.ScoreMemo before scoring them, so the same counts submitted again
+    (even under another sample ID or with aliases in another order) return a cheap copy of the earlier result.  Several
+    calculators can share one memo, since the key includes the analysis method, expected values, tolerance, floor and bootstrap
+    settings.  The memo's stats() give hit and miss counts.
+    '''
+    def __init__(self, standardReference: referenceHandler.StandardReference, analysisMethod:str, percentToleranceInStandard:[int, float]=0, floor:[int, float]=0, bootstrapReplicates:int=0, confidenceLevel:float=0.95, bootstrapSeed:int=None, memo:scoreMemo.ScoreMemo=None):
+        super().__init__(standardReference, analysisMethod, percentToleranceInStandard, floor, bootstrapReplicates, confidenceLevel, bootstrapSeed)
+        if memo is None:
+            memo = scoreMemo.ScoreMemo()
+        self.memo = memo
+
+    def calculateMiq(self, sampleData:dict, sampleID:str=None, compact:bool=False):
+        if compact:
+            return self.calculateCompactMiq(sampleData, sampleID)
+        calculate = lambda: super(MemoizedMiqScoreCalculator, self).calculateMiq(sampleData, sampleID)
+        return self.memo.getOrCalculate(self, sampleData, sampleID, False, calculate)
+
+    def calculateCompactMiq(self, sampleData:dict, sampleID:str=None):
+        calculate = lambda: super(MemoizedMiqScoreCalculator, self).calculateCompactMiq(sampleData, sampleID)
+        return self.memo.getOrCalculate(self, sampleData, sampleID, True, calculate)
+
+
+class MiqScoreAccumulator(object):
+    '''
+    Running read counts for one sample that can be scored at any point, for example while reads are still being aligned.
+    Count increments go through the same alias mapping as convertKeysToStandardIdentifiers.  Adding counts is constant time and
+    scoring, the read fate table and percent of expected each take one pass over the read sources, so nothing is recomputed from
+    the full count history.  Accumulators for shards of the same sample can be combined with merge().
+    '''
+
+    def __init__(self, calculator: MiqScoreCalculator):
+        self.calculator = calculator
+        self.aliasLookup = calculator.standardReference.compiledReference.aliasLookup
+        self.referenceCounts = [0] * len(calculator.expectedReadSources)
+        self.observedColumns = {}  # reference columns in the order they were first seen, so totals are summed like calculateMiq does
+        self.nonreferenceCounts = {}
+        self.updates = 0
+
+    def add(self, readSource:str, count:[int, float]=1):
+        readSource = self.aliasLookup.get(readSource, readSource)
+        column = self.calculator.expectedReadSourceIndex.get(readSource)
+        if column is None:
+            self.nonreferenceCounts[readSource] = self.nonreferenceCounts.get(readSource, 0) + count
+        else:
+            self.observedColumns[column] = True
+            self.referenceCounts[column] += count
+        self.updates += 1
+
+    def update(self, countIncrements:dict):
+        '''Adds a dictionary of readSource:count increments (aliases allowed)'''
+        for readSource in countIncrements:
+            self.add(readSource, countIncrements[readSource])
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        del state["aliasLookup"]  # a read-only view of the reference, taken from the calculator again when unpickled
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.aliasLookup = self.calculator.standardReference.compiledReference.aliasLookup
+
+    def merge(self, other):
+        '''
+        Adds the counts from another accumulator (such as one from a different alignment shard, possibly pickled in another process)
+        into this one and returns this one.  References are compared by content, so an unpickled copy of the same reference matches.
+        '''
+        if not (other.calculator.standardReference.compiledReference.contentHash == self.calculator.standardReference.compiledReference.contentHash and other.calculator.analysisMethod == self.calculator.analysisMethod):
+            raise ValueError("Only accumulators using the same standard reference and analysis method can be merged")
+        for column in other.observedColumns:
+            self.observedColumns[column] = True
+            self.referenceCounts[column] += other.referenceCounts[column]
+        for readSource in other.nonreferenceCounts:
+            self.nonreferenceCounts[readSource] = self.nonreferenceCounts.get(readSource, 0) + other.nonreferenceCounts[readSource]
+        self.updates += other.updates
+        return self
+
+    def reset(self):
+        self.referenceCounts = [0] * len(self.calculator.expectedReadSources)
+        self.observedColumns = {}
+        self.nonreferenceCounts = {}
+        self.updates = 0
+
+    @property
+    def referenceReadTotal(self):
+        readSum = 0
+        for column in self.observedColumns:
+            readSum += self.referenceCounts[column]
+        return readSum
+
+    @property
+    def referenceReadCounts(self):
+        return dict(zip(self.calculator.expectedReadSources, self.referenceCounts))
+
+    def score(self):
+        '''Current MIQ score (with the calculator's floor applied)'''
+        return self.calculator.scoreReferenceCounts(self.referenceCounts, self.referenceReadTotal)[0]
+
+    def rawScore(self):
+        return self.calculator.scoreReferenceCounts(self.referenceCounts, self.referenceReadTotal)[1]
+
+    def samplePercentagesOfExpected(self):
+        expectedValues = self.calculator.standardReference.expectedValues[self.calculator.analysisMethod]
+        readSum = self.referenceReadTotal
+        percentOfExpected = {}
+        for readSource, count in zip(self.calculator.expectedReadSources, self.referenceCounts):
+            if readSum == 0:
+                percentage = count
+            else:
+                percentage = (count / readSum) * 100
+            if percentage:
+                percentOfExpected[readSource] = (percentage / expectedValues[readSource]) * 100
+            else:
+                percentOfExpected[readSource] = 0
+        return percentOfExpected
+
+    def readFateTable(self):
+        readFates = self.nonreferenceCounts.copy()
+        readFates["Reference"] = self.referenceReadTotal
+        return absoluteReadCountDictOperations.convertDictToPercentages(readFates)
+
+    def result(self, sampleID:str=None, compact:bool=True):
+        '''Snapshot of the current counts as a CompactMiqScoreData (or a full MiqScoreData with compact=False)'''
+        import numpy
+        calculator = self.calculator
+        readSum = self.referenceReadTotal
+        filteredMiqScore, miqScore = calculator.scoreReferenceCounts(self.referenceCounts, readSum)
+        result = CompactMiqScoreData(filteredMiqScore, miqScore, calculator.expectedReadSources, numpy.array(self.referenceCounts, dtype=numpy.float64), readSum, tuple(self.nonreferenceCounts), numpy.array(list(self.nonreferenceCounts.values()), dtype=numpy.float64), calculator.percentToleranceInStandard, calculator.analysisMethod, calculator.standardReference, sampleID)
+        if compact:
+            return result
+        return result.toMiqScoreData()
+
+
+class MiqScoreInterval(object):
+    '''
+    Percentile bootstrap confidence interval for a sample's MIQ score, showing how much the sample's sequencing depth limits the
+    score.  Limits are given for the floored score and the raw score, along with the standard error of the raw score.
+    '''
+
+    __slots__ = ["miqScoreLower",
+                 "miqScoreUpper",
+                 "rawMiqScoreLower",
+                 "rawMiqScoreUpper",
+                 "rawMiqScoreStandardError",
+                 "confidenceLevel",
+                 "replicates",
+                 "referenceReadTotal"]
+
+    def __init__(self, miqScoreLower:float, miqScoreUpper:float, rawMiqScoreLower:float, rawMiqScoreUpper:float, rawMiqScoreStandardError:float, confidenceLevel:float, replicates:int, referenceReadTotal:[int, float]):
+        self.miqScoreLower = miqScoreLower
+        self.miqScoreUpper = miqScoreUpper
+        self.rawMiqScoreLower = rawMiqScoreLower
+        self.rawMiqScoreUpper = rawMiqScoreUpper
+        self.rawMiqScoreStandardError = rawMiqScoreStandardError
+        self.confidenceLevel = confidenceLevel
+        self.replicates = replicates
+        self.referenceReadTotal = referenceReadTotal
+
+    def __repr__(self):
+        return "MiqScoreInterval(%.0f%%: %.2f-%.2f)" %(self.confidenceLevel * 100, self.miqScoreLower, self.miqScoreUpper)
+
+    def toDict(self):
+        return {"miqScoreLower": self.miqScoreLower,
+                "miqScoreUpper": self.miqScoreUpper,
+                "rawMiqScoreLower": self.rawMiqScoreLower,
+                "rawMiqScoreUpper": self.rawMiqScoreUpper,
+                "rawMiqScoreStandardError": self.rawMiqScoreStandardError,
+                "confidenceLevel": self.confidenceLevel,
+                "replicates": self.replicates,
+                "referenceReadTotal": self.referenceReadTotal}
+
+
+class RarefactionCurve(object):
+    '''
+    Expected MIQ score and its spread at a series of read depths, from MiqScoreCalculator.calculateRarefactionCurve.  Arrays line
+    up with depths.  stableDepth() finds the depth from which the score stops depending on depth, and makePlot() draws the curve.
+    '''
+
+    __slots__ = ["depths",
+                 "meanMiqScores",
+                 "miqScoreStandardDeviations",
+                 "lowerMiqScores",
+                 "upperMiqScores",
+                 "meanRawMiqScores",
+                 "fullDepthMiqScore",
+                 "readTotal",
+                 "replicates",
+                 "confidenceLevel",
+                 "sampleID"]
+
+    def __init__(self, depths:list, meanMiqScores, miqScoreStandardDeviations, lowerMiqScores, upperMiqScores, meanRawMiqScores, fullDepthMiqScore:float, readTotal:int, replicates:int, confidenceLevel:float, sampleID:str=None):
+        self.depths = list(depths)
+        self.meanMiqScores = meanMiqScores
+        self.miqScoreStandardDeviations = miqScoreStandardDeviations
+        self.lowerMiqScores = lowerMiqScores
+        self.upperMiqScores = upperMiqScores
+        self.meanRawMiqScores = meanRawMiqScores
+        self.fullDepthMiqScore = fullDepthMiqScore
+        self.readTotal = readTotal
+        self.replicates = replicates
+        self.confidenceLevel = confidenceLevel
+        self.sampleID = sampleID
+
+    def __len__(self):
+        return len(self.depths)
+
+    def stableDepth(self, tolerance:float=1.0):
+        '''
+        Lowest depth from which every depth has a score standard deviation within tolerance (in MIQ points) and a mean score within
+        tolerance of the full depth score.  Returns None if the score is not stable even at the highest depth.
+        '''
+        stableDepth = None
+        for depth, meanMiqScore, standardDeviation in zip(reversed(self.depths), reversed(self.meanMiqScores.tolist()), reversed(self.miqScoreStandardDeviations.tolist())):
+            if standardDeviation > tolerance or abs(meanMiqScore - self.fullDepthMiqScore) > tolerance:
+                break
+            stableDepth = depth
+        return stableDepth
+
+    def toDict(self, tolerance:float=1.0):
+        return {"sampleID": self.sampleID,
+                "depths": self.depths,
+                "meanMiqScores": self.meanMiqScores.tolist(),
+                "miqScoreStandardDeviations": self.miqScoreStandardDeviations.tolist(),
+                "lowerMiqScores": self.lowerMiqScores.tolist(),
+                "upperMiqScores": self.upperMiqScores.tolist(),
+                "meanRawMiqScores": self.meanRawMiqScores.tolist(),
+                "fullDepthMiqScore": self.fullDepthMiqScore,
+                "readTotal": self.readTotal,
+                "replicates": self.replicates,
+                "confidenceLevel": self.confidenceLevel,
+                "stableDepth": self.stableDepth(tolerance),
+                "stabilityTolerance": tolerance}
+
+    def makePlot(self, format:str="png", tolerance:float=1.0, output:str="base64"):
+        return plotting.rarefactionCurve.makeRarefactionCurve(self.depths, self.meanMiqScores.tolist(), self.lowerMiqScores.tolist(), self.upperMiqScores.tolist(), self.fullDepthMiqScore, self.stableDepth(tolerance), self.sampleID, self.confidenceLevel, format, output)
+
+
+class MiqScoreBatch(object):
+    '''
+    Compact results for a set of samples scored together.  Per-sample values are stored as rows of arrays with columns in the order of readSources (reference) or nonreferenceReadSources.
+    '''
+
+    __slots__ = ["miqScores",
+                 "rawMiqScores",
+                 "readSources",
+                 "referenceReadCounts",
+                 "nonreferenceReadSources",
+                 "nonreferenceReadCounts",
+                 "samplePercentages",
+                 "samplePercentagesOfExpected",
+                 "percentToleranceInStandard",
+                 "analysisMethod",
+                 "standardReference",
+                 "sampleIDs"]
+
+    def __init__(self, miqScores, rawMiqScores, readSources:list, referenceReadCounts, nonreferenceReadSources:list, nonreferenceReadCounts, samplePercentages, samplePercentagesOfExpected, percentToleranceInStandard:float, analysisMethod:str, standardReference: referenceHandler.StandardReference, sampleIDs:list):
+        self.miqScores = miqScores
+        self.rawMiqScores = rawMiqScores
+        self.readSources = list(readSources)
+        self.referenceReadCounts = referenceReadCounts
+        self.nonreferenceReadSources = list(nonreferenceReadSources)
+        self.nonreferenceReadCounts = nonreferenceReadCounts
+        self.samplePercentages = samplePercentages
+        self.samplePercentagesOfExpected = samplePercentagesOfExpected
+        self.percentToleranceInStandard = percentToleranceInStandard
+        self.analysisMethod = analysisMethod
+        self.standardReference = standardReference
+        self.sampleIDs = sampleIDs
+
+    def __len__(self):
+        return len(self.sampleIDs)
+
+    def __getitem__(self, index:int):
+        return self.makeCompactMiqScoreData(index)
+
+    def scoreTable(self):
+        '''Returns a dictionary of sampleID:miqScore (sample index is used for samples without an ID)'''
+        scoreTable = {}
+        for index, sampleID in enumerate(self.sampleIDs):
+            if sampleID is None:
+                sampleID = index
+            scoreTable[sampleID] = float(self.miqScores[index])
+        return scoreTable
+
+    def makeRunCompositionPlots(self, samplesPerPage:int=96, includeTheoretical:bool=True, sortingName:str="Lysis Difficulty", format:str="png", output:str="base64"):
+        '''
+        Composition plots for the whole batch, samplesPerPage bars to a page, with taxa stacked and colored by their order in one of the
+        reference's sortings so every page and every run uses the same colors (see plotting.stackedBars.makeRunCompositionPlots).
+        '''
+        import numpy
+        columnIndex = {readSource: column for column, readSource in enumerate(self.readSources)}
+        valueOrder = [readSource for readSource in self.standardReference.sortings[sortingName][1] if readSource in columnIndex]
+        columns = [columnIndex[readSource] for readSource in valueOrder]
+        percentageMatrix = numpy.asarray(self.samplePercentages)[:, columns]
+        referencePercentages = None
+        if includeTheoretical:
+            expectedPercentages = self.standardReference.expectedValues[self.analysisMethod]
+            referencePercentages = [expectedPercentages.get(readSource, 0) for readSource in valueOrder]
+        sampleNames = [str(index) if sampleID is None else str(sampleID) for index, sampleID in enumerate(self.sampleIDs)]
+        colorTable = plotting.stackedBars.makeTaxonColorTable(self.standardReference, sortingName)
+        return plotting.stackedBars.makeRunCompositionPlots(percentageMatrix, sampleNames, valueOrder, "Run Composition", samplesPerPage, format, printNameTable=self.standardReference.printNames, colorTable=colorTable, referencePercentages=referencePercentages, output=output)
+
+    def makeMiqScoreData(self, index:int):
+        '''Builds the full MiqScoreData object for one sample.  Nonreference read sources with no reads are left out.'''
+        referenceReads = dict(zip(self.readSources, self.referenceReadCounts[index].tolist()))
+        nonreferenceReads = {}
+        for readSource, count in zip(self.nonreferenceReadSources, self.nonreferenceReadCounts[index].tolist()):
+            if count:
+                nonreferenceReads[readSource] = count
+        samplePercentages = dict(zip(self.readSources, self.samplePercentages[index].tolist()))
+        samplePercentagesOfExpected = dict(zip(self.readSources, self.samplePercentagesOfExpected[index].tolist()))
+        return MiqScoreData(float(self.miqScores[index]), float(self.rawMiqScores[index]), referenceReads, nonreferenceReads, samplePercentages, samplePercentagesOfExpected, self.percentToleranceInStandard, self.analysisMethod, self.standardReference, self.sampleIDs[index])
+
+    def makeCompactMiqScoreData(self, index:int):
+        '''Returns one sample as a CompactMiqScoreData.  Nonreference read sources with no reads are left out.'''
+        nonreferenceColumns = self.nonreferenceReadCounts[index].nonzero()[0]
+        nonreferenceReadSources = tuple(self.nonreferenceReadSources[column] for column in nonreferenceColumns.tolist())
+        return CompactMiqScoreData(float(self.miqScores[index]), float(self.rawMiqScores[index]), self.readSources, self.referenceReadCounts[index].copy(), float(self.referenceReadCounts[index].sum()), nonreferenceReadSources, self.nonreferenceReadCounts[index, nonreferenceColumns], self.percentToleranceInStandard, self.analysisMethod, self.standardReference, self.sampleIDs[index])
+
+
+class CompactMiqScoreData(object):
+    '''
+    Lightweight result for score-only work.  Reference read counts are kept as an array in the order of readSources (shared with the calculator)
+    and nonreference counts as an array alongside a tuple of their names.  The dictionaries, read fate table and plots of MiqScoreData are only
+    built when they are used, and toMiqScoreData() gives the full object (which is kept, so plots made through this object are not redrawn).
+    '''
+
+    __slots__ = ["miqScore",
+                 "rawMiqScore",
+                 "readSources",
+                 "referenceCounts",
+                 "referenceReadTotal",
+                 "nonreferenceReadSources",
+                 "nonreferenceCounts",
+                 "percentToleranceInStandard",
+                 "analysisMethod",
+                 "standardReference",
+                 "sampleID",
+                 "confidenceInterval",
+                 "miqScoreData"]
+
+    def __init__(self, miqScore:float, rawMiqScore:float, readSources:[list, tuple], referenceCounts, referenceReadTotal:[int, float], nonreferenceReadSources:tuple, nonreferenceCounts, percentToleranceInStandard:float, analysisMethod:str, standardReference: referenceHandler.StandardReference, sampleID:str=None):
+        self.miqScore = miqScore
+        self.rawMiqScore = rawMiqScore
+        self.readSources = readSources
+        self.referenceCounts = referenceCounts
+        self.referenceReadTotal = referenceReadTotal
+        self.nonreferenceReadSources = nonreferenceReadSources
+        self.nonreferenceCounts = nonreferenceCounts
+        self.percentToleranceInStandard = percentToleranceInStandard
+        self.analysisMethod = analysisMethod
+        self.standardReference = standardReference
+        self.sampleID = sampleID
+        self.confidenceInterval = None
+        self.miqScoreData = None
+
+    @property
+    def samplePercentageVector(self):
+        if not self.referenceReadTotal:
+            return self.referenceCounts.copy()
+        return (self.referenceCounts / self.referenceReadTotal) * 100
+
+    @property
+    def samplePercentOfExpectedVector(self):
+        import numpy
+        compiledReference = self.standardReference.compiledReference
+        expectedPercentages = compiledReference.expectedValueVectors[self.analysisMethod][compiledReference.expectedReadSourceIndices[self.analysisMethod]]
+        samplePercentages = self.samplePercentageVector
+        return numpy.where(samplePercentages != 0, (samplePercentages / expectedPercentages) * 100, 0.0)
+
+    @property
+    def referenceReadCounts(self):
+        return dict(zip(self.readSources, self.referenceCounts.tolist()))
+
+    @property
+    def nonreferenceReadCounts(self):
+        return dict(zip(self.nonreferenceReadSources, self.nonreferenceCounts.tolist()))
+
+    @property
+    def samplePercentages(self):
+        return dict(zip(self.readSources, self.samplePercentageVector.tolist()))
+
+    @property
+    def samplePercentagesOfExpected(self):
+        return dict(zip(self.readSources, self.samplePercentOfExpectedVector.tolist()))
+
+    @property
+    def readFateTable(self):
+        readFates = self.nonreferenceReadCounts
+        readFates["Reference"] = self.referenceReadTotal
+        return absoluteReadCountDictOperations.convertDictToPercentages(readFates)
+
+    @property
+    def plots(self):
+        if self.miqScoreData is None:
+            return {}
+        return self.miqScoreData.plots
+
+    def toMiqScoreData(self):
+        if self.miqScoreData is None:
+            self.miqScoreData = MiqScoreData(self.miqScore, self.rawMiqScore, self.referenceReadCounts, self.nonreferenceReadCounts, self.samplePercentages, self.samplePercentagesOfExpected, self.percentToleranceInStandard, self.analysisMethod, self.standardReference, self.sampleID)
+            self.miqScoreData.confidenceInterval = self.confidenceInterval
+        return self.miqScoreData
+
+    def makeReadFateChart(self, *args, **kwargs):
+        return self.toMiqScoreData().makeReadFateChart(*args, **kwargs)
+
+    def makeRadarPlots(self, *args, **kwargs):
+        return self.toMiqScoreData().makeRadarPlots(*args, **kwargs)
+
+    def makeCompositionBarPlot(self, *args, **kwargs):
+        return self.toMiqScoreData().makeCompositionBarPlot(*args, **kwargs)
+
+    def renderAllPlots(self, *args, **kwargs):
+        return self.toMiqScoreData().renderAllPlots(*args, **kwargs)
+
+    def jsonOutput(self, stream=None, includeProfile:bool=False, plots:dict=None):
+        return self.toMiqScoreData().jsonOutput(stream, includeProfile, plots)
+
+    def binaryOutput(self, stream=None, includePlots:bool=True):
+        return self.toMiqScoreData().binaryOutput(stream, includePlots)
 
 
 class MiqScoreData(object):
@@ -77,6 +743,9 @@ class MiqScoreData(object):
         self.sampleID = sampleID
         self.storePlots = storePlots
         self.plots = {}
+        self.profile = None  # instrumentation.SampleProfile when instrumentation is enabled
+        self.confidenceInterval = None  # MiqScoreInterval when the calculator bootstraps scores
+        self.rarefactionCurve = None  # RarefactionCurve from MiqScoreCalculator.calculateRarefactionCurve, if one is attached
 
     def makeReadFateTable(self):
         readFates = self.nonreferenceReadCounts.copy()
@@ -84,7 +753,8 @@ class MiqScoreData(object):
         readFates = absoluteReadCountDictOperations.convertDictToPercentages(readFates)
         return readFates
 
-    def makeReadFateChart(self, format:str="png", forceRedraw:bool=False, readFatePrintNames:dict=None):
+    @instrumentation.profiledMethod("makeReadFateChart")
+    def makeReadFateChart(self, format:str="png", forceRedraw:bool=False, readFatePrintNames:dict=None, plotCache:plotting.plotCache.PlotCache=None, output:str="base64"):
         if "readFates" in self.plots and not forceRedraw:
             return self.plots["readFates"]
         printReadFateTable = {}
@@ -96,12 +766,14 @@ class MiqScoreData(object):
                     printReadFateTable[readFate] = self.readFateTable[readFate]
         else:
             printReadFateTable = self.readFateTable.copy()
-        encodedPlot = plotting.readFateChart.makeReadFateChart(printReadFateTable, self.sampleID, explodeCell="Aligned To Reference", saveFormat=format)
+        makePlot = lambda: plotting.getDrawingModule("readFateChart", format).makeReadFateChart(printReadFateTable, self.sampleID, explodeCell="Aligned To Reference", saveFormat=format, output=output)
+        encodedPlot = plotting.plotCache.makeCachedPlot(plotCache, "readFateChart", makePlot, format, output, readFates=printReadFateTable, sampleID=self.sampleID, explodeCell="Aligned To Reference")
         if self.storePlots:
             self.plots["readFates"] = encodedPlot
         return encodedPlot
 
-    def makeRadarPlots(self, format:str="png", forceRedraw:bool=False):
+    @instrumentation.profiledMethod("makeRadarPlots")
+    def makeRadarPlots(self, format:str="png", forceRedraw:bool=False, plotCache:plotting.plotCache.PlotCache=None, output:str="base64"):
         if "radarPlots" in self.plots and not forceRedraw:
             return self.plots["radarPlots"]
         radarPlots = {}
@@ -113,14 +785,15 @@ class MiqScoreData(object):
                 plotTitle = "%s: %s" %(self.sampleID, "Sorted By " + sortingMethod)
             else:
                 plotTitle = sortingMethod
-            plottingDict = {plotTitle: self.samplePercentagesOfExpected}
-            encodedPlot = plotting.radarMaker.makeRadarPlot(plottingDict, orderedList, sortingMethod, topHigh=topHigh, format=format, printNames=self.standardReference.printNames)
+            makePlot = lambda: plotting.getDrawingModule("radarMaker", format).makeSingleSampleRadarPlot(plotTitle, self.samplePercentagesOfExpected, orderedList, sortingMethod, topHigh=topHigh, format=format, printNames=self.standardReference.printNames, output=output)
+            encodedPlot = plotting.plotCache.makeCachedPlot(plotCache, "radarPlot", makePlot, format, output, title=plotTitle, data=self.samplePercentagesOfExpected, dataRankOrder=orderedList, orderedFeature=sortingMethod, topHigh=topHigh, printNames=self.standardReference.printNames)
             radarPlots[sortingMethod] = encodedPlot
         if self.storePlots:
             self.plots["radarPlots"] = radarPlots
         return radarPlots
 
-    def makeCompositionBarPlot(self, goodExample:dict=None, badExample:dict=None):
+    @instrumentation.profiledMethod("makeCompositionBarPlot")
+    def makeCompositionBarPlot(self, goodExample:dict=None, badExample:dict=None, plotCache:plotting.plotCache.PlotCache=None, output:str="base64", format:str="png"):
         expectedPercentagesRaw = self.standardReference.expectedValues[self.analysisMethod]
         barPlotValueOrder = []
         for value in self.standardReference.sortings["Lysis Difficulty"][1]:
@@ -142,29 +815,119 @@ class MiqScoreData(object):
             sampleOrder = ("Theoretical", "Good", self.sampleID, "Biased")
         else:
             sampleOrder = ("Theoretical", self.sampleID)
-        encodedPlot = plotting.stackedBars.makeStackedBar(barPlotData, barPlotValueOrder, sampleOrder, "%s Composition" %self.sampleID, printNameTable=self.standardReference.printNames)
+        makePlot = lambda: plotting.getDrawingModule("stackedBars", format).makeStackedBar(barPlotData, barPlotValueOrder, sampleOrder, "%s Composition" %self.sampleID, format, printNameTable=self.standardReference.printNames, output=output)
+        encodedPlot = plotting.plotCache.makeCachedPlot(plotCache, "stackedBar", makePlot, format, output, data=barPlotData, valueOrder=barPlotValueOrder, sampleOrder=sampleOrder, title="%s Composition" %self.sampleID, printNames=self.standardReference.printNames)
         if self.storePlots:
             self.plots["compositionPlot"] = encodedPlot
         return encodedPlot
 
-    def jsonOutput(self):
-        import json
+    @instrumentation.profiledMethod("makeRarefactionPlot")
+    def makeRarefactionPlot(self, format:str="png", forceRedraw:bool=False, tolerance:float=1.0, output:str="base64"):
+        '''Plots the attached rarefactionCurve (see MiqScoreCalculator.calculateRarefactionCurve)'''
+        if self.rarefactionCurve is None:
+            raise ValueError("No rarefaction curve is attached to sample %s. Set rarefactionCurve from MiqScoreCalculator.calculateRarefactionCurve first" %self.sampleID)
+        if "rarefactionCurve" in self.plots and not forceRedraw:
+            return self.plots["rarefactionCurve"]
+        encodedPlot = self.rarefactionCurve.makePlot(format, tolerance, output)
+        if self.storePlots:
+            self.plots["rarefactionCurve"] = encodedPlot
+        return encodedPlot
+
+    @instrumentation.profiledMethod("renderAllPlots")
+    def renderAllPlots(self, format:str="png", goodExample:dict=None, badExample:dict=None, readFatePrintNames:dict=None, forceRedraw:bool=False, plotCache:plotting.plotCache.PlotCache=None, output:str="base64", executor=None):
+        '''
+        Draws the read fate chart, radar plots and composition bar plot at the same time on a thread pool and returns them as a
+        dictionary with the same keys as plots.  Plots are drawn on their own figures without pyplot, so this is safe to call from
+        several threads as well.  Pass a concurrent.futures executor to share one pool between samples; otherwise a pool of three
+        threads is made for the call.
+        '''
+        import concurrent.futures
+        plotTasks = {"readFates": (self.makeReadFateChart, (format, forceRedraw, readFatePrintNames, plotCache, output)),
+                     "radarPlots": (self.makeRadarPlots, (format, forceRedraw, plotCache, output)),
+                     "compositionPlot": (self.makeCompositionBarPlot, (goodExample, badExample, plotCache, output, format))}
+        ownExecutor = executor is None
+        if ownExecutor:
+            executor = concurrent.futures.ThreadPoolExecutor(max_workers=len(plotTasks))
+        try:
+            futures = {plotName: executor.submit(method, *methodArgs) for plotName, (method, methodArgs) in plotTasks.items()}
+            return {plotName: future.result() for plotName, future in futures.items()}
+        finally:
+            if ownExecutor:
+                executor.shutdown()
+
+    @instrumentation.profiledMethod("jsonOutput")
+    def jsonOutput(self, stream=None, includeProfile:bool=False, plots:dict=None):
+        '''
+        Returns the results as a JSON string, or writes them to stream if one is given.  Plots kept as raw bytes or EncodedPlot handles are written as base64, a chunk at a time.
+        plots replaces the stored plots in the output, for example with the asset links from ReportBundle.linkPlots.
+        A bootstrap confidence interval, if one was calculated, is added under "miqScoreConfidenceInterval" and an attached rarefaction
+        curve under "rarefactionCurve".
+        With includeProfile, the instrumentation profile for the sample (if one was recorded) is added under "profile".
+        '''
         resultTable = {"nonreferenceReadCounts": self.nonreferenceReadCounts,
                        "miqScore": self.miqScore,
                        "rawMiq": self.rawMiqScore,
                        "percentToleranceInStandard": self.percentToleranceInStandard,
-                       "plots": self.plots,
+                       "plots": self.plots if plots is None else plots,
                        "readFateTable": self.readFateTable,
                        "referenceReadCounts": self.referenceReadCounts,
                        "sampleID": self.sampleID,
                        "samplePercentages": self.samplePercentages,
                        "samplePercentagesOfExpected": self.samplePercentagesOfExpected}
-        return json.dumps(resultTable, indent=4)
+        if self.confidenceInterval is not None:
+            resultTable["miqScoreConfidenceInterval"] = self.confidenceInterval.toDict()
+        if self.rarefactionCurve is not None:
+            resultTable["rarefactionCurve"] = self.rarefactionCurve.toDict()
+        if includeProfile and self.profile is not None:
+            resultTable["profile"] = self.profile.toDict()
+        chunks = plotting.plotEncoding.iterateJSONChunks(resultTable, indent=4)
+        if stream is not None:
+            for chunk in chunks:
+                stream.write(chunk)
+            return None
+        return "".join(chunks)
 
+    def binaryOutput(self, stream=None, includePlots:bool=True):
+        '''
+        Returns the results in the compact binary result format (see binaryResult), or writes them to a binary stream if one is given.
+        Scores, counts, percentages and any confidence interval or rarefaction curve are stored, and plots (unless includePlots is
+        False) are kept as raw image bytes in their own sections.  binaryResult.loadResult rebuilds the result without scoring again.
+        '''
+        if stream is not None:
+            binaryResult.writeResult(self, stream, includePlots)
+            return None
+        return binaryResult.makeResultBytes(self, includePlots)
 
-def loadExampleData(goodMiqPath:str, badMiqPath:str, referenceData:[str, referenceHandler.StandardReference], analysisMethod:str):
-    import os
+
+def readExampleReport(path:str):
+    '''Sample ID, percent tolerance and counts (reference and nonreference) from an example result saved as JSON or in the binary format'''
     import json
+    if binaryResult.isBinaryResult(path):
+        with binaryResult.BinaryResultFile(path) as resultFile:
+            scores = resultFile.readScores()
+            referenceReadCounts, nonreferenceReadCounts = resultFile.readCounts()
+        return {"sampleID": scores["sampleID"],
+                "percentToleranceInStandard": scores["percentToleranceInStandard"],
+                "referenceReadCounts": referenceReadCounts,
+                "nonreferenceReadCounts": nonreferenceReadCounts}
+    file = open(path, 'r')
+    report = json.load(file)
+    file.close()
+    return report
+
+
+def loadBinaryExample(path:str, standardReference: referenceHandler.StandardReference, analysisMethod:str, plotFormat:str="png"):
+    '''The stored result of a binary (.miqb) example scored with analysisMethod, with its plots in plotFormat, or None if it has to be scored again'''
+    if not binaryResult.isBinaryResult(path):
+        return None
+    with binaryResult.BinaryResultFile(path) as resultFile:
+        if not resultFile.readScores()["analysisMethod"] == analysisMethod:
+            return None
+        return resultFile.loadResult(standardReference, plotFormat=plotFormat)
+
+
+def loadExampleData(goodMiqPath:str, badMiqPath:str, referenceData:[str, referenceHandler.StandardReference], analysisMethod:str, plotCache:plotting.plotCache.PlotCache=None, memo:scoreMemo.ScoreMemo=None, plotFormat:str="png"):
+    import os
     if not os.path.isfile(goodMiqPath):
         raise FileNotFoundError("Unable to find good miq example at %s" %goodMiqPath)
     if not os.path.isfile(badMiqPath):
@@ -176,33 +939,34 @@ def loadExampleData(goodMiqPath:str, badMiqPath:str, referenceData:[str, referen
             referenceData = referenceHandler.StandardReference(referenceData)
     examples = []
     for path in [goodMiqPath, badMiqPath]:
-        file = open(path, 'r')
-        report = json.load(file)
-        file.close()
-        sampleCounts = report["nonreferenceReadCounts"]
-        sampleCounts.update(report["referenceReadCounts"])
-        calculator = MiqScoreCalculator(referenceData, analysisMethod=analysisMethod, percentToleranceInStandard=report["percentToleranceInStandard"], floor=0)
-        miqScoreResult = calculator.calculateMiq(sampleCounts, report["sampleID"])
-        miqScoreResult.makeReadFateChart()
-        miqScoreResult.makeRadarPlots()
-        miqScoreResult.makeCompositionBarPlot()
+        miqScoreResult = loadBinaryExample(path, referenceData, analysisMethod, plotFormat)
+        if miqScoreResult is None:
+            report = readExampleReport(path)
+            sampleCounts = report["nonreferenceReadCounts"]
+            sampleCounts.update(report["referenceReadCounts"])
+            if memo is None:
+                calculator = MiqScoreCalculator(referenceData, analysisMethod=analysisMethod, percentToleranceInStandard=report["percentToleranceInStandard"], floor=0)
+            else:
+                calculator = MemoizedMiqScoreCalculator(referenceData, analysisMethod=analysisMethod, percentToleranceInStandard=report["percentToleranceInStandard"], floor=0, memo=memo)
+            miqScoreResult = calculator.calculateMiq(sampleCounts, report["sampleID"])
+        # plots already loaded from a binary example are kept, so these only draw what the file did not have in plotFormat
+        miqScoreResult.makeReadFateChart(plotFormat, plotCache=plotCache)
+        miqScoreResult.makeRadarPlots(plotFormat, plotCache=plotCache)
+        if not "compositionPlot" in miqScoreResult.plots:  # shared with earlier copies when the example came from the memo
+            miqScoreResult.makeCompositionBarPlot(plotCache=plotCache, format=plotFormat)
         examples.append(miqScoreResult)
     return examples
 
 
 def loadReferenceCompositionFromExampleMiq(goodMiqPath:str, badMiqPath:str):
     import os
-    import json
     if not os.path.isfile(goodMiqPath):
         raise FileNotFoundError("Unable to find good miq example at %s" % goodMiqPath)
     if not os.path.isfile(badMiqPath):
         raise FileNotFoundError("Unable to find bad miq example at %s" % badMiqPath)
     examples = []
     for path in [goodMiqPath, badMiqPath]:
-        file = open(path, 'r')
-        report = json.load(file)
-        file.close()
-        referenceReadCounts = report["referenceReadCounts"]
+        referenceReadCounts = readExampleReport(path)["referenceReadCounts"]
         examples.append(absoluteReadCountDictOperations.convertDictToPercentages(referenceReadCounts))
     return examples
 
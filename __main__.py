@@ -0,0 +1,4 @@
+import sys
+from .batchRunner import main
+
+sys.exit(main())
@@ -0,0 +1,359 @@
+import os
+import sys
+from . import referenceHandler
+from . import countTableReader
+from . import instrumentation
+from . import binaryResult
+from . import countArchive
+
+_workerState = {}
+
+
+def parseArgs(argv:list=None):
+    import argparse
+    parser = argparse.ArgumentParser(prog="python -m miqScoreNGSReadCountPublic", description="Score and report MIQ for many samples in parallel")
+    parser.add_argument("counts", help="Count table (wide, long or BIOM), count archive or a directory of per-sample count files (.json dictionaries or two column feature/count tables)")
+    parser.add_argument("-r", "--reference", default=os.path.join(os.path.split(referenceHandler.__file__)[0], "zrCommunityStandard.json"), help="Standard reference JSON. Defaults to the Zymo community standard")
+    parser.add_argument("-m", "--analysisMethod", required=True, help="Analysis method from the reference expected values")
+    parser.add_argument("-o", "--outputDirectory", required=True, help="Directory to write per-sample JSON and HTML reports into")
+    parser.add_argument("-t", "--percentToleranceInStandard", type=float, default=0, help="Manufacturing tolerance of the standard in percent")
+    parser.add_argument("-f", "--floor", type=float, default=0, help="Minimum MIQ score. Use a negative value for no floor")
+    parser.add_argument("--bootstrapReplicates", type=int, default=0, help="Add a bootstrap confidence interval for the MIQ score to each sample's JSON output, using this many multinomial resamples (2000 is a good choice)")
+    parser.add_argument("--confidenceLevel", type=float, default=0.95, help="Confidence level for bootstrap intervals")
+    parser.add_argument("--bootstrapSeed", type=int, help="Seed for reproducible bootstrap intervals")
+    parser.add_argument("--rarefactionReplicates", type=int, default=0, help="Add a rarefaction curve (MIQ score by read depth, with this many subsamples per depth) to each sample's JSON output and report")
+    parser.add_argument("-w", "--workers", type=int, default=os.cpu_count(), help="Number of worker processes")
+    parser.add_argument("--longTable", action="store_true", help="Count table has one sample, feature, count record per line")
+    parser.add_argument("--nonreferenceFates", nargs="*", default=[], help="Features in a count table to keep as named read fates instead of grouping them as unassigned")
+    parser.add_argument("--template", help="HTML report template. If not given, only JSON output is written")
+    parser.add_argument("--goodExample", help="JSON or binary (.miqb) output from a good example sample (required with --template)")
+    parser.add_argument("--badExample", help="JSON or binary (.miqb) output from a biased example sample (required with --template)")
+    parser.add_argument("--radarSorting", default="Lysis Difficulty", help="Sorting method to use for the radar plots in the HTML report")
+    parser.add_argument("--plotFormat", choices=("png", "nativesvg"), default="png", help="Format of the read fate, radar and composition plots. nativesvg draws small vector plots directly, without matplotlib")
+    parser.add_argument("--binaryOutput", action="store_true", help="Also write each sample's result in the compact binary result format (.miqb), which loads without scoring or drawing plots again")
+    parser.add_argument("--noPlots", action="store_true", help="Only write scores. No plots or HTML reports will be made")
+    parser.add_argument("--bundle", action="store_true", help="Write the run as a report bundle: plots are stored once in assets/ by content hash and linked from the HTML reports instead of embedded, and index.html summarizes every sample")
+    parser.add_argument("--plotCache", help="Directory for a plot cache shared between runs and workers")
+    parser.add_argument("--plotCacheSize", type=int, default=1024, help="Maximum plot cache size in MB")
+    parser.add_argument("--profile", action="store_true", help="Time each stage of scoring, plotting and reporting. Adds a profile to each sample's JSON output and writes run totals to metrics.json")
+    parser.add_argument("--history", help="SQLite score history to add every sample's scores, read source values and read fates to")
+    parser.add_argument("--instrument", help="Instrument name recorded with the run in the score history")
+    parser.add_argument("--runName", help="Run name recorded in the score history. Defaults to the counts file or directory name")
+    parser.add_argument("--historyPlots", action="store_true", help="Also store each sample's plots in the score history")
+    parser.add_argument("--scoreMemo", help="SQLite file of memoized scores shared between runs and workers, so samples with counts that were scored before are not scored again")
+    parser.add_argument("--scoreMemoSize", type=int, default=4096, help="Number of memoized scores each worker keeps in memory")
+    parser.add_argument("--quiet", action="store_true", help="Do not show progress")
+    args = parser.parse_args(argv)
+    if args.template and not (args.goodExample and args.badExample):
+        parser.error("--template requires both --goodExample and --badExample")
+    if args.floor < 0:
+        args.floor = None
+    args.historyRunID = None  # set by main once the run is recorded in the score history
+    return args
+
+
+def iterateSamples(countsPath:str, standardReference: referenceHandler.StandardReference, longTable:bool=False, nonreferenceFates:list=()):
+    '''Yields (sampleID, countDict) from a count table, a count archive or a directory with one count file per sample'''
+    if countArchive.isCountArchive(countsPath):
+        archive = countArchive.CountArchive(countsPath)
+        for index, sampleID in enumerate(archive.getSampleIDs()):
+            yield sampleID, archive.getSampleData(index)
+        return
+    if not os.path.isdir(countsPath):
+        reader = countTableReader.CountTableReader(standardReference, nonreferenceFates)
+        for sampleID, counts in reader.readTable(countsPath, long=longTable):
+            yield sampleID, reader.makeCountDict(counts)
+        return
+    for fileName in sorted(os.listdir(countsPath)):
+        path = os.path.join(countsPath, fileName)
+        if not os.path.isfile(path) or fileName.startswith("."):
+            continue
+        yield os.path.splitext(fileName)[0], loadCountFile(path)
+
+
+def loadCountFile(path:str):
+    '''Loads a single sample's counts from a JSON dictionary or a two column feature/count table'''
+    import json
+    import csv
+    if path.lower().endswith(".json"):
+        file = open(path, 'r')
+        counts = json.load(file)
+        file.close()
+        if "referenceReadCounts" in counts:
+            sampleCounts = counts["nonreferenceReadCounts"]
+            sampleCounts.update(counts["referenceReadCounts"])
+            return sampleCounts
+        return counts
+    counts = {}
+    file = open(path, 'r', newline='')
+    for row in csv.reader(file, delimiter=countTableReader.guessDelimiter(path)):
+        if len(row) < 2 or row[0].startswith("#"):
+            continue
+        try:
+            count = float(row[1])
+        except ValueError:
+            continue  # header line
+        counts[row[0]] = counts.get(row[0], 0) + count
+    file.close()
+    return counts
+
+
+def openWorkerConnections(args, standardReference: referenceHandler.StandardReference):
+    '''Makes the calculator and opens the score history.  Both can hold SQLite connections, so every process opens its own.  Returns the score memo, if any.'''
+    from . import MiqScoreCalculator, MemoizedMiqScoreCalculator
+    memo = None
+    if args.scoreMemo:
+        from . import scoreMemo
+        memo = scoreMemo.ScoreMemo(args.scoreMemoSize, args.scoreMemo)
+        _workerState["calculator"] = MemoizedMiqScoreCalculator(standardReference, args.analysisMethod, args.percentToleranceInStandard, args.floor, args.bootstrapReplicates, args.confidenceLevel, args.bootstrapSeed, memo)
+    else:
+        _workerState["calculator"] = MiqScoreCalculator(standardReference, args.analysisMethod, args.percentToleranceInStandard, args.floor, args.bootstrapReplicates, args.confidenceLevel, args.bootstrapSeed)
+    if args.history:
+        from . import scoreHistory
+        _workerState["history"] = scoreHistory.ScoreHistory(args.history)
+    return memo
+
+
+def prepareWorkerState(args):
+    '''
+    Loads the reference, calculator, matplotlib, template and examples into _workerState.  The run does this in the parent process
+    before any worker starts, so bad settings stop the run with their error, and forked workers inherit everything it loaded.
+    '''
+    from . import loadExampleData, loadReferenceCompositionFromExampleMiq, reportGeneration
+    _workerState.clear()
+    standardReference = referenceHandler.StandardReference(args.reference)
+    _workerState["args"] = args
+    _workerState["standardReference"] = standardReference
+    memo = openWorkerConnections(args, standardReference)
+    if args.profile:
+        instrumentation.enable()
+    if args.noPlots:
+        return
+    from . import plotting
+    if not plotting.plotEncoding.isNativeFormat(args.plotFormat) or args.rarefactionReplicates:
+        plotting.importPlottingModules()  # native plots are drawn without matplotlib, so it is only loaded when needed
+    if args.plotCache:
+        plotting.plotCache.setDefaultPlotCache(plotting.plotCache.PlotCache(args.plotCache, args.plotCacheSize * 1024 ** 2))
+    templateText = None
+    if args.template:
+        file = open(args.template, 'r')
+        templateText = file.read()
+        file.close()
+    if args.bundle:
+        _workerState["bundle"] = reportGeneration.ReportBundle(args.outputDirectory, templateText)  # also links the plots in each sample's JSON output
+    if args.template:
+        _workerState["template"] = reportGeneration.ReportTemplate(templateText)
+        _workerState["examples"] = loadExampleData(args.goodExample, args.badExample, standardReference, args.analysisMethod, memo=memo, plotFormat=args.plotFormat)
+        _workerState["exampleCompositions"] = loadReferenceCompositionFromExampleMiq(args.goodExample, args.badExample)
+
+
+def initializeWorker(args):
+    '''
+    Runs once in each worker process.  A forked worker already has the parent's prepared state and only opens its own connections.
+    Other workers prepare it themselves.  An error here is kept and reported for every sample instead of raised, because the pool
+    would otherwise keep replacing workers that fail the same way.
+    '''
+    import traceback
+    try:
+        if "args" in _workerState:
+            openWorkerConnections(args, _workerState["standardReference"])
+            _workerState["args"] = args
+        else:
+            prepareWorkerState(args)
+    except Exception:
+        _workerState["initializationError"] = "Worker could not be started:\n" + traceback.format_exc()
+
+
+def processSample(sample:tuple):
+    '''
+    Scores, plots and writes reports for one (sampleID, counts, outputName) from assignOutputNames.  Returns (sampleID, miqScore, error,
+    profile, readFateTable, outputName) so that one failure never stops the run.
+    The profile is the sample's instrumentation profile as a dictionary when profiling is on, otherwise None.
+    '''
+    import traceback
+    sampleID, counts, outputName = sample
+    if "initializationError" in _workerState:
+        return sampleID, None, _workerState["initializationError"], None, None, outputName
+    if outputName is None:
+        return sampleID, None, "Sample ID %s appears more than once in the input.  Only its first sample was scored." %sampleID, None, None, None
+    try:
+        miqScore, profile, readFateTable = scoreAndWriteSample(sampleID, counts, outputName)
+        return sampleID, miqScore, None, profile, readFateTable, outputName
+    except Exception:
+        return sampleID, None, traceback.format_exc(), None, None, outputName
+
+
+def scoreAndWriteSample(sampleID:str, counts:dict, outputName:str):
+    from . import reportGeneration
+    args = _workerState["args"]
+    miqResult = _workerState["calculator"].calculateMiq(counts, sampleID)
+    if args.rarefactionReplicates:
+        miqResult.rarefactionCurve = _workerState["calculator"].calculateRarefactionCurve(counts, replicates=args.rarefactionReplicates, sampleID=sampleID)
+    if not args.noPlots:
+        if miqResult.rarefactionCurve is not None:
+            miqResult.makeRarefactionPlot(output="handle")
+        miqResult.makeReadFateChart(args.plotFormat, output="handle")
+        miqResult.makeRadarPlots(args.plotFormat, output="handle")
+        if "exampleCompositions" in _workerState:
+            goodComposition, badComposition = _workerState["exampleCompositions"]
+            miqResult.makeCompositionBarPlot(goodComposition, badComposition, output="handle", format=args.plotFormat)
+        else:
+            miqResult.makeCompositionBarPlot(output="handle", format=args.plotFormat)
+    outputBase = os.path.join(args.outputDirectory, outputName)
+    if "template" in _workerState:
+        goodExample, badExample = _workerState["examples"]
+        with instrumentation.activateProfile(miqResult.profile):
+            replacementTable = reportGeneration.makeReplacementTable(miqResult, goodExample, badExample, args.radarSorting)
+            if "bundle" in _workerState:
+                _workerState["bundle"].writeReport(os.path.basename(outputBase) + ".html", replacementTable)
+            else:
+                reportGeneration.writeReport(outputBase + ".html.tmp", _workerState["template"], replacementTable)
+                os.replace(outputBase + ".html.tmp", outputBase + ".html")
+    jsonPlots = None
+    if "bundle" in _workerState:
+        jsonPlots = _workerState["bundle"].linkPlots(miqResult.plots)  # the plots are stored once as assets, so the JSON only links them
+    file = open(outputBase + ".json.tmp", 'w')
+    miqResult.jsonOutput(file, includeProfile=args.profile, plots=jsonPlots)
+    file.close()
+    os.replace(outputBase + ".json.tmp", outputBase + ".json")
+    if args.binaryOutput:
+        file = open(outputBase + binaryResult.fileExtension + ".tmp", 'wb')
+        miqResult.binaryOutput(file)
+        file.close()
+        os.replace(outputBase + binaryResult.fileExtension + ".tmp", outputBase + binaryResult.fileExtension)
+    if "history" in _workerState:
+        _workerState["history"].addResult(miqResult, args.historyRunID, storePlots=args.historyPlots)
+    if miqResult.profile is None:
+        return miqResult.miqScore, None, miqResult.readFateTable
+    return miqResult.miqScore, miqResult.profile.toDict(), miqResult.readFateTable
+
+
+def makeSafeFileName(sampleID:str):
+    return "".join(character if character.isalnum() or character in "-_." else "_" for character in str(sampleID))
+
+
+def assignOutputNames(samples, reservedNames:[list, tuple]=("summary", "metrics", "index")):
+    '''
+    Yields (sampleID, counts, outputName) for each (sampleID, counts), giving every sample its own output file name before it is
+    submitted.  When makeSafeFileName gives a name already taken, ignoring case for case-insensitive file systems (such as "a/b"
+    after "a_b", or a sample called "summary"), a numeric suffix is added ("a_b_2").  A sample ID that was already seen gets None
+    and processSample fails it, instead of letting it overwrite the first sample's files.
+    '''
+    usedNames = {name.lower() for name in reservedNames}
+    seenSampleIDs = set()
+    for sampleID, counts in samples:
+        if sampleID in seenSampleIDs:
+            yield sampleID, counts, None
+            continue
+        seenSampleIDs.add(sampleID)
+        baseName = makeSafeFileName(sampleID) or "sample"
+        outputName = baseName
+        suffix = 1
+        while outputName.lower() in usedNames:
+            suffix += 1
+            outputName = "%s_%s" %(baseName, suffix)
+        usedNames.add(outputName.lower())
+        yield sampleID, counts, outputName
+
+
+def writeTextFile(path:str, text:str):
+    temporaryPath = path + ".tmp"
+    file = open(temporaryPath, 'w')
+    file.write(text)
+    file.close()
+    os.replace(temporaryPath, path)
+
+
+def showProgress(completed:int, failed:int, total:int=None):
+    if total:
+        message = "\rProcessed %s/%s samples (%s failed)" %(completed, total, failed)
+    else:
+        message = "\rProcessed %s samples (%s failed)" %(completed, failed)
+    sys.stderr.write(message)
+    sys.stderr.flush()
+
+
+def runSamples(args, runMetrics: instrumentation.RunMetrics=None, reportBundle=None):
+    '''
+    Runs every sample through a process pool and returns a dictionary of sampleID:{"miqScore", "error"}.
+    Sample profiles sent back by the workers are added to runMetrics if it is given, and samples to the index of reportBundle.
+    '''
+    import multiprocessing
+    os.makedirs(args.outputDirectory, exist_ok=True)
+    if not _workerState.get("args") is args:
+        prepareWorkerState(args)
+    standardReference = referenceHandler.StandardReference(args.reference)
+    samples = assignOutputNames(iterateSamples(args.counts, standardReference, args.longTable, args.nonreferenceFates))
+    total = None
+    if countArchive.isCountArchive(args.counts):
+        total = len(countArchive.CountArchive(args.counts))
+    elif os.path.isdir(args.counts):
+        total = len([fileName for fileName in os.listdir(args.counts) if os.path.isfile(os.path.join(args.counts, fileName)) and not fileName.startswith(".")])
+    results = {}
+    completed = 0
+    failed = 0
+    if args.workers and args.workers > 1:
+        pool = multiprocessing.Pool(args.workers, initializer=initializeWorker, initargs=(args,))
+        sampleResults = pool.imap_unordered(processSample, samples)
+    else:
+        pool = None
+        sampleResults = map(processSample, samples)
+    try:
+        for sampleID, miqScore, error, profile, readFateTable, outputName in sampleResults:
+            if error or not sampleID in results:  # a repeated sample ID keeps its error whichever copy finishes first
+                results[sampleID] = {"miqScore": miqScore, "error": error}
+            completed += 1
+            if reportBundle is not None:
+                reportFileName = outputName + ".html" if args.template and not error else None
+                reportBundle.addSample(sampleID, miqScore, readFateTable, reportFileName, error)
+            if runMetrics is not None and profile is not None:
+                runMetrics.addProfile(profile)
+            if error:
+                failed += 1
+            if not args.quiet:
+                showProgress(completed, failed, total)
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+    if not args.quiet:
+        sys.stderr.write("\n")
+    return results
+
+
+def main(argv:list=None):
+    import json
+    args = parseArgs(argv)
+    os.makedirs(args.outputDirectory, exist_ok=True)
+    try:
+        prepareWorkerState(args)
+    except Exception as error:
+        sys.stderr.write("Unable to start the run: %s: %s\n" %(type(error).__name__, error))
+        return 1
+    runMetrics = None
+    if args.profile:
+        runMetrics = instrumentation.RunMetrics()
+    if args.history:
+        from . import scoreHistory
+        history = scoreHistory.ScoreHistory(args.history)
+        args.historyRunID = history.startRun(args.runName or os.path.basename(os.path.normpath(args.counts)), args.instrument, metadata={"analysisMethod": args.analysisMethod, "counts": os.path.abspath(args.counts)})
+        history.close()
+    reportBundle = None
+    if args.bundle:
+        from . import reportGeneration
+        reportBundle = reportGeneration.ReportBundle(args.outputDirectory)
+    results = runSamples(args, runMetrics, reportBundle)
+    writeTextFile(os.path.join(args.outputDirectory, "summary.json"), json.dumps(results, indent=4))
+    if reportBundle is not None:
+        reportBundle.samples.sort(key=lambda sample: str(sample["sampleID"]))  # workers finish in any order
+        reportBundle.writeIndex("MIQ Run Summary: %s" %os.path.basename(os.path.normpath(args.counts)))
+    if runMetrics is not None:
+        writeTextFile(os.path.join(args.outputDirectory, "metrics.json"), json.dumps(runMetrics.toDict(), indent=4))
+        if not args.quiet:
+            sys.stderr.write(runMetrics.formatTable() + "\n")
+    failures = [sampleID for sampleID in results if results[sampleID]["error"]]
+    for sampleID in failures:
+        sys.stderr.write("Sample %s failed:\n%s\n" %(sampleID, results[sampleID]["error"]))
+    if failures:
+        return 1
+    return 0
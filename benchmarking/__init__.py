@@ -0,0 +1,6 @@
+from . import syntheticData
+from . import benchmarkSuite
+
+
+__all__ = ["syntheticData",
+           "benchmarkSuite"]
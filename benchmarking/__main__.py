@@ -0,0 +1,4 @@
+import sys
+from .benchmarkSuite import main
+
+sys.exit(main())
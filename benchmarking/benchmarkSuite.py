@@ -0,0 +1,607 @@
+import sys
+import time
+from .. import referenceHandler
+from .. import instrumentation
+from . import syntheticData
+
+benchmarkVersion = 1
+defaultSampleCounts = (1, 100, 10000)
+importTimeBudgetSeconds = 0.5  # importing the package for scoring must stay well under matplotlib's own start up time
+
+
+def measure(function, repeats:int=1, measureMemory:bool=True, stageMetrics: instrumentation.RunMetrics=None):
+    '''
+    Returns (best wall time in seconds, peak traced memory in bytes) for calling function.  Memory is measured in a separate
+    run with tracemalloc so that tracing does not slow down the timed runs.  Memory allocated outside of Python's allocators
+    (such as matplotlib's Agg buffers) is not seen by tracemalloc.  If stageMetrics is given, instrumentation is turned on
+    for the first timed run and its stages are collected there.
+    '''
+    timings = []
+    for repeat in range(max(repeats, 1)):
+        if repeat == 0 and stageMetrics is not None:
+            instrumentation.enable(stageMetrics)
+        start = time.perf_counter()
+        try:
+            function()
+        finally:
+            instrumentation.disable()
+        timings.append(time.perf_counter() - start)
+    peakBytes = None
+    if measureMemory:
+        import tracemalloc
+        tracemalloc.start()
+        try:
+            function()
+            peakBytes = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    return min(timings), peakBytes
+
+
+class BenchmarkSuite(object):
+    '''
+    Times the main paths of the package (scoring, alias conversion, each plot and report rendering) on synthetic samples
+    made from a standard reference.  Every benchmark runs at each of the requested sample counts and reports its total time,
+    throughput, peak memory and a breakdown of time by stage.  Plots are slow enough that they are only run up to maxPlotSamples.
+    '''
+
+    benchmarkNames = ("calculateMiq",
+                      "bootstrapMiqBatch",
+                      "multiTargetScore",
+                      "countArchiveScore",
+                      "convertKeysToStandardIdentifiers",
+                      "readFateChart",
+                      "radarPlots",
+                      "stackedBar",
+                      "runCompositionPlot",
+                      "nativeSvgPlots",
+                      "generateReport")
+    plotBenchmarks = ("readFateChart", "radarPlots", "stackedBar", "runCompositionPlot")
+
+    def __init__(self, standardReference: referenceHandler.StandardReference=None, analysisMethod:str="Genomic", seed:int=0, repeats:int=1, measureMemory:bool=True, maxPlotSamples:int=100, aliasSamplePoolSize:int=50, progressStream=None):
+        if standardReference is None:
+            standardReference = referenceHandler.StandardReference(syntheticData.defaultReferencePath)
+        self.standardReference = standardReference
+        self.analysisMethod = analysisMethod
+        self.seed = seed
+        self.repeats = repeats
+        self.measureMemory = measureMemory
+        self.maxPlotSamples = maxPlotSamples
+        self.aliasSamplePoolSize = aliasSamplePoolSize
+        self.progressStream = progressStream
+
+    def makeGenerator(self):
+        '''Each benchmark gets a fresh generator so results do not depend on which benchmarks ran before it'''
+        return syntheticData.SyntheticCountGenerator(self.standardReference, self.analysisMethod, self.seed)
+
+    def makeCalculator(self, percentToleranceInStandard:[int, float]=15):
+        from .. import MiqScoreCalculator
+        return MiqScoreCalculator(self.standardReference, self.analysisMethod, percentToleranceInStandard)
+
+    def run(self, sampleCounts:[list, tuple]=defaultSampleCounts, benchmarkNames:[list, tuple]=None):
+        results = {"benchmarkVersion": benchmarkVersion,
+                   "environment": describeEnvironment(),
+                   "settings": {"analysisMethod": self.analysisMethod,
+                                "seed": self.seed,
+                                "repeats": self.repeats,
+                                "maxPlotSamples": self.maxPlotSamples,
+                                "sampleCounts": list(sampleCounts)},
+                   "benchmarks": {}}
+        for benchmarkName in benchmarkNames or self.benchmarkNames:
+            if not benchmarkName in self.benchmarkNames:
+                raise ValueError("Unknown benchmark %s. Valid benchmarks: %s" %(benchmarkName, self.benchmarkNames))
+            benchmarkFunction = getattr(self, "benchmark" + benchmarkName[0].upper() + benchmarkName[1:])
+            results["benchmarks"][benchmarkName] = {}
+            for sampleCount in sampleCounts:
+                if self.progressStream:
+                    self.progressStream.write("Running %s with %s samples\n" %(benchmarkName, sampleCount))
+                    self.progressStream.flush()
+                if benchmarkName in self.plotBenchmarks and sampleCount > self.maxPlotSamples:
+                    result = {"skipped": "More than maxPlotSamples (%s)" %self.maxPlotSamples}
+                else:
+                    result = benchmarkFunction(sampleCount)
+                results["benchmarks"][benchmarkName][str(sampleCount)] = result
+        return results
+
+    def makeResult(self, sampleCount:int, seconds:float, peakBytes:int, stages:dict):
+        return {"sampleCount": sampleCount,
+                "seconds": seconds,
+                "samplesPerSecond": sampleCount / seconds if seconds else None,
+                "peakBytes": peakBytes,
+                "stages": stages}
+
+    def benchmarkCalculateMiq(self, sampleCount:int):
+        calculator = self.makeCalculator()
+        samples = self.makeGenerator().makeSamples(sampleCount)
+        sampleIDs = self.makeGenerator().makeSampleIDs(sampleCount)
+        scoreSamples = lambda: [calculator.calculateMiq(sample, sampleID) for sample, sampleID in zip(samples, sampleIDs)]
+        seconds, peakBytes = measure(scoreSamples, self.repeats, self.measureMemory)
+        stages = profileCalculateMiqStages(calculator, samples, seconds)
+        return self.makeResult(sampleCount, seconds, peakBytes, stages)
+
+    def benchmarkBootstrapMiqBatch(self, sampleCount:int, replicates:int=2000):
+        '''Bootstrap confidence intervals with 2000 replicates per sample for a batch of samples, chunked like bootstrapMiqBatch does by default'''
+        calculator = self.makeCalculator()
+        calculator.bootstrapSeed = self.seed
+        generator = self.makeGenerator()
+        miqScoreBatch = calculator.calculateMiqBatch(generator.makeSamples(sampleCount), sampleIDs=generator.makeSampleIDs(sampleCount))
+        bootstrapSamples = lambda: calculator.bootstrapMiqBatch(miqScoreBatch, replicates)
+        seconds, peakBytes = measure(bootstrapSamples, self.repeats, self.measureMemory)
+        result = self.makeResult(sampleCount, seconds, peakBytes, {"bootstrapMiqBatch": seconds})
+        result["replicates"] = replicates
+        return result
+
+    def benchmarkMultiTargetScore(self, sampleCount:int):
+        '''Every analysis method of the reference scored in one pass over the samples'''
+        from .. import multiTargetScoring
+        scorer = multiTargetScoring.MultiTargetScorer(self.standardReference)
+        generator = self.makeGenerator()
+        samples = generator.makeSamples(sampleCount)
+        sampleIDs = generator.makeSampleIDs(sampleCount)
+        scoreSamples = lambda: scorer.score(samples, sampleIDs=sampleIDs)
+        seconds, peakBytes = measure(scoreSamples, self.repeats, self.measureMemory)
+        result = self.makeResult(sampleCount, seconds, peakBytes, {"multiTargetScorer.score": seconds})
+        result["targets"] = len(scorer)
+        return result
+
+    def benchmarkCountArchiveScore(self, sampleCount:int):
+        '''Samples written to a count archive in a temporary directory and scored back from its memory maps a chunk at a time'''
+        import shutil
+        import tempfile
+        from .. import countArchive
+        calculator = self.makeCalculator()
+        generator = self.makeGenerator()
+        archiveDirectory = tempfile.mkdtemp(prefix="miqCountArchive")
+        try:
+            writeStart = time.perf_counter()
+            with countArchive.CountArchiveWriter(archiveDirectory, self.standardReference) as writer:
+                for sampleID, sample in zip(generator.makeSampleIDs(sampleCount), generator.makeSamples(sampleCount)):
+                    writer.addSample(sampleID, sample)
+            writeSeconds = time.perf_counter() - writeStart
+            archive = countArchive.CountArchive(archiveDirectory)
+            scoreSamples = lambda: countArchive.ArchiveScorer(calculator, archive).scoreAll()
+            stageMetrics = instrumentation.RunMetrics()
+            seconds, peakBytes = measure(scoreSamples, self.repeats, self.measureMemory, stageMetrics)
+            archive.close()
+        finally:
+            shutil.rmtree(archiveDirectory, ignore_errors=True)
+        result = self.makeResult(sampleCount, seconds, peakBytes, getStageSeconds(stageMetrics))
+        result["writeSeconds"] = writeSeconds
+        return result
+
+    def benchmarkConvertKeysToStandardIdentifiers(self, sampleCount:int):
+        '''Large raw classifier style inputs with every alias and thousands of unmapped features.  A pool of samples is reused to keep memory down.'''
+        generator = self.makeGenerator()
+        pool = [generator.makeAliasHeavySample() for sample in range(min(sampleCount, self.aliasSamplePoolSize))]
+        samples = [pool[index % len(pool)] for index in range(sampleCount)]
+        def convertSamples():
+            for sample in samples:
+                referenceHandler.convertKeysToStandardIdentifiers(sample, self.standardReference)
+        seconds, peakBytes = measure(convertSamples, self.repeats, self.measureMemory)
+        result = self.makeResult(sampleCount, seconds, peakBytes, {"convertKeysToStandardIdentifiers": seconds})
+        result["keysPerSample"] = sum(len(sample) for sample in pool) / len(pool)
+        return result
+
+    def makeScoredSamples(self, sampleCount:int):
+        calculator = self.makeCalculator()
+        generator = self.makeGenerator()
+        return [calculator.calculateMiq(sample, sampleID) for sample, sampleID in zip(generator.makeSamples(sampleCount), generator.makeSampleIDs(sampleCount))]
+
+    def benchmarkReadFateChart(self, sampleCount:int):
+        from .. import plotting
+        miqResults = self.makeScoredSamples(sampleCount)
+        def makePlots():
+            for miqResult in miqResults:
+                plotting.readFateChart.makeReadFateChart(miqResult.readFateTable, miqResult.sampleID, explodeCell="Aligned To Reference")
+        stageMetrics = instrumentation.RunMetrics()
+        seconds, peakBytes = measure(makePlots, self.repeats, self.measureMemory, stageMetrics)
+        return self.makeResult(sampleCount, seconds, peakBytes, getStageSeconds(stageMetrics))
+
+    def benchmarkRadarPlots(self, sampleCount:int):
+        '''Times both the full radar plot and the template based single sample radar plot for every sorting method'''
+        from .. import plotting
+        miqResults = self.makeScoredSamples(sampleCount)
+        sortings = self.standardReference.sortings
+        printNames = self.standardReference.printNames
+        def makeRadarPlots():
+            for miqResult in miqResults:
+                for sortingMethod in sortings:
+                    orderType, orderedList = sortings[sortingMethod]
+                    plotting.radarMaker.makeRadarPlot({miqResult.sampleID: miqResult.samplePercentagesOfExpected}, orderedList, sortingMethod, topHigh=orderType == "descending", printNames=printNames)
+        def makeSingleSampleRadarPlots():
+            for miqResult in miqResults:
+                for sortingMethod in sortings:
+                    orderType, orderedList = sortings[sortingMethod]
+                    plotting.radarMaker.makeSingleSampleRadarPlot(miqResult.sampleID, miqResult.samplePercentagesOfExpected, orderedList, sortingMethod, topHigh=orderType == "descending", printNames=printNames)
+        stageMetrics = instrumentation.RunMetrics()
+        radarSeconds, radarPeakBytes = measure(makeRadarPlots, self.repeats, self.measureMemory, stageMetrics)
+        singleStageMetrics = instrumentation.RunMetrics()
+        singleSeconds, singlePeakBytes = measure(makeSingleSampleRadarPlots, self.repeats, self.measureMemory, singleStageMetrics)
+        peakBytes = None
+        if self.measureMemory:
+            peakBytes = max(radarPeakBytes, singlePeakBytes)
+        stages = getStageSeconds(stageMetrics, "makeRadarPlot/")
+        stages.update(getStageSeconds(singleStageMetrics, "makeSingleSampleRadarPlot/"))
+        return self.makeResult(sampleCount, radarSeconds + singleSeconds, peakBytes, stages)
+
+    def benchmarkStackedBar(self, sampleCount:int):
+        from .. import plotting
+        from .. import absoluteReadCountDictOperations
+        miqResults = self.makeScoredSamples(sampleCount)
+        valueOrder = self.standardReference.sortings["Lysis Difficulty"][1]
+        expectedValues = self.standardReference.expectedValues[self.analysisMethod]
+        theoretical = {readSource: expectedValues[readSource] for readSource in expectedValues if expectedValues[readSource]}
+        plotData = [{"Theoretical": theoretical, miqResult.sampleID: absoluteReadCountDictOperations.convertDictToPercentages(miqResult.referenceReadCounts)} for miqResult in miqResults]
+        def makePlots():
+            for data, miqResult in zip(plotData, miqResults):
+                plotting.stackedBars.makeStackedBar(data, valueOrder, ("Theoretical", miqResult.sampleID), "%s Composition" %miqResult.sampleID, printNameTable=self.standardReference.printNames)
+        stageMetrics = instrumentation.RunMetrics()
+        seconds, peakBytes = measure(makePlots, self.repeats, self.measureMemory, stageMetrics)
+        return self.makeResult(sampleCount, seconds, peakBytes, getStageSeconds(stageMetrics))
+
+    def benchmarkRunCompositionPlot(self, sampleCount:int):
+        '''One run-level composition plot (paged at 96 samples) for the whole batch rather than a plot per sample'''
+        calculator = self.makeCalculator()
+        generator = self.makeGenerator()
+        miqScoreBatch = calculator.calculateMiqBatch(generator.makeSamples(sampleCount), sampleIDs=generator.makeSampleIDs(sampleCount))
+        makePlots = lambda: miqScoreBatch.makeRunCompositionPlots(output="bytes")
+        stageMetrics = instrumentation.RunMetrics()
+        seconds, peakBytes = measure(makePlots, self.repeats, self.measureMemory, stageMetrics)
+        return self.makeResult(sampleCount, seconds, peakBytes, getStageSeconds(stageMetrics))
+
+    def benchmarkNativeSvgPlots(self, sampleCount:int):
+        '''Read fate chart, radar plots and composition bar plot of every sample drawn as native SVG (no matplotlib), so it runs at every sample count'''
+        miqResults = self.makeScoredSamples(sampleCount)
+        def makePlots():
+            for miqResult in miqResults:
+                miqResult.makeReadFateChart("nativesvg", forceRedraw=True, output="bytes")
+                miqResult.makeRadarPlots("nativesvg", forceRedraw=True, output="bytes")
+                miqResult.makeCompositionBarPlot(output="bytes", format="nativesvg")
+        stageMetrics = instrumentation.RunMetrics()
+        seconds, peakBytes = measure(makePlots, self.repeats, self.measureMemory, stageMetrics)
+        return self.makeResult(sampleCount, seconds, peakBytes, getStageSeconds(stageMetrics))
+
+    def benchmarkGenerateReport(self, sampleCount:int):
+        '''
+        Renders the example report template for every sample.  Plots are drawn once and shared by all samples so that
+        only report generation is timed.
+        '''
+        from .. import reportGeneration
+        template = syntheticData.loadReportTemplate()
+        calculator = self.makeCalculator()
+        generator = self.makeGenerator()
+        goodExample = calculator.calculateMiq(generator.makeSample(biasStrength=0.05), "Good")
+        badExample = calculator.calculateMiq(generator.makeSample(biasStrength=1.0), "Biased")
+        plotSource = calculator.calculateMiq(generator.makeSample(), "PlotSource")
+        for miqResult in (goodExample, badExample, plotSource):
+            miqResult.makeReadFateChart()
+            miqResult.makeRadarPlots()
+            miqResult.makeCompositionBarPlot()
+        miqResults = []
+        for sample, sampleID in zip(generator.makeSamples(sampleCount), generator.makeSampleIDs(sampleCount)):
+            miqResult = calculator.calculateMiq(sample, sampleID)
+            miqResult.plots = plotSource.plots
+            miqResults.append(miqResult)
+        replacementTables = []
+        def makeReplacementTables():
+            replacementTables[:] = [reportGeneration.makeReplacementTable(miqResult, goodExample, badExample) for miqResult in miqResults]
+        makeReplacementTables()
+        def makeReports():
+            for replacementTable in replacementTables:
+                reportGeneration.generateReport(template, replacementTable)  # reports are dropped as they are made, like a writer would
+        tableSeconds = measure(makeReplacementTables, self.repeats, False)[0]
+        seconds, peakBytes = measure(makeReports, self.repeats, self.measureMemory)
+        result = self.makeResult(sampleCount, seconds, peakBytes, {"makeReplacementTable": tableSeconds, "generateReport": seconds})
+        result["reportBytes"] = len(reportGeneration.generateReport(template, replacementTables[0]))
+        return result
+
+
+def profileCalculateMiqStages(calculator, samples:list, totalSeconds:float):
+    '''
+    Breaks calculateMiq time down by stage by running its component steps on the same samples.  Whatever is left of the total
+    (the error calculation, mean and building MiqScoreData) is reported as scoreAndResult.
+    '''
+    from .. import generalDictOperations, absoluteReadCountDictOperations, percentReadCountDictOperations
+    stages = {"convertKeysToStandardIdentifiers": 0.0,
+              "separateReferenceAndNonreferenceReads": 0.0,
+              "convertDictToPercentages": 0.0,
+              "calculateObservedPercentOfExpected": 0.0}
+    expectedValues = calculator.standardReference.expectedValues[calculator.analysisMethod]
+    for sample in samples:
+        start = time.perf_counter()
+        sampleData = referenceHandler.convertKeysToStandardIdentifiers(sample, calculator.standardReference)
+        converted = time.perf_counter()
+        referenceReads, nonreferenceReads = generalDictOperations.separateReferenceAndNonreferenceReads(sampleData, calculator.expectedReadSources)
+        separated = time.perf_counter()
+        samplePercentages = absoluteReadCountDictOperations.convertDictToPercentages(referenceReads)
+        percentages = time.perf_counter()
+        percentReadCountDictOperations.calculateObservedPercentOfExpected(samplePercentages, expectedValues)
+        finished = time.perf_counter()
+        stages["convertKeysToStandardIdentifiers"] += converted - start
+        stages["separateReferenceAndNonreferenceReads"] += separated - converted
+        stages["convertDictToPercentages"] += percentages - separated
+        stages["calculateObservedPercentOfExpected"] += finished - percentages
+    stages["scoreAndResult"] = max(totalSeconds - sum(stages.values()), 0.0)
+    return stages
+
+
+def getStageSeconds(stageMetrics: instrumentation.RunMetrics, prefix:str=""):
+    return {prefix + stageName: statistics.seconds for stageName, statistics in stageMetrics.stages.items()}
+
+
+def measurePackageImport(repeats:int=3):
+    '''
+    Imports the package in fresh interpreters and returns the best import time, whether any matplotlib module got loaded and
+    (where the resource module is available) the peak resident memory of the interpreter afterwards.
+    '''
+    import os
+    import json
+    import subprocess
+    packageName = __name__.split(".")[0]
+    packageParent = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    code = "\n".join(["import json, sys, time",
+                       "start = time.perf_counter()",
+                       "import %s" %packageName,
+                       "seconds = time.perf_counter() - start",
+                       "try:",
+                       "    import resource",
+                       "    maxRSSKilobytes = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss",
+                       "except ImportError:",
+                       "    maxRSSKilobytes = None",
+                       "matplotlibModules = [name for name in sys.modules if name == 'matplotlib' or name.startswith('matplotlib.')]",
+                       "print(json.dumps({'seconds': seconds, 'maxRSSKilobytes': maxRSSKilobytes, 'matplotlibModules': len(matplotlibModules)}))"])
+    environment = dict(os.environ)
+    environment["PYTHONPATH"] = os.pathsep.join([packageParent] + [path for path in [environment.get("PYTHONPATH")] if path])
+    runs = []
+    for repeat in range(max(repeats, 1)):
+        output = subprocess.run([sys.executable, "-c", code], env=environment, stdout=subprocess.PIPE, check=True).stdout
+        runs.append(json.loads(output.decode().strip().splitlines()[-1]))
+    best = min(runs, key=lambda run: run["seconds"])
+    return {"seconds": best["seconds"],
+            "maxRSSKilobytes": best["maxRSSKilobytes"],
+            "matplotlibLoaded": any(run["matplotlibModules"] for run in runs)}
+
+
+def checkImportBudget(importResult:dict, budgetSeconds:float=importTimeBudgetSeconds):
+    '''Returns a list of problems with a measurePackageImport result (empty if the import is within budget)'''
+    problems = []
+    if importResult["matplotlibLoaded"]:
+        problems.append("Importing the package loaded matplotlib. Plotting modules must only be imported when a plot is made.")
+    if importResult["seconds"] > budgetSeconds:
+        problems.append("Importing the package took %.3fs, over the %.3fs budget" %(importResult["seconds"], budgetSeconds))
+    return problems
+
+
+def checkScoreConsistency(standardReference: referenceHandler.StandardReference, analysisMethod:str="Genomic", sampleCount:int=500, seed:int=0):
+    '''
+    Scores samples with fractional counts through calculateMiq and through each batch path (calculateMiqBatch on dictionaries and
+    on a count matrix, MultiTargetScorer and ArchiveScorer) and returns a list of problems (empty if every raw score is identical)
+    '''
+    import shutil
+    import tempfile
+    from .. import MiqScoreCalculator
+    from .. import multiTargetScoring
+    from .. import countArchive
+    generator = syntheticData.SyntheticCountGenerator(standardReference, analysisMethod, seed)
+    samples = [generator.makeFractionalSample() for sample in range(sampleCount)]
+    readSources = sorted({readSource for sample in samples for readSource in sample})
+    matrixSamples = [{readSource: sample.get(readSource, 0) for readSource in readSources} for sample in samples]
+    countMatrix = [list(sample.values()) for sample in matrixSamples]
+    problems = []
+    for percentToleranceInStandard, floor in ((0, 0), (15, None)):
+        calculator = MiqScoreCalculator(standardReference, analysisMethod, percentToleranceInStandard, floor)
+        expectedScores = [calculator.calculateMiq(sample).rawMiqScore for sample in samples]
+        expectedMatrixScores = [calculator.calculateMiq(sample).rawMiqScore for sample in matrixSamples]
+        multiTargetScorer = multiTargetScoring.MultiTargetScorer(standardReference, [analysisMethod], percentToleranceInStandard, floor)
+        archiveDirectory = tempfile.mkdtemp(prefix="miqCountArchive")
+        try:
+            with countArchive.CountArchiveWriter(archiveDirectory, standardReference) as writer:
+                for index, sample in enumerate(samples):
+                    writer.addSample("Sample%s" %index, sample)
+            archive = countArchive.CountArchive(archiveDirectory)
+            expectedArchiveScores = [calculator.calculateMiq(archive.getSampleData(index)).rawMiqScore for index in range(len(archive))]
+            archiveScores = countArchive.ArchiveScorer(calculator, archive).scoreAll()[1].tolist()
+            archive.close()
+        finally:
+            shutil.rmtree(archiveDirectory, ignore_errors=True)
+        pathScores = [("calculateMiqBatch", calculator.calculateMiqBatch(samples).rawMiqScores.tolist(), expectedScores),
+                      ("calculateMiqBatch (count matrix)", calculator.calculateMiqBatch(countMatrix, readSources).rawMiqScores.tolist(), expectedMatrixScores),
+                      ("MultiTargetScorer", multiTargetScorer.score(samples).rawMiqScores[:, 0].tolist(), expectedScores),
+                      ("ArchiveScorer", archiveScores, expectedArchiveScores)]
+        for pathName, scores, expected in pathScores:
+            mismatches = sum(1 for score, expectedScore in zip(scores, expected) if not score == expectedScore)
+            if mismatches:
+                problems.append("%s gave a different raw MiQ score from calculateMiq for %s of %s samples with fractional counts (tolerance %s)" %(pathName, mismatches, sampleCount, percentToleranceInStandard))
+    return problems
+
+
+def checkAccumulatorMerge(standardReference: referenceHandler.StandardReference, analysisMethod:str="Genomic", sampleCount:int=20, shards:int=4, seed:int=0):
+    '''
+    Accumulates each sample's reads in shards, pickles and unpickles every shard's accumulator as if it came back from another
+    process, merges them and returns a list of problems (empty if every merged score matches calculateMiq on the whole sample)
+    '''
+    import pickle
+    from .. import MiqScoreCalculator
+    generator = syntheticData.SyntheticCountGenerator(standardReference, analysisMethod, seed)
+    # made from raw data, so an unpickled accumulator gets its own copy of the compiled reference, as it would in another process
+    calculator = MiqScoreCalculator(referenceHandler.makeStandardReference(standardReference.makeRawData()), analysisMethod, 15)
+    problems = []
+    mismatches = 0
+    for sample in generator.makeSamples(sampleCount):
+        merged = calculator.makeAccumulator()
+        for shard in range(shards):
+            accumulator = calculator.makeAccumulator()
+            accumulator.update({readSource: count // shards + (1 if shard < count % shards else 0) for readSource, count in sample.items()})
+            try:
+                merged.merge(pickle.loads(pickle.dumps(accumulator)))
+            except Exception as error:
+                return ["Merging a pickled MiqScoreAccumulator failed: %s: %s" %(type(error).__name__, error)]
+        if not merged.rawScore() == calculator.calculateMiq(sample).rawMiqScore:
+            mismatches += 1
+    if mismatches:
+        problems.append("Merged pickled accumulators gave a different raw MiQ score from calculateMiq for %s of %s samples" %(mismatches, sampleCount))
+    return problems
+
+
+def describeEnvironment():
+    import os
+    import platform
+    import numpy
+    environment = {"python": platform.python_version(),
+                   "implementation": platform.python_implementation(),
+                   "platform": platform.platform(),
+                   "processor": platform.processor(),
+                   "cpuCount": os.cpu_count(),
+                   "numpy": numpy.__version__}
+    try:
+        import matplotlib
+        environment["matplotlib"] = matplotlib.__version__
+    except ImportError:
+        environment["matplotlib"] = None
+    return environment
+
+
+def saveResults(results:dict, path:str):
+    import json
+    file = open(path, 'w')
+    json.dump(results, file, indent=4)
+    file.close()
+
+
+def loadResults(path:str):
+    import os
+    import json
+    if not os.path.isfile(path):
+        raise FileNotFoundError("Unable to find benchmark baseline at %s" %path)
+    file = open(path, 'r')
+    results = json.load(file)
+    file.close()
+    return results
+
+
+def compareToBaseline(results:dict, baseline:dict, tolerance:float=0.25, minimumSeconds:float=0.005):
+    '''
+    Compares time and peak memory for every benchmark and sample count found in both results.  A measurement is a regression if it
+    grew by more than tolerance (0.25 is 25%) and, for times, by more than minimumSeconds so that very short runs do not flag on noise.
+    Returns a list of comparison dictionaries.
+    '''
+    comparisons = []
+    for benchmarkName, sampleCountResults in results["benchmarks"].items():
+        baselineResults = baseline.get("benchmarks", {}).get(benchmarkName, {})
+        for sampleCount, result in sampleCountResults.items():
+            baselineResult = baselineResults.get(sampleCount)
+            if not baselineResult or "skipped" in result or "skipped" in baselineResult:
+                continue
+            for metric in ("seconds", "peakBytes"):
+                current = result.get(metric)
+                previous = baselineResult.get(metric)
+                if current is None or not previous:
+                    continue
+                ratio = current / previous
+                regression = ratio > 1 + tolerance
+                if metric == "seconds" and current - previous <= minimumSeconds:
+                    regression = False
+                comparisons.append({"benchmark": benchmarkName,
+                                    "sampleCount": int(sampleCount),
+                                    "metric": metric,
+                                    "baseline": previous,
+                                    "current": current,
+                                    "ratio": ratio,
+                                    "regression": regression})
+    return comparisons
+
+
+def formatBytes(byteCount:int):
+    if byteCount is None:
+        return "-"
+    for unit in ("B", "KB", "MB"):
+        if byteCount < 1024:
+            return "%.1f%s" %(byteCount, unit)
+        byteCount /= 1024
+    return "%.1fGB" %byteCount
+
+
+def formatResults(results:dict):
+    lines = ["%-40s %9s %11s %13s %10s" %("Benchmark", "Samples", "Seconds", "Samples/sec", "Peak mem")]
+    if results.get("packageImport"):
+        importResult = results["packageImport"]
+        peakMemory = None
+        if importResult["maxRSSKilobytes"]:
+            peakMemory = importResult["maxRSSKilobytes"] * 1024
+        lines.append("%-40s %9s %11.4f %13s %10s" %("packageImport", "", importResult["seconds"], "", formatBytes(peakMemory)))
+    for benchmarkName, sampleCountResults in results["benchmarks"].items():
+        for sampleCount, result in sampleCountResults.items():
+            if "skipped" in result:
+                lines.append("%-40s %9s %s" %(benchmarkName, sampleCount, "skipped: " + result["skipped"]))
+                continue
+            lines.append("%-40s %9s %11.4f %13.1f %10s" %(benchmarkName, sampleCount, result["seconds"], result["samplesPerSecond"] or 0, formatBytes(result["peakBytes"])))
+            for stage, seconds in result["stages"].items():
+                lines.append("    %-46s %11.4f" %(stage, seconds))
+    return "\n".join(lines)
+
+
+def formatComparison(comparisons:list):
+    lines = []
+    for comparison in comparisons:
+        if comparison["metric"] == "seconds":
+            values = "%.4fs -> %.4fs" %(comparison["baseline"], comparison["current"])
+        else:
+            values = "%s -> %s" %(formatBytes(comparison["baseline"]), formatBytes(comparison["current"]))
+        flag = "REGRESSION" if comparison["regression"] else ""
+        lines.append("%-40s %9s %-10s %-28s %6.2fx %s" %(comparison["benchmark"], comparison["sampleCount"], comparison["metric"], values, comparison["ratio"], flag))
+    return "\n".join(lines)
+
+
+def parseArgs(argv:list=None):
+    import argparse
+    parser = argparse.ArgumentParser(prog="python -m miqScoreNGSReadCountPublic.benchmarking", description="Benchmark scoring, reference handling, plotting and report rendering on synthetic samples")
+    parser.add_argument("-s", "--sampleCounts", type=int, nargs="+", default=list(defaultSampleCounts), help="Numbers of samples to run each benchmark with")
+    parser.add_argument("-b", "--benchmarks", nargs="+", choices=BenchmarkSuite.benchmarkNames, help="Only run these benchmarks")
+    parser.add_argument("-m", "--analysisMethod", default="Genomic", help="Analysis method used for the synthetic samples")
+    parser.add_argument("-r", "--reference", default=syntheticData.defaultReferencePath, help="Standard reference JSON")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed for the synthetic samples")
+    parser.add_argument("--repeats", type=int, default=1, help="Timed runs per measurement (the best is kept)")
+    parser.add_argument("--maxPlotSamples", type=int, default=100, help="Largest sample count to run the plotting benchmarks with")
+    parser.add_argument("--noMemory", action="store_true", help="Skip the tracemalloc peak memory runs")
+    parser.add_argument("-o", "--output", help="Write results as JSON to this path (use it as a baseline for later runs)")
+    parser.add_argument("--baseline", help="Results JSON from an earlier run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="Allowed slowdown or memory growth over the baseline before it counts as a regression")
+    parser.add_argument("--importBudget", type=float, default=importTimeBudgetSeconds, help="Maximum seconds for importing the package (without matplotlib)")
+    parser.add_argument("--importCheckOnly", action="store_true", help="Only check the package import time and that it does not load matplotlib")
+    parser.add_argument("--quiet", action="store_true", help="Do not show progress")
+    return parser.parse_args(argv)
+
+
+def main(argv:list=None):
+    '''Runs the benchmarks.  Returns 1 if the package import is over budget, a batch scoring path disagrees with calculateMiq or anything regressed against the baseline.'''
+    from .. import plotting
+    args = parseArgs(argv)
+    importResult = measurePackageImport(max(args.repeats, 3))
+    importProblems = checkImportBudget(importResult, args.importBudget)
+    consistencyProblems = []
+    if args.importCheckOnly:
+        results = {"benchmarkVersion": benchmarkVersion, "environment": describeEnvironment(), "benchmarks": {}}
+    else:
+        standardReference = referenceHandler.StandardReference(args.reference)
+        consistencyProblems = checkScoreConsistency(standardReference, args.analysisMethod, seed=args.seed) + checkAccumulatorMerge(standardReference, args.analysisMethod, seed=args.seed)
+        plotting.useHeadlessBackend()
+        progressStream = None if args.quiet else sys.stderr
+        suite = BenchmarkSuite(referenceHandler.StandardReference(args.reference), args.analysisMethod, args.seed, args.repeats, not args.noMemory, args.maxPlotSamples, progressStream=progressStream)
+        results = suite.run(args.sampleCounts, args.benchmarks)
+    results["packageImport"] = importResult
+    print(formatResults(results))
+    if args.output:
+        saveResults(results, args.output)
+    failed = False
+    for problem in importProblems + consistencyProblems:
+        print(problem)
+        failed = True
+    if args.baseline:
+        comparisons = compareToBaseline(results, loadResults(args.baseline), args.tolerance)
+        print()
+        print(formatComparison(comparisons))
+        if any(comparison["regression"] for comparison in comparisons):
+            failed = True
+    if failed:
+        return 1
+    return 0
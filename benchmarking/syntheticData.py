@@ -0,0 +1,88 @@
+import os
+import numpy as np
+from .. import referenceHandler
+
+defaultReferencePath = os.path.join(os.path.split(referenceHandler.__file__)[0], "zrCommunityStandard.json")
+defaultTemplatePath = os.path.join(os.path.split(os.path.split(__file__)[0])[0], "reportTemplateExample.html")
+nonreferenceFates = ("Unassigned", "Chimeric", "Low Quality", "Unaligned", "Off Target")
+
+
+class SyntheticCountGenerator(object):
+    '''
+    Makes reproducible synthetic read count dictionaries for a standard reference.  Reads are drawn from a multinomial around the
+    expected composition of the analysis method, with a per-sample log-normal bias so that scores spread out like real controls.
+    '''
+
+    def __init__(self, standardReference: referenceHandler.StandardReference, analysisMethod:str, seed:int=0):
+        if not analysisMethod in standardReference.analysisMethods:
+            raise ValueError("Analysis method %s not found in analysis methods for the chosen standard. Valid methods: %s" %(analysisMethod, standardReference.analysisMethods))
+        self.standardReference = standardReference
+        self.analysisMethod = analysisMethod
+        self.random = np.random.default_rng(seed)
+        self.readSources = standardReference.compiledReference.expectedReadSources(analysisMethod)
+        expectedValues = standardReference.expectedValues[analysisMethod]
+        expectedPercentages = np.array([expectedValues[readSource] for readSource in self.readSources], dtype=np.float64)
+        self.expectedFractions = expectedPercentages / expectedPercentages.sum()
+        self.aliases = {readSource: [] for readSource in self.readSources}
+        for alias, readSource in standardReference.compiledReference.aliasLookup.items():
+            if readSource in self.aliases and not alias == readSource:
+                self.aliases[readSource].append(alias)
+
+    def makeSample(self, totalReads:int=100000, biasStrength:float=0.3, nonreferenceFraction:float=0.05):
+        '''Returns a dictionary of readSource:count with standard identifiers and a few nonreference read fates'''
+        bias = self.random.lognormal(0, biasStrength, len(self.readSources)) if biasStrength else np.ones(len(self.readSources))
+        fractions = self.expectedFractions * bias
+        fractions /= fractions.sum()
+        nonreferenceReads = int(totalReads * nonreferenceFraction)
+        referenceCounts = self.random.multinomial(totalReads - nonreferenceReads, fractions)
+        sample = dict(zip(self.readSources, referenceCounts.tolist()))
+        if nonreferenceReads:
+            nonreferenceCounts = self.random.multinomial(nonreferenceReads, np.full(len(nonreferenceFates), 1 / len(nonreferenceFates)))
+            sample.update(zip(nonreferenceFates, nonreferenceCounts.tolist()))
+        return sample
+
+    def makeSamples(self, sampleCount:int, **kwargs):
+        return [self.makeSample(**kwargs) for sample in range(sampleCount)]
+
+    def makeAliasHeavySample(self, totalReads:int=100000, unmappedFeatures:int=2000, biasStrength:float=0.3):
+        '''
+        Returns a large count dictionary like a raw classifier export: each read source's reads are split between its identifier and
+        all of its aliases, and a share of the reads is spread over many feature names that are not part of the standard.
+        '''
+        sample = {}
+        standardCounts = self.makeSample(totalReads, biasStrength, nonreferenceFraction=0.1)
+        for readSource in self.readSources:
+            names = [readSource] + self.aliases[readSource]
+            counts = self.random.multinomial(standardCounts.pop(readSource), np.full(len(names), 1 / len(names)))
+            sample.update(zip(names, counts.tolist()))
+        unmappedReads = sum(standardCounts.values())
+        if unmappedFeatures:
+            counts = self.random.multinomial(unmappedReads, np.full(unmappedFeatures, 1 / unmappedFeatures))
+            sample.update(("feature%06d" %index, count) for index, count in enumerate(counts.tolist()))
+        return sample
+
+    def makeFractionalSample(self, totalReads:int=100000, biasStrength:float=0.3):
+        '''
+        Returns a count dictionary with fractional counts (as from abundance correction or normalization), with some read sources
+        split between their identifier and an alias and the keys in a shuffled order
+        '''
+        sample = {}
+        for readSource, count in self.makeSample(totalReads, biasStrength).items():
+            count *= self.random.uniform(0.5, 1.5)
+            if self.aliases.get(readSource) and self.random.random() < 0.5:
+                share = self.random.random()
+                sample[self.aliases[readSource][0]] = count * share
+                count *= 1 - share
+            sample[readSource] = count
+        keys = list(sample)
+        return {keys[index]: sample[keys[index]] for index in self.random.permutation(len(keys)).tolist()}
+
+    def makeSampleIDs(self, sampleCount:int, prefix:str="Synthetic"):
+        return ["%s%06d" %(prefix, index) for index in range(sampleCount)]
+
+
+def loadReportTemplate(templatePath:str=defaultTemplatePath):
+    file = open(templatePath, 'r')
+    template = file.read()
+    file.close()
+    return template
@@ -0,0 +1,342 @@
+import sys
+import array
+import struct
+from . import instrumentation
+
+magic = b"MIQB"
+formatVersion = 1  # bump whenever the layout of a section changes; readers refuse files from newer versions
+fileExtension = ".miqb"
+headerStruct = struct.Struct("<4sHHI")  # magic, format version, flags (unused), section count
+sectionStruct = struct.Struct("<QQ")  # offset from the start of the file, length
+lengthStruct = struct.Struct("<I")
+noString = 0xFFFFFFFF  # string length written for None
+scoreStruct = struct.Struct("<ddd")  # miqScore, rawMiqScore, percentToleranceInStandard
+intervalStruct = struct.Struct("<5ddq")  # MiqScoreInterval limits, standard error, confidence level and replicates
+plotSectionPrefix = "plot/"
+
+
+class SectionWriter(object):
+    '''Builds one section's bytes from strings, numbers and name:value tables'''
+
+    def __init__(self):
+        self.parts = []
+
+    def addStruct(self, structure:struct.Struct, *values):
+        self.parts.append(structure.pack(*values))
+
+    def addString(self, text:str):
+        if text is None:
+            self.parts.append(lengthStruct.pack(noString))
+            return
+        encodedText = str(text).encode("utf-8")
+        self.parts.append(lengthStruct.pack(len(encodedText)))
+        self.parts.append(encodedText)
+
+    def addNumber(self, value:[int, float]):
+        '''A single number, kept as an integer if it is one'''
+        if isinstance(value, int) and not isinstance(value, bool):
+            self.parts.append(struct.pack("<cq", b"q", value))
+        else:
+            self.parts.append(struct.pack("<cd", b"d", value))
+
+    def addArray(self, values, typecode:str="d"):
+        values = array.array(typecode, values)
+        if sys.byteorder == "big":
+            values.byteswap()
+        self.parts.append(lengthStruct.pack(len(values)))
+        self.parts.append(values.tobytes())
+
+    def addTable(self, table:dict):
+        '''Names then values of a dictionary in its own order.  Values are stored as 64 bit integers if they all are integers, otherwise as doubles.'''
+        values = list(table.values())
+        integers = all(isinstance(value, int) and not isinstance(value, bool) for value in values)
+        self.parts.append(b"q" if integers else b"d")
+        self.parts.append(lengthStruct.pack(len(table)))
+        for name in table:
+            self.addString(name)
+        self.addArray(values, "q" if integers else "d")
+
+    def getBytes(self):
+        return b"".join(self.parts)
+
+
+class SectionReader(object):
+    '''Reads back what a SectionWriter wrote, in the same order'''
+
+    def __init__(self, data:[bytes, memoryview]):
+        self.data = memoryview(data)
+        self.position = 0
+
+    def readStruct(self, structure:struct.Struct):
+        values = structure.unpack_from(self.data, self.position)
+        self.position += structure.size
+        return values
+
+    def readLength(self):
+        return self.readStruct(lengthStruct)[0]
+
+    def readString(self):
+        length = self.readLength()
+        if length == noString:
+            return None
+        text = bytes(self.data[self.position:self.position + length]).decode("utf-8")
+        self.position += length
+        return text
+
+    def readNumber(self):
+        typecode = bytes(self.data[self.position:self.position + 1])
+        value = struct.unpack_from("<" + typecode.decode("ascii"), self.data, self.position + 1)[0]
+        self.position += 9
+        return value
+
+    def readArray(self, typecode:str="d"):
+        length = self.readLength()
+        values = array.array(typecode)
+        values.frombytes(self.data[self.position:self.position + length * values.itemsize])
+        if sys.byteorder == "big":
+            values.byteswap()
+        self.position += length * values.itemsize
+        return values
+
+    def readTable(self):
+        typecode = bytes(self.data[self.position:self.position + 1]).decode("ascii")
+        self.position += 1
+        names = [self.readString() for index in range(self.readLength())]
+        return dict(zip(names, self.readArray(typecode).tolist()))
+
+
+def makeSections(miqResult, includePlots:bool=True):
+    '''(section name, section bytes) for every part of a MiqScoreData that is stored'''
+    from . import scoreHistory
+    scores = SectionWriter()
+    scores.addStruct(scoreStruct, miqResult.miqScore, miqResult.rawMiqScore, miqResult.percentToleranceInStandard)
+    scores.addString(miqResult.sampleID)
+    scores.addString(miqResult.analysisMethod)
+    scores.addString(scoreHistory.getReferenceName(miqResult.standardReference))
+    interval = miqResult.confidenceInterval
+    if interval is None:
+        scores.addStruct(struct.Struct("<?"), False)
+    else:
+        scores.addStruct(struct.Struct("<?"), True)
+        scores.addStruct(intervalStruct, interval.miqScoreLower, interval.miqScoreUpper, interval.rawMiqScoreLower, interval.rawMiqScoreUpper, interval.rawMiqScoreStandardError, interval.confidenceLevel, interval.replicates)
+        scores.addNumber(interval.referenceReadTotal)
+    sections = [("scores", scores.getBytes())]
+    counts = SectionWriter()
+    counts.addTable(miqResult.referenceReadCounts)
+    counts.addTable(miqResult.nonreferenceReadCounts)
+    sections.append(("counts", counts.getBytes()))
+    percentages = SectionWriter()
+    percentages.addTable(miqResult.samplePercentages)
+    percentages.addTable(miqResult.samplePercentagesOfExpected)
+    sections.append(("percentages", percentages.getBytes()))
+    curve = miqResult.rarefactionCurve
+    if curve is not None:
+        rarefaction = SectionWriter()
+        rarefaction.addString(curve.sampleID)
+        rarefaction.addArray(curve.depths, "q")
+        for values in (curve.meanMiqScores, curve.miqScoreStandardDeviations, curve.lowerMiqScores, curve.upperMiqScores, curve.meanRawMiqScores):
+            rarefaction.addArray(values.tolist())
+        rarefaction.addNumber(curve.fullDepthMiqScore)
+        rarefaction.addNumber(curve.readTotal)
+        rarefaction.addNumber(curve.replicates)
+        rarefaction.addNumber(curve.confidenceLevel)
+        sections.append(("rarefaction", rarefaction.getBytes()))
+    if includePlots:
+        for plotName, plotFormat, plotBytes in scoreHistory.iteratePlots(miqResult.plots):
+            plotHeader = SectionWriter()
+            plotHeader.addString(plotFormat)
+            sections.append((plotSectionPrefix + plotName, plotHeader.getBytes() + plotBytes))
+    return sections
+
+
+@instrumentation.timed("binaryResult.write")
+def writeResult(miqResult, stream, includePlots:bool=True):
+    '''
+    Writes a MiqScoreData (or CompactMiqScoreData) to a binary stream: a header, a table of named sections (offset and length of
+    each) and the sections themselves.  Scores, counts and percentages each have a section and every plot is kept as raw image
+    bytes in its own section, so readers can pick out only what they need.  Returns the number of bytes written.
+    '''
+    if hasattr(miqResult, "toMiqScoreData"):
+        miqResult = miqResult.toMiqScoreData()
+    sections = makeSections(miqResult, includePlots)
+    encodedNames = [name.encode("utf-8") for name, sectionBytes in sections]
+    offset = headerStruct.size + sum(lengthStruct.size + len(encodedName) + sectionStruct.size for encodedName in encodedNames)
+    header = [headerStruct.pack(magic, formatVersion, 0, len(sections))]
+    for encodedName, (name, sectionBytes) in zip(encodedNames, sections):
+        header.append(lengthStruct.pack(len(encodedName)))
+        header.append(encodedName)
+        header.append(sectionStruct.pack(offset, len(sectionBytes)))
+        offset += len(sectionBytes)
+    byteCount = stream.write(b"".join(header))
+    for name, sectionBytes in sections:
+        byteCount += stream.write(sectionBytes)
+    return byteCount
+
+
+def makeResultBytes(miqResult, includePlots:bool=True):
+    import io
+    stream = io.BytesIO()
+    writeResult(miqResult, stream, includePlots)
+    return stream.getvalue()
+
+
+def isBinaryResult(path:str):
+    file = open(path, 'rb')
+    fileMagic = file.read(len(magic))
+    file.close()
+    return fileMagic == magic
+
+
+class BinaryResultFile(object):
+    '''
+    An open binary result.  Only the header and section table are read on opening; each section is read from the file when it is
+    asked for, so reading the scores of a large file with many plots costs a few small reads.
+    '''
+
+    def __init__(self, path:str):
+        self.path = path
+        self.file = open(path, 'rb')
+        try:
+            self.sections = self.readSectionTable()
+        except BaseException:
+            self.file.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exceptionType, exception, traceback):
+        self.close()
+        return False
+
+    def close(self):
+        self.file.close()
+
+    def readSectionTable(self):
+        headerBytes = self.file.read(headerStruct.size)
+        if len(headerBytes) < headerStruct.size:
+            raise ValueError("%s is too short to be a binary MIQ result" %self.path)
+        fileMagic, version, flags, sectionCount = headerStruct.unpack(headerBytes)
+        if not fileMagic == magic:
+            raise ValueError("%s is not a binary MIQ result" %self.path)
+        if version > formatVersion:
+            raise ValueError("%s was written in binary result format version %s, but only versions up to %s can be read. Please update the package." %(self.path, version, formatVersion))
+        sections = {}
+        for index in range(sectionCount):
+            nameLength = lengthStruct.unpack(self.file.read(lengthStruct.size))[0]
+            name = self.file.read(nameLength).decode("utf-8")
+            sections[name] = sectionStruct.unpack(self.file.read(sectionStruct.size))
+        return sections
+
+    def readSection(self, name:str):
+        if not name in self.sections:
+            raise ValueError("Binary result %s has no %s section" %(self.path, name))
+        offset, length = self.sections[name]
+        self.file.seek(offset)
+        sectionBytes = self.file.read(length)
+        if len(sectionBytes) < length:
+            raise ValueError("Binary result %s is truncated in its %s section" %(self.path, name))
+        return sectionBytes
+
+    def readScores(self):
+        '''
+        Dictionary of sampleID, analysisMethod, referenceName, miqScore, rawMiq, percentToleranceInStandard and (if one was stored)
+        miqScoreConfidenceInterval, named like the jsonOutput fields
+        '''
+        reader = SectionReader(self.readSection("scores"))
+        miqScore, rawMiqScore, percentToleranceInStandard = reader.readStruct(scoreStruct)
+        scores = {"sampleID": reader.readString(),
+                  "analysisMethod": reader.readString(),
+                  "referenceName": reader.readString(),
+                  "miqScore": miqScore,
+                  "rawMiq": rawMiqScore,
+                  "percentToleranceInStandard": percentToleranceInStandard}
+        if reader.readStruct(struct.Struct("<?"))[0]:
+            intervalValues = reader.readStruct(intervalStruct)
+            intervalNames = ("miqScoreLower", "miqScoreUpper", "rawMiqScoreLower", "rawMiqScoreUpper", "rawMiqScoreStandardError", "confidenceLevel", "replicates")
+            interval = dict(zip(intervalNames, intervalValues))
+            interval["referenceReadTotal"] = reader.readNumber()
+            scores["miqScoreConfidenceInterval"] = interval
+        return scores
+
+    def readCounts(self):
+        '''(referenceReadCounts, nonreferenceReadCounts)'''
+        reader = SectionReader(self.readSection("counts"))
+        return reader.readTable(), reader.readTable()
+
+    def readPercentages(self):
+        '''(samplePercentages, samplePercentagesOfExpected)'''
+        reader = SectionReader(self.readSection("percentages"))
+        return reader.readTable(), reader.readTable()
+
+    def readRarefactionCurve(self):
+        '''The stored RarefactionCurve, or None'''
+        import numpy
+        from . import RarefactionCurve
+        if not "rarefaction" in self.sections:
+            return None
+        reader = SectionReader(self.readSection("rarefaction"))
+        sampleID = reader.readString()
+        depths = reader.readArray("q").tolist()
+        meanMiqScores, miqScoreStandardDeviations, lowerMiqScores, upperMiqScores, meanRawMiqScores = [numpy.array(reader.readArray(), dtype=numpy.float64) for index in range(5)]
+        fullDepthMiqScore = reader.readNumber()
+        readTotal = reader.readNumber()
+        replicates = reader.readNumber()
+        confidenceLevel = reader.readNumber()
+        return RarefactionCurve(depths, meanMiqScores, miqScoreStandardDeviations, lowerMiqScores, upperMiqScores, meanRawMiqScores, fullDepthMiqScore, readTotal, replicates, confidenceLevel, sampleID)
+
+    def listPlots(self):
+        return [name[len(plotSectionPrefix):] for name in self.sections if name.startswith(plotSectionPrefix)]
+
+    def readPlot(self, plotName:str, output:str="base64"):
+        '''(format, plot) for one stored plot as the requested output type (see plotting.plotEncoding)'''
+        from . import plotting
+        sectionBytes = self.readSection(plotSectionPrefix + plotName)
+        reader = SectionReader(sectionBytes)
+        plotFormat = reader.readString()
+        return plotFormat, plotting.plotEncoding.convertPlotOutput(sectionBytes[reader.position:], plotFormat, output)
+
+    def readPlots(self, output:str="base64", plotFormat:str=None):
+        '''The stored plots as a plots dictionary (groups such as radarPlots nested as they were).  With plotFormat, only plots in that format are read.'''
+        from . import plotting
+        plots = {}
+        for plotName in self.listPlots():
+            storedFormat, plot = self.readPlot(plotName, output)
+            if plotFormat is not None and not storedFormat == plotting.plotEncoding.getFileFormat(plotFormat):
+                continue
+            if "/" in plotName:
+                group, plotName = plotName.split("/", 1)
+                plots.setdefault(group, {})[plotName] = plot
+            else:
+                plots[plotName] = plot
+        return plots
+
+    def loadResult(self, standardReference, loadPlots:bool=True, plotOutput:str="base64", plotFormat:str=None):
+        from . import MiqScoreData, MiqScoreInterval
+        scores = self.readScores()
+        referenceReadCounts, nonreferenceReadCounts = self.readCounts()
+        samplePercentages, samplePercentagesOfExpected = self.readPercentages()
+        miqResult = MiqScoreData(scores["miqScore"], scores["rawMiq"], referenceReadCounts, nonreferenceReadCounts, samplePercentages, samplePercentagesOfExpected, scores["percentToleranceInStandard"], scores["analysisMethod"], standardReference, scores["sampleID"])
+        if "miqScoreConfidenceInterval" in scores:
+            miqResult.confidenceInterval = MiqScoreInterval(**scores["miqScoreConfidenceInterval"])
+        miqResult.rarefactionCurve = self.readRarefactionCurve()
+        if loadPlots:
+            miqResult.plots = self.readPlots(plotOutput, plotFormat)
+        return miqResult
+
+
+def readScores(path:str):
+    '''Only the score fields of a binary result (see BinaryResultFile.readScores), without reading its counts or plots'''
+    with BinaryResultFile(path) as resultFile:
+        return resultFile.readScores()
+
+
+@instrumentation.timed("binaryResult.load")
+def loadResult(path:str, standardReference, loadPlots:bool=True, plotOutput:str="base64", plotFormat:str=None):
+    '''
+    Rebuilds the MiqScoreData stored in a binary result exactly as it was written, without scoring it again or redrawing its
+    plots.  The standard reference is not stored in the file, so it has to be given.  Plots are returned as plotOutput (see
+    plotting.plotEncoding), only in plotFormat if one is given, and are left out with loadPlots=False.
+    '''
+    with BinaryResultFile(path) as resultFile:
+        return resultFile.loadResult(standardReference, loadPlots, plotOutput, plotFormat)
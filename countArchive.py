@@ -0,0 +1,342 @@
+import os
+import json
+import numpy
+from . import instrumentation
+from . import referenceHandler
+from . import countTableReader
+from . import readCountMatrixOperations
+
+archiveVersion = 1  # bump whenever the layout of the archive files changes; readers refuse archives from newer versions
+metadataFileName = "archive.json"
+sampleIDFileName = "sampleIDs.utf8"
+sampleIDOffsetFileName = "sampleIDOffsets.i8"
+countType = numpy.dtype("<f8")
+offsetType = numpy.dtype("<i8")
+
+
+def isCountArchive(path:str):
+    return os.path.isfile(os.path.join(path, metadataFileName))
+
+
+def getColumnFileName(column:int):
+    return "column%05d.f8" %column
+
+
+def readMetadata(path:str):
+    file = open(os.path.join(path, metadataFileName), 'r')
+    metadata = json.load(file)
+    file.close()
+    if metadata.get("archiveVersion", 0) > archiveVersion:
+        raise ValueError("Count archive %s was written with archive version %s, but only versions up to %s can be read. Please update the package." %(path, metadata["archiveVersion"], archiveVersion))
+    return metadata
+
+
+class CountArchiveWriter(object):
+    '''
+    Writes a count archive: a directory with one file of little-endian float64 counts per column, the sample IDs as UTF-8 text with
+    an offset index and archive.json describing the columns.  Columns are laid out like CountTableReader.readSources: every read
+    source of the standard reference in reference index order, then the named nonreference fates, then one unassigned column for
+    everything else.  Samples are buffered chunkSize at a time and each column's part of the chunk is appended to its own file, so
+    writing needs memory for one chunk only.  archive.json, with the sample count, is replaced atomically after every chunk, so
+    readers only see whole chunks.  Opening the writer on an existing archive appends to it (the columns must match).
+    '''
+
+    def __init__(self, path:str, standardReference: referenceHandler.StandardReference, nonreferenceFates:[list, tuple]=(), unassignedLabel:str="Unassigned", chunkSize:int=65536):
+        if chunkSize < 1:
+            raise ValueError("Chunk size must be at least 1. Got %s" %chunkSize)
+        self.path = path
+        self.standardReference = standardReference
+        self.reader = countTableReader.CountTableReader(standardReference, nonreferenceFates, unassignedLabel)
+        self.readSources = self.reader.readSources
+        self.referenceReadSourceCount = len(standardReference.compiledReference.readSourceIDs)
+        self.chunkSize = chunkSize
+        os.makedirs(path, exist_ok=True)
+        existingArchive = isCountArchive(path)
+        if existingArchive:
+            metadata = readMetadata(path)
+            if not metadata["readSources"] == self.readSources:
+                raise ValueError("Count archive %s has the columns %s, which do not match the reference and nonreference fates given (%s)" %(path, metadata["readSources"], self.readSources))
+            self.sampleCount = metadata["sampleCount"]
+            self.sampleIDByteCount = metadata["sampleIDBytes"]
+        else:
+            self.sampleCount = 0
+            self.sampleIDByteCount = 0
+        self.columnFiles = [self.openTruncated(getColumnFileName(column), self.sampleCount * countType.itemsize) for column in range(len(self.readSources))]
+        self.sampleIDFile = self.openTruncated(sampleIDFileName, self.sampleIDByteCount)
+        if existingArchive:
+            self.sampleIDOffsetFile = self.openTruncated(sampleIDOffsetFileName, (self.sampleCount + 1) * offsetType.itemsize)
+        else:
+            self.sampleIDOffsetFile = self.openTruncated(sampleIDOffsetFileName, 0)
+            self.sampleIDOffsetFile.write(numpy.zeros(1, dtype=offsetType).tobytes())  # offsets start with the start of the first sample ID
+        self.buffer = numpy.zeros((len(self.readSources), chunkSize), dtype=countType)  # column major, so each column's chunk is written straight from the buffer
+        self.bufferedSampleIDs = []
+        if not existingArchive:
+            self.writeMetadata()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exceptionType, exception, traceback):
+        self.close()
+        return False
+
+    def __len__(self):
+        return self.sampleCount + len(self.bufferedSampleIDs)
+
+    def openTruncated(self, fileName:str, length:int):
+        '''Opens one of the archive files for appending after its first length bytes, dropping anything a crashed writer left after the last whole chunk'''
+        path = os.path.join(self.path, fileName)
+        file = open(path, 'r+b' if os.path.isfile(path) else 'w+b')
+        file.truncate(length)
+        file.seek(length)
+        return file
+
+    def addCounts(self, sampleID:str, counts:[list, tuple, numpy.ndarray]):
+        '''Adds a sample given as a count vector in the order of readSources (as the CountTableReader readers yield them)'''
+        if not len(counts) == len(self.readSources):
+            raise ValueError("Sample %s has %s counts, but the archive has %s columns" %(sampleID, len(counts), len(self.readSources)))
+        self.buffer[:, len(self.bufferedSampleIDs)] = counts
+        self.bufferedSampleIDs.append(str(sampleID))
+        if len(self.bufferedSampleIDs) == self.chunkSize:
+            self.flush()
+
+    def addSample(self, sampleID:str, sampleData:dict):
+        '''
+        Adds a sample given as a count dictionary like those taken by calculateMiq.  Names are matched to the reference (aliases and
+        taxonomy strings) like CountTableReader does, and names that are neither in the reference nor a named nonreference fate are
+        added to the unassigned column.
+        '''
+        counts = numpy.zeros(len(self.readSources), dtype=countType)
+        for featureName, count in sampleData.items():
+            counts[self.reader.resolveFeatureName(featureName)] += count
+        self.addCounts(sampleID, counts)
+
+    def addSamples(self, samples):
+        '''Adds (sampleID, count vector) pairs from any of the CountTableReader readers'''
+        for sampleID, counts in samples:
+            self.addCounts(sampleID, counts)
+
+    @instrumentation.timed("countArchive.write")
+    def flush(self):
+        if not self.bufferedSampleIDs:
+            return
+        sampleCount = len(self.bufferedSampleIDs)
+        for column, file in enumerate(self.columnFiles):
+            file.write(memoryview(self.buffer[column, :sampleCount]))
+        encodedSampleIDs = [sampleID.encode("utf-8") for sampleID in self.bufferedSampleIDs]
+        offsets = numpy.cumsum([len(encodedSampleID) for encodedSampleID in encodedSampleIDs], dtype=offsetType) + self.sampleIDByteCount
+        self.sampleIDFile.write(b"".join(encodedSampleIDs))
+        self.sampleIDOffsetFile.write(offsets.tobytes())
+        for file in self.columnFiles + [self.sampleIDFile, self.sampleIDOffsetFile]:
+            file.flush()
+        self.sampleCount += sampleCount
+        self.sampleIDByteCount = int(offsets[-1])
+        self.bufferedSampleIDs = []
+        self.writeMetadata()
+
+    def writeMetadata(self):
+        metadata = {"archiveVersion": archiveVersion,
+                    "sampleCount": self.sampleCount,
+                    "sampleIDBytes": self.sampleIDByteCount,
+                    "readSources": self.readSources,
+                    "referenceReadSourceCount": self.referenceReadSourceCount,
+                    "unassignedLabel": self.reader.unassignedLabel,
+                    "countType": countType.str}
+        temporaryPath = os.path.join(self.path, metadataFileName + ".tmp")
+        file = open(temporaryPath, 'w')
+        json.dump(metadata, file, indent=4)
+        file.close()
+        os.replace(temporaryPath, os.path.join(self.path, metadataFileName))
+
+    def close(self):
+        if self.columnFiles is None:
+            return
+        self.flush()
+        for file in self.columnFiles + [self.sampleIDFile, self.sampleIDOffsetFile]:
+            file.close()
+        self.columnFiles = None
+
+
+def archiveCountTable(countsPath:str, archivePath:str, standardReference: referenceHandler.StandardReference, longTable:bool=False, nonreferenceFates:[list, tuple]=(), chunkSize:int=65536):
+    '''Adds every sample in a count table (wide, long or BIOM, see CountTableReader.readTable) to a count archive.  Returns the number of samples in the archive.'''
+    with CountArchiveWriter(archivePath, standardReference, nonreferenceFates, chunkSize=chunkSize) as writer:
+        writer.addSamples(writer.reader.readTable(countsPath, long=longTable))
+        return len(writer)
+
+
+class CountArchive(object):
+    '''
+    Read-only view of a count archive.  Every column and the sample ID index are memory mapped, so opening an archive costs the same
+    at any size, and slices of columns (getColumn(readSource)[start:end]) are zero-copy views backed by the page cache.  Only the
+    samples that were complete when the archive was opened are visible.
+    '''
+
+    def __init__(self, path:str):
+        if not isCountArchive(path):
+            raise ValueError("No count archive found at %s" %path)
+        self.path = path
+        metadata = readMetadata(path)
+        self.readSources = metadata["readSources"]
+        self.referenceReadSourceCount = metadata["referenceReadSourceCount"]
+        self.unassignedLabel = metadata["unassignedLabel"]
+        self.sampleCount = metadata["sampleCount"]
+        self.columnIndex = {readSource: column for column, readSource in enumerate(self.readSources)}
+        self.columns = [self.mapFile(getColumnFileName(column), countType, self.sampleCount) for column in range(len(self.readSources))]
+        self.sampleIDOffsets = self.mapFile(sampleIDOffsetFileName, offsetType, self.sampleCount + 1)
+        self.sampleIDBytes = self.mapFile(sampleIDFileName, numpy.uint8, metadata["sampleIDBytes"])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exceptionType, exception, traceback):
+        self.close()
+        return False
+
+    def __len__(self):
+        return self.sampleCount
+
+    def mapFile(self, fileName:str, dataType, length:int):
+        if not length:  # empty files can not be memory mapped
+            empty = numpy.zeros(0, dtype=dataType)
+            empty.setflags(write=False)
+            return empty
+        return numpy.memmap(os.path.join(self.path, fileName), dtype=dataType, mode='r', shape=(length,))
+
+    def close(self):
+        '''Drops the memory maps.  Arrays taken from the archive keep their maps open until they are released.'''
+        self.columns = []
+        self.sampleIDOffsets = None
+        self.sampleIDBytes = None
+
+    @property
+    def nonreferenceReadSources(self):
+        '''Nonreference fate columns (named fates and the unassigned column), which come after the reference read sources'''
+        return self.readSources[self.referenceReadSourceCount:]
+
+    def getColumn(self, readSource:str):
+        '''Memory mapped counts of one column (a reference read source or nonreference fate) for every sample'''
+        if not readSource in self.columnIndex:
+            raise ValueError("Count archive %s has no column %s" %(self.path, readSource))
+        return self.columns[self.columnIndex[readSource]]
+
+    def getSampleIDs(self, start:int=0, end:int=None):
+        start, end, step = slice(start, end).indices(self.sampleCount)
+        offsets = self.sampleIDOffsets[start:end + 1].tolist()
+        if not offsets:
+            return []
+        text = self.sampleIDBytes[offsets[0]:offsets[-1]].tobytes()
+        return [text[offset - offsets[0]:nextOffset - offsets[0]].decode("utf-8") for offset, nextOffset in zip(offsets, offsets[1:])]
+
+    def getCountMatrix(self, start:int=0, end:int=None):
+        '''Samples x readSources matrix of counts for a range of samples, which can be given to calculateMiqBatch with readSources'''
+        start, end, step = slice(start, end).indices(self.sampleCount)
+        countMatrix = numpy.empty((max(end - start, 0), len(self.readSources)), dtype=numpy.float64)
+        for column, counts in enumerate(self.columns):
+            countMatrix[:, column] = counts[start:end]
+        return countMatrix
+
+    def getSampleData(self, index:int):
+        '''One sample as a count dictionary for calculateMiq (empty columns are left out)'''
+        return {readSource: float(counts[index]) for readSource, counts in zip(self.readSources, self.columns) if counts[index]}
+
+    def iterateSamples(self, chunkSize:int=4096):
+        '''Yields (sampleID, count vector) pairs in archive order, like the CountTableReader readers'''
+        for start in range(0, self.sampleCount, chunkSize):
+            end = min(start + chunkSize, self.sampleCount)
+            yield from zip(self.getSampleIDs(start, end), self.getCountMatrix(start, end))
+
+
+class ArchiveScorer(object):
+    '''
+    Scores every sample in a CountArchive with a calculator's analysis method, tolerance and floor, a chunk of samples at a time.
+    Only the columns of the calculator's expected read sources are read (archive columns are matched to them by name through the
+    calculator's reference, so archives written with an older version of a reference still score).  Each chunk is gathered from
+    zero-copy slices of those columns' memory maps into one reusable chunkSize x expected read sources buffer and scored with the
+    same matrix operations as calculateMiqBatch, so scores are identical to calculateMiq's and resident memory is bounded by the
+    chunk size rather than the archive.  With exact=False the last step is fully vectorized (see
+    readCountMatrixOperations.calculateVectorizedRawMiqScores), which is faster again but can differ from calculateMiq in the last
+    bit.  Bootstrap intervals and rarefaction are not calculated.
+    '''
+
+    def __init__(self, calculator, archive: CountArchive, chunkSize:int=65536, exact:bool=True):
+        if chunkSize < 1:
+            raise ValueError("Chunk size must be at least 1. Got %s" %chunkSize)
+        self.calculator = calculator
+        self.archive = archive
+        self.chunkSize = chunkSize
+        self.exact = exact
+        aliasLookup = calculator.standardReference.compiledReference.aliasLookup
+        expectedIndex = {readSource: index for index, readSource in enumerate(calculator.expectedReadSources)}
+        self.columnGroups = [[] for readSource in calculator.expectedReadSources]  # archive columns summed into each expected read source
+        for column, readSource in enumerate(archive.readSources):
+            index = expectedIndex.get(aliasLookup.get(readSource, readSource))
+            if index is not None:
+                self.columnGroups[index].append(column)
+        # calculateMiq on an archived sample sees its read sources in archive column order, so read totals are added in that order
+        self.referenceColumnOrder = readCountMatrixOperations.getReferenceColumnOrders([range(len(archive.readSources))], archive.readSources, calculator.expectedReadSources, calculator.standardReference)[0]
+        compiledReference = calculator.standardReference.compiledReference
+        self.expectedPercentages = compiledReference.expectedValueVectors[calculator.analysisMethod][compiledReference.expectedReadSourceIndices[calculator.analysisMethod]]
+        self.buffer = None
+
+    def __len__(self):
+        return len(self.archive)
+
+    def gatherReferenceCounts(self, start:int, end:int):
+        '''Reference counts of samples start to end in the order of expectedReadSources, in the scorer's reused chunk buffer'''
+        if self.buffer is None or self.buffer.shape[0] < end - start:
+            self.buffer = numpy.empty((end - start, len(self.columnGroups)), dtype=numpy.float64)
+        referenceCounts = self.buffer[:end - start]
+        for index, columns in enumerate(self.columnGroups):
+            if not columns:
+                referenceCounts[:, index] = 0
+                continue
+            referenceCounts[:, index] = self.archive.columns[columns[0]][start:end]
+            for column in columns[1:]:
+                referenceCounts[:, index] += self.archive.columns[column][start:end]
+        return referenceCounts
+
+    @instrumentation.timed("countArchive.scoreChunk")
+    def scoreChunk(self, start:int, end:int):
+        '''(miqScores, rawMiqScores) arrays for samples start to end'''
+        start, end, step = slice(start, end).indices(len(self.archive))
+        end = max(start, end)
+        referenceCounts = self.gatherReferenceCounts(start, end)
+        readSums = readCountMatrixOperations.calculateReadSums(referenceCounts, [self.referenceColumnOrder] * (end - start))
+        samplePercentages = readCountMatrixOperations.convertMatrixToPercentages(referenceCounts, readSums)
+        samplePercentOfExpected = readCountMatrixOperations.calculateObservedPercentOfExpected(samplePercentages, self.expectedPercentages)
+        adjustedPercentErrors = readCountMatrixOperations.calculateAdjustedPercentErrors(samplePercentOfExpected, self.calculator.percentToleranceInStandard)
+        if self.exact:
+            rawMiqScores = readCountMatrixOperations.calculateRawMiqScores(adjustedPercentErrors)
+        else:
+            rawMiqScores = readCountMatrixOperations.calculateVectorizedRawMiqScores(adjustedPercentErrors)
+        return readCountMatrixOperations.applyFloor(rawMiqScores, self.calculator.floor), rawMiqScores
+
+    def iterateScores(self, start:int=0, end:int=None, includeSampleIDs:bool=True):
+        '''Yields (chunk start, sampleIDs, miqScores, rawMiqScores) chunk by chunk.  Sample IDs are None with includeSampleIDs=False, which skips decoding them.'''
+        if end is None:
+            end = len(self.archive)
+        for chunkStart in range(start, end, self.chunkSize):
+            chunkEnd = min(chunkStart + self.chunkSize, end)
+            miqScores, rawMiqScores = self.scoreChunk(chunkStart, chunkEnd)
+            sampleIDs = self.archive.getSampleIDs(chunkStart, chunkEnd) if includeSampleIDs else None
+            yield chunkStart, sampleIDs, miqScores, rawMiqScores
+
+    def scoreAll(self):
+        '''(miqScores, rawMiqScores) arrays for every sample in archive order'''
+        miqScores = numpy.empty(len(self.archive), dtype=numpy.float64)
+        rawMiqScores = numpy.empty(len(self.archive), dtype=numpy.float64)
+        for chunkStart, sampleIDs, chunkMiqScores, chunkRawMiqScores in self.iterateScores(includeSampleIDs=False):
+            miqScores[chunkStart:chunkStart + len(chunkMiqScores)] = chunkMiqScores
+            rawMiqScores[chunkStart:chunkStart + len(chunkRawMiqScores)] = chunkRawMiqScores
+        return miqScores, rawMiqScores
+
+    def scoreTable(self):
+        '''Returns a dictionary of sampleID:miqScore for every sample in the archive'''
+        scoreTable = {}
+        for chunkStart, sampleIDs, miqScores, rawMiqScores in self.iterateScores():
+            scoreTable.update(zip(sampleIDs, miqScores.tolist()))
+        return scoreTable
+
+    def scoreBatch(self, start:int, end:int):
+        '''Full MiqScoreBatch (with percentages and nonreference counts) for samples start to end, from calculateMiqBatch'''
+        return self.calculator.calculateMiqBatch(self.archive.getCountMatrix(start, end), self.archive.readSources, self.archive.getSampleIDs(start, end))
@@ -0,0 +1,203 @@
+import numpy as np
+from . import referenceHandler
+
+
+class CountTableReader(object):
+    '''
+    Streams multi-sample count tables and yields (sampleID, countVector) pairs, where each count vector is already mapped
+    through the standard reference aliases.  Vectors line up with readSources: every read source in the reference, then any
+    named nonreference read fates, then a single unassigned column collecting all features that are not part of the standard.
+    Memory use is bounded by samples x read sources no matter how many features the table has.
+    '''
+
+    def __init__(self, standardReference: referenceHandler.StandardReference, nonreferenceFates:[list, tuple]=(), unassignedLabel:str="Unassigned"):
+        self.standardReference = standardReference
+        compiledReference = standardReference.compiledReference
+        self.readSources = list(compiledReference.readSourceIDs) + [fate for fate in nonreferenceFates if not fate in compiledReference.aliasIndex]
+        if unassignedLabel in self.readSources:
+            raise ValueError("Unassigned label %s is already a read source or nonreference fate" %unassignedLabel)
+        self.readSources.append(unassignedLabel)
+        self.unassignedLabel = unassignedLabel
+        self.unassignedColumn = len(self.readSources) - 1
+        self.fateColumns = {fate: self.readSources.index(fate) for fate in nonreferenceFates if not fate in compiledReference.aliasIndex}
+        self.resolvedFeatures = {}
+
+    def resolveFeatureName(self, featureName:str):
+        '''
+        Returns the column for a feature name.  Names are checked against the reference aliases first, then treated as QIIME-style
+        taxonomy strings (k__...;p__...;...): whitespace and empty ranks are dropped and the genus;species pair and shorter lineages are tried.
+        '''
+        if featureName in self.resolvedFeatures:
+            return self.resolvedFeatures[featureName]
+        column = self.lookupFeatureName(featureName)
+        self.resolvedFeatures[featureName] = column
+        return column
+
+    def lookupFeatureName(self, featureName:str):
+        aliasIndex = self.standardReference.compiledReference.aliasIndex
+        if featureName in aliasIndex:
+            return aliasIndex[featureName]
+        if featureName in self.fateColumns:
+            return self.fateColumns[featureName]
+        ranks = [rank.strip() for rank in featureName.split(";")]
+        ranks = [rank for rank in ranks if rank and not rank.endswith("__")]
+        candidates = [";".join(ranks)]
+        if len(ranks) > 2:
+            candidates.append(";".join(ranks[-2:]))
+        for end in range(len(ranks) - 1, 0, -1):
+            candidates.append(";".join(ranks[:end]))
+        for candidate in candidates:
+            if candidate in aliasIndex:
+                return aliasIndex[candidate]
+        return self.unassignedColumn
+
+    def readTable(self, path:str, long:bool=False, **kwargs):
+        '''Picks a reader from the file extension: .biom for BIOM/HDF5, otherwise a wide table unless long is set.'''
+        if path.lower().endswith(".biom"):
+            return self.readBiomTable(path, **kwargs)
+        if long:
+            return self.readLongTable(path, **kwargs)
+        return self.readWideTable(path, **kwargs)
+
+    def readWideTable(self, path:str, delimiter:str=None, featureColumn:int=0, taxonomyColumn:str="taxonomy"):
+        '''
+        Reads a table with features as rows and samples as columns (like a QIIME OTU table or feature table export).
+        Comment lines before the header are skipped, and a trailing taxonomy column is used as the feature name when present.
+        '''
+        import csv
+        file = openTextFile(path)
+        try:
+            reader = csv.reader(file, delimiter=delimiter or guessDelimiter(path))
+            header = None
+            for row in reader:
+                if row and not (row[0].startswith("#") and len(row) == 1):
+                    header = row
+                    break
+            if header is None:
+                return
+            nameColumn = featureColumn
+            dataColumns = [column for column in range(len(header)) if not column == featureColumn]
+            if taxonomyColumn and header[-1].strip().lower() == taxonomyColumn.lower():
+                nameColumn = len(header) - 1
+                dataColumns.remove(nameColumn)
+            sampleIDs = [header[column] for column in dataColumns]
+            counts = np.zeros((len(self.readSources), len(sampleIDs)), dtype=np.float64)
+            for row in reader:
+                if not row or row[0].startswith("#"):
+                    continue
+                column = self.resolveFeatureName(row[nameColumn])
+                counts[column] += np.array([row[dataColumn] or 0 for dataColumn in dataColumns], dtype=np.float64)
+        finally:
+            file.close()
+        counts = np.ascontiguousarray(counts.T)
+        for index, sampleID in enumerate(sampleIDs):
+            yield sampleID, counts[index]
+
+    def readLongTable(self, path:str, delimiter:str=None, sampleColumn:int=0, featureColumn:int=1, countColumn:int=2, hasHeader:bool=True, sortedBySample:bool=False):
+        '''
+        Reads a table with one (sample, feature, count) record per line.  If the table is sorted by sample, sortedBySample=True
+        will yield each sample as soon as its last record is read so that only one sample is held in memory at a time.
+        '''
+        import csv
+        file = openTextFile(path)
+        try:
+            reader = csv.reader(file, delimiter=delimiter or guessDelimiter(path))
+            if hasHeader:
+                next(reader, None)
+            sampleCounts = {}
+            finishedSamples = set()
+            currentSample = None
+            for row in reader:
+                if not row or row[0].startswith("#"):
+                    continue
+                sampleID = row[sampleColumn]
+                if sortedBySample and not sampleID == currentSample:
+                    if currentSample is not None:
+                        finishedSamples.add(currentSample)
+                        yield currentSample, sampleCounts.pop(currentSample)
+                    if sampleID in finishedSamples:
+                        raise ValueError("Sample %s appears in more than one block of %s, but the table was read as sorted by sample" %(sampleID, path))
+                    currentSample = sampleID
+                if not sampleID in sampleCounts:
+                    sampleCounts[sampleID] = np.zeros(len(self.readSources), dtype=np.float64)
+                sampleCounts[sampleID][self.resolveFeatureName(row[featureColumn])] += float(row[countColumn] or 0)
+        finally:
+            file.close()
+        for sampleID in sampleCounts:
+            yield sampleID, sampleCounts[sampleID]
+
+    def readBiomTable(self, path:str, samplesPerBlock:int=256, useTaxonomy:bool=True):
+        '''
+        Reads a BIOM 2.x (HDF5) table one block of samples at a time from its sample-major (CSC) matrix.  Requires h5py.
+        Observation taxonomy metadata is used for any observation whose ID is not a reference alias.
+        '''
+        try:
+            import h5py
+        except ImportError:
+            raise ImportError("Reading BIOM tables requires h5py to be installed")
+        table = h5py.File(path, 'r')
+        try:
+            featureColumns = np.array([self.resolveFeatureName(decodeBiomString(name)) for name in table["observation/ids"][:]], dtype=np.intp)
+            if useTaxonomy and "observation/metadata/taxonomy" in table:
+                taxonomy = table["observation/metadata/taxonomy"][:]
+                for observation in np.flatnonzero(featureColumns == self.unassignedColumn).tolist():
+                    lineage = ";".join(decodeBiomString(rank) for rank in taxonomy[observation])
+                    featureColumns[observation] = self.resolveFeatureName(lineage)
+            sampleIDs = [decodeBiomString(name) for name in table["sample/ids"][:]]
+            indptr = table["sample/matrix/indptr"][:]
+            data = table["sample/matrix/data"]
+            indices = table["sample/matrix/indices"]
+            for blockStart in range(0, len(sampleIDs), samplesPerBlock):
+                blockEnd = min(blockStart + samplesPerBlock, len(sampleIDs))
+                blockData = data[indptr[blockStart]:indptr[blockEnd]]
+                blockIndices = indices[indptr[blockStart]:indptr[blockEnd]]
+                for sampleIndex in range(blockStart, blockEnd):
+                    start = indptr[sampleIndex] - indptr[blockStart]
+                    end = indptr[sampleIndex + 1] - indptr[blockStart]
+                    counts = np.bincount(featureColumns[blockIndices[start:end]], weights=blockData[start:end], minlength=len(self.readSources))
+                    yield sampleIDs[sampleIndex], counts.astype(np.float64)
+        finally:
+            table.close()
+
+    def readBatches(self, samples, batchSize:int=1024):
+        '''
+        Groups (sampleID, countVector) pairs from any of the readers into (sampleIDs, count matrix) batches that can be passed
+        straight to MiqScoreCalculator.calculateMiqBatch along with readSources.
+        '''
+        sampleIDs = []
+        vectors = []
+        for sampleID, counts in samples:
+            sampleIDs.append(sampleID)
+            vectors.append(counts)
+            if len(sampleIDs) == batchSize:
+                yield sampleIDs, np.vstack(vectors)
+                sampleIDs = []
+                vectors = []
+        if sampleIDs:
+            yield sampleIDs, np.vstack(vectors)
+
+    def makeCountDict(self, counts:np.ndarray):
+        '''Converts a count vector back into a dictionary of readSource:count (dropping empty read sources) for calculateMiq'''
+        return {self.readSources[column]: count for column, count in enumerate(counts.tolist()) if count}
+
+
+def guessDelimiter(path:str):
+    name = path.lower()
+    if name.endswith(".gz"):
+        name = name[:-3]
+    if name.endswith(".csv"):
+        return ","
+    return "\t"
+
+
+def openTextFile(path:str):
+    if path.lower().endswith(".gz"):
+        import gzip
+        return gzip.open(path, 'rt', newline='')
+    return open(path, 'r', newline='')
+
+
+def decodeBiomString(value):
+    if isinstance(value, bytes):
+        return value.decode()
+    return str(value)
@@ -0,0 +1,402 @@
+import time
+import threading
+
+enabled = False
+_runMetrics = None
+_metricsLock = threading.Lock()
+_localState = threading.local()
+
+
+class StageStatistics(object):
+    '''Running totals for one named stage: number of calls, time spent and bytes produced'''
+
+    __slots__ = ["calls",
+                 "seconds",
+                 "bytes",
+                 "minimumSeconds",
+                 "maximumSeconds"]
+
+    def __init__(self):
+        self.calls = 0
+        self.seconds = 0.0
+        self.bytes = 0
+        self.minimumSeconds = None
+        self.maximumSeconds = None
+
+    def add(self, seconds:float, byteCount:int=0, calls:int=1, minimumSeconds:float=None, maximumSeconds:float=None):
+        if minimumSeconds is None:
+            minimumSeconds = seconds
+        if maximumSeconds is None:
+            maximumSeconds = seconds
+        self.calls += calls
+        self.seconds += seconds
+        self.bytes += byteCount
+        if self.minimumSeconds is None or minimumSeconds < self.minimumSeconds:
+            self.minimumSeconds = minimumSeconds
+        if self.maximumSeconds is None or maximumSeconds > self.maximumSeconds:
+            self.maximumSeconds = maximumSeconds
+
+    def toDict(self):
+        return {"calls": self.calls,
+                "seconds": self.seconds,
+                "bytes": self.bytes,
+                "minimumSeconds": self.minimumSeconds,
+                "maximumSeconds": self.maximumSeconds}
+
+
+class LatencyHistogram(object):
+    '''
+    Counts latencies in logarithmic buckets (by default 0.1ms to 100s with four buckets per power of ten) along with their
+    total, minimum and maximum, so percentiles can be estimated in constant memory however many latencies are recorded.
+    '''
+
+    def __init__(self, lowestSeconds:float=1e-4, highestSeconds:float=100, bucketsPerDecade:int=4):
+        import math
+        if not 0 < lowestSeconds < highestSeconds:
+            raise ValueError("Histogram needs 0 < lowestSeconds < highestSeconds. Got %s and %s" %(lowestSeconds, highestSeconds))
+        bucketCount = math.ceil(math.log10(highestSeconds / lowestSeconds) * bucketsPerDecade)
+        self.upperBounds = [lowestSeconds * 10 ** (bucket / bucketsPerDecade) for bucket in range(bucketCount + 1)]
+        self.bucketCounts = [0] * (len(self.upperBounds) + 1)  # the last bucket holds everything above highestSeconds
+        self.count = 0
+        self.totalSeconds = 0.0
+        self.minimumSeconds = None
+        self.maximumSeconds = None
+        self.lock = threading.Lock()
+
+    def record(self, seconds:float):
+        import bisect
+        with self.lock:
+            self.bucketCounts[bisect.bisect_left(self.upperBounds, seconds)] += 1
+            self.count += 1
+            self.totalSeconds += seconds
+            if self.minimumSeconds is None or seconds < self.minimumSeconds:
+                self.minimumSeconds = seconds
+            if self.maximumSeconds is None or seconds > self.maximumSeconds:
+                self.maximumSeconds = seconds
+
+    def percentile(self, fraction:float):
+        '''Upper bound of the bucket holding the given fraction of latencies (capped at the largest latency seen), or None if empty'''
+        with self.lock:
+            if not self.count:
+                return None
+            rank = fraction * self.count
+            cumulativeCount = 0
+            for bucket, bucketCount in enumerate(self.bucketCounts):
+                cumulativeCount += bucketCount
+                if cumulativeCount >= rank and bucketCount:
+                    if bucket == len(self.upperBounds):
+                        return self.maximumSeconds
+                    return min(self.upperBounds[bucket], self.maximumSeconds)
+            return self.maximumSeconds
+
+    def toDict(self):
+        buckets = [[upperBound, bucketCount] for upperBound, bucketCount in zip(self.upperBounds + [None], self.bucketCounts) if bucketCount]
+        return {"count": self.count,
+                "meanSeconds": self.totalSeconds / self.count if self.count else None,
+                "minimumSeconds": self.minimumSeconds,
+                "maximumSeconds": self.maximumSeconds,
+                "p50Seconds": self.percentile(0.5),
+                "p90Seconds": self.percentile(0.9),
+                "p99Seconds": self.percentile(0.99),
+                "buckets": buckets}
+
+
+class SampleProfile(object):
+    '''
+    Stage timings, bytes produced and event counts for one sample.  A profile is started by calculateMiq when instrumentation is
+    enabled and kept on the MiqScoreData object, which makes it the active profile while its plots and report are made.  Plots for
+    one sample can be drawn on several threads, so updates are locked.
+    '''
+
+    def __init__(self, sampleID:str=None):
+        self.sampleID = sampleID
+        self.stages = {}
+        self.counters = {}
+        self.lock = threading.Lock()
+
+    def record(self, stageName:str, seconds:float, byteCount:int=0):
+        with self.lock:
+            if not stageName in self.stages:
+                self.stages[stageName] = StageStatistics()
+            self.stages[stageName].add(seconds, byteCount)
+
+    def count(self, counterName:str, amount:int=1):
+        with self.lock:
+            self.counters[counterName] = self.counters.get(counterName, 0) + amount
+
+    def toDict(self):
+        return {"sampleID": self.sampleID,
+                "stages": {stageName: statistics.toDict() for stageName, statistics in self.stages.items()},
+                "counters": dict(self.counters)}
+
+
+class RunMetrics(object):
+    '''
+    Aggregate stage statistics over a whole run.  Every stage recorded while instrumentation is enabled is added here, and profiles
+    returned from other processes can be folded in with addProfile.
+    '''
+
+    def __init__(self):
+        self.startTime = time.time()
+        self.samples = 0
+        self.stages = {}
+        self.counters = {}
+
+    def record(self, stageName:str, seconds:float, byteCount:int=0, calls:int=1, minimumSeconds:float=None, maximumSeconds:float=None):
+        if not stageName in self.stages:
+            self.stages[stageName] = StageStatistics()
+        self.stages[stageName].add(seconds, byteCount, calls, minimumSeconds, maximumSeconds)
+
+    def count(self, counterName:str, amount:int=1):
+        self.counters[counterName] = self.counters.get(counterName, 0) + amount
+
+    def addProfile(self, profile:[SampleProfile, dict]):
+        '''Adds a sample profile (or its toDict() output, such as one sent back from a worker process) to these metrics'''
+        if isinstance(profile, SampleProfile):
+            profile = profile.toDict()
+        self.samples += 1
+        for stageName, statistics in profile["stages"].items():
+            self.record(stageName, statistics["seconds"], statistics["bytes"], statistics["calls"], statistics["minimumSeconds"], statistics["maximumSeconds"])
+        for counterName, amount in profile["counters"].items():
+            self.count(counterName, amount)
+
+    def merge(self, other):
+        self.samples += other.samples
+        for stageName, statistics in other.stages.items():
+            self.record(stageName, statistics.seconds, statistics.bytes, statistics.calls, statistics.minimumSeconds, statistics.maximumSeconds)
+        for counterName, amount in other.counters.items():
+            self.count(counterName, amount)
+        return self
+
+    def toDict(self):
+        return {"samples": self.samples,
+                "wallSeconds": time.time() - self.startTime,
+                "stages": {stageName: statistics.toDict() for stageName, statistics in self.stages.items()},
+                "counters": dict(self.counters)}
+
+    def formatTable(self):
+        lines = ["%-45s %8s %11s %11s %12s" %("Stage", "Calls", "Seconds", "Mean (ms)", "Bytes")]
+        for stageName, statistics in sorted(self.stages.items(), key=lambda item: -item[1].seconds):
+            lines.append("%-45s %8s %11.4f %11.3f %12s" %(stageName, statistics.calls, statistics.seconds, 1000 * statistics.seconds / statistics.calls, statistics.bytes))
+        for counterName, amount in sorted(self.counters.items()):
+            lines.append("%-45s %8s" %(counterName, amount))
+        return "\n".join(lines)
+
+
+class StageTimer(object):
+
+    __slots__ = ["stageName",
+                 "profile",
+                 "byteCount",
+                 "startTime"]
+
+    def __init__(self, stageName:str, profile:SampleProfile=None):
+        self.stageName = stageName
+        self.profile = profile
+        self.byteCount = 0
+        self.startTime = None
+
+    def __enter__(self):
+        self.startTime = time.perf_counter()
+        return self
+
+    def __exit__(self, exceptionType, exception, traceback):
+        seconds = time.perf_counter() - self.startTime
+        if self.profile is not None:
+            self.profile.record(self.stageName, seconds, self.byteCount)
+        runMetrics = _runMetrics
+        if runMetrics is not None:
+            with _metricsLock:
+                runMetrics.record(self.stageName, seconds, self.byteCount)
+        return False
+
+    def addBytes(self, byteCount:int):
+        self.byteCount += byteCount
+
+
+class NullStageTimer(object):
+    '''Stand-in returned while instrumentation is disabled so timed blocks cost next to nothing'''
+
+    __slots__ = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exceptionType, exception, traceback):
+        return False
+
+    def addBytes(self, byteCount:int):
+        pass
+
+
+_nullStageTimer = NullStageTimer()
+
+
+class LapTimer(object):
+    '''
+    Times consecutive stages of a function without nesting blocks: each lap(name) records the time since the previous lap as
+    stageName.name, and finish() records the whole span as stageName.  Cheaper than a with block per stage on very short calls.
+    '''
+
+    __slots__ = ["stageName",
+                 "profile",
+                 "startTime",
+                 "lapTime"]
+
+    def __init__(self, stageName:str, profile:SampleProfile=None):
+        self.stageName = stageName
+        self.profile = profile
+        self.startTime = time.perf_counter()
+        self.lapTime = self.startTime
+
+    def record(self, stageName:str, seconds:float):
+        if self.profile is not None:
+            self.profile.record(stageName, seconds)
+        runMetrics = _runMetrics
+        if runMetrics is not None:
+            with _metricsLock:
+                runMetrics.record(stageName, seconds)
+
+    def lap(self, lapName:str):
+        now = time.perf_counter()
+        self.record(self.stageName + "." + lapName, now - self.lapTime)
+        self.lapTime = now
+
+    def finish(self):
+        self.record(self.stageName, time.perf_counter() - self.startTime)
+
+
+class NullLapTimer(object):
+
+    __slots__ = []
+
+    def lap(self, lapName:str):
+        pass
+
+    def finish(self):
+        pass
+
+
+_nullLapTimer = NullLapTimer()
+
+
+class ProfileActivation(object):
+
+    __slots__ = ["profile",
+                 "previousProfile"]
+
+    def __init__(self, profile:SampleProfile):
+        self.profile = profile
+        self.previousProfile = None
+
+    def __enter__(self):
+        self.previousProfile = getattr(_localState, "profile", None)
+        _localState.profile = self.profile
+        return self.profile
+
+    def __exit__(self, exceptionType, exception, traceback):
+        _localState.profile = self.previousProfile
+        return False
+
+
+def enable(runMetrics:RunMetrics=None):
+    '''Turns instrumentation on for this process and returns the RunMetrics that will collect every stage'''
+    global enabled, _runMetrics
+    if runMetrics is None:
+        runMetrics = RunMetrics()
+    _runMetrics = runMetrics
+    enabled = True
+    return runMetrics
+
+
+def disable():
+    global enabled
+    enabled = False
+
+
+def getRunMetrics():
+    return _runMetrics
+
+
+def getCurrentProfile():
+    return getattr(_localState, "profile", None)
+
+
+def stage(stageName:str):
+    '''
+    Context manager timing a block as a stage of the current sample profile and of the run metrics.  Use addBytes on the returned
+    timer to record the size of anything the stage produced.
+    '''
+    if not enabled:
+        return _nullStageTimer
+    return StageTimer(stageName, getattr(_localState, "profile", None))
+
+
+def startLaps(stageName:str, profile:SampleProfile=None):
+    '''Returns a LapTimer for stageName recording into profile (or the current profile), or a no-op stand-in if instrumentation is disabled'''
+    if not enabled:
+        return _nullLapTimer
+    if profile is None:
+        profile = getattr(_localState, "profile", None)
+    return LapTimer(stageName, profile)
+
+
+def count(counterName:str, amount:int=1):
+    if not enabled:
+        return
+    profile = getattr(_localState, "profile", None)
+    if profile is not None:
+        profile.count(counterName, amount)
+    runMetrics = _runMetrics
+    if runMetrics is not None:
+        with _metricsLock:
+            runMetrics.count(counterName, amount)
+
+
+def startProfile(sampleID:str=None):
+    '''Returns a new SampleProfile, or None if instrumentation is disabled'''
+    if not enabled:
+        return None
+    runMetrics = _runMetrics
+    if runMetrics is not None:
+        with _metricsLock:
+            runMetrics.samples += 1
+    return SampleProfile(sampleID)
+
+
+def activateProfile(profile:SampleProfile):
+    '''Context manager making profile the one stages are recorded into on this thread'''
+    if not enabled or profile is None:
+        return _nullStageTimer
+    return ProfileActivation(profile)
+
+
+def timed(stageName:str):
+    '''Decorator timing every call of a function as a stage'''
+    import functools
+    def decorator(function):
+        @functools.wraps(function)
+        def timedFunction(*args, **kwargs):
+            if not enabled:
+                return function(*args, **kwargs)
+            with StageTimer(stageName, getattr(_localState, "profile", None)):
+                return function(*args, **kwargs)
+        return timedFunction
+    return decorator
+
+
+def profiledMethod(stageName:str):
+    '''Decorator for methods of objects with a profile attribute: activates that profile and times the call as a stage'''
+    import functools
+    def decorator(method):
+        @functools.wraps(method)
+        def profiledFunction(self, *args, **kwargs):
+            if not enabled:
+                return method(self, *args, **kwargs)
+            profile = getattr(self, "profile", None)
+            if profile is None:
+                profile = getattr(_localState, "profile", None)
+            with ProfileActivation(profile), StageTimer(stageName, profile):
+                return method(self, *args, **kwargs)
+        return profiledFunction
+    return decorator
@@ -0,0 +1,188 @@
+import numpy
+from . import instrumentation
+from . import referenceHandler
+from . import readCountMatrixOperations
+from . import scoreHistory
+
+
+class MultiTargetScorer(object):
+    '''
+    Scores samples against several (standard reference, analysis method) targets at once.  Each batch of samples is turned into a
+    count matrix once, aliases are merged once per reference (on columns, not per sample) and the expected read sources of every
+    target are gathered side by side into one stacked matrix, so percentages, percent of expected and tolerance are applied to all
+    targets in single array operations.  Scores are identical to those from a MiqScoreCalculator for each target.
+    '''
+
+    def __init__(self, standardReferences:[referenceHandler.StandardReference, list, tuple], analysisMethods:[list, tuple]=None, percentToleranceInStandard:[int, float]=0, floor:[int, float]=0):
+        '''
+        :param standardReferences: One StandardReference or a list of them
+        :param analysisMethods: Analysis methods to score against, each with every reference that has it.  Defaults to every method of every reference.
+        '''
+        if isinstance(standardReferences, referenceHandler.StandardReference):
+            standardReferences = [standardReferences]
+        self.standardReferences = list(standardReferences)
+        if not self.standardReferences:
+            raise ValueError("At least one standard reference is needed")
+        self.percentToleranceInStandard = percentToleranceInStandard
+        self.floor = floor
+        self.targets = []
+        for standardReference in self.standardReferences:
+            if analysisMethods is None:
+                referenceMethods = standardReference.analysisMethods
+            else:
+                referenceMethods = [analysisMethod for analysisMethod in analysisMethods if analysisMethod in standardReference.analysisMethods]
+            for analysisMethod in referenceMethods:
+                self.targets.append((standardReference, analysisMethod))
+        if analysisMethods is not None:
+            scoredMethods = set(target[1] for target in self.targets)
+            missingMethods = [analysisMethod for analysisMethod in analysisMethods if not analysisMethod in scoredMethods]
+            if missingMethods:
+                raise ValueError("Analysis methods %s were not found in any of the standard references" %missingMethods)
+        self.targetNames = [(scoreHistory.getReferenceName(standardReference), analysisMethod) for standardReference, analysisMethod in self.targets]
+        self.expectedReadSources = []
+        expectedPercentages = []
+        self.columnStarts = [0]
+        for standardReference, analysisMethod in self.targets:
+            compiledReference = standardReference.compiledReference
+            self.expectedReadSources.append(compiledReference.expectedReadSources(analysisMethod))
+            expectedPercentages.append(compiledReference.expectedValueVectors[analysisMethod][compiledReference.expectedReadSourceIndices[analysisMethod]])
+            self.columnStarts.append(self.columnStarts[-1] + len(self.expectedReadSources[-1]))
+        self.expectedPercentages = numpy.concatenate(expectedPercentages)  # one column per expected read source of each target, target after target
+
+    def __len__(self):
+        return len(self.targets)
+
+    @instrumentation.timed("multiTargetScorer.score")
+    def score(self, samples, readSources:[list, tuple]=None, sampleIDs:[list, tuple]=None):
+        '''
+        Scores samples against every target.  Samples are given like MiqScoreCalculator.calculateMiqBatch takes them: a samples x read
+        sources matrix of absolute counts with readSources naming the columns (aliases allowed), or an iterable of count dictionaries.
+        Returns a MultiTargetScores.
+        '''
+        if readSources is None:
+            countMatrix, readSources, columnOrders = readCountMatrixOperations.buildCountMatrixWithColumnOrders(samples, None)
+        else:
+            countMatrix = numpy.asarray(samples, dtype=numpy.float64)
+            if not countMatrix.ndim == 2 or not countMatrix.shape[1] == len(readSources):
+                raise ValueError("Count matrix must be samples x read sources with one column per read source. Got shape %s for %s read sources" %(countMatrix.shape, len(readSources)))
+            columnOrders = [range(len(readSources))] * countMatrix.shape[0]
+        if sampleIDs is None:
+            sampleIDs = [None] * countMatrix.shape[0]
+        elif not len(sampleIDs) == countMatrix.shape[0]:
+            raise ValueError("Got %s sample IDs for %s samples" %(len(sampleIDs), countMatrix.shape[0]))
+        convertedMatrices = {}
+        for standardReference in self.standardReferences:
+            if not id(standardReference) in convertedMatrices:
+                convertedMatrices[id(standardReference)] = readCountMatrixOperations.convertColumnsToStandardIdentifiers(countMatrix, readSources, standardReference)
+        referenceCounts = numpy.zeros((countMatrix.shape[0], self.columnStarts[-1]), dtype=numpy.float64)
+        for target, (standardReference, analysisMethod) in enumerate(self.targets):
+            convertedMatrix, convertedReadSources = convertedMatrices[id(standardReference)]
+            columnIndex = {readSource: column for column, readSource in enumerate(convertedReadSources)}
+            for offset, readSource in enumerate(self.expectedReadSources[target]):
+                if readSource in columnIndex:
+                    referenceCounts[:, self.columnStarts[target] + offset] = convertedMatrix[:, columnIndex[readSource]]
+        # each target's read total is summed over its own columns in the order calculateMiq would add them, then all targets are scored together
+        readSums = numpy.empty(referenceCounts.shape, dtype=numpy.float64)
+        for target, (standardReference, analysisMethod) in enumerate(self.targets):
+            start, end = self.columnStarts[target], self.columnStarts[target + 1]
+            referenceColumnOrders = readCountMatrixOperations.getReferenceColumnOrders(columnOrders, readSources, self.expectedReadSources[target], standardReference)
+            readSums[:, start:end] = readCountMatrixOperations.calculateReadSums(referenceCounts[:, start:end], referenceColumnOrders)
+        samplePercentages = numpy.zeros(referenceCounts.shape, dtype=numpy.float64)
+        numpy.divide(referenceCounts, readSums, out=samplePercentages, where=readSums != 0)
+        samplePercentages *= 100
+        samplePercentOfExpected = readCountMatrixOperations.calculateObservedPercentOfExpected(samplePercentages, self.expectedPercentages)
+        adjustedPercentErrors = readCountMatrixOperations.calculateAdjustedPercentErrors(samplePercentOfExpected, self.percentToleranceInStandard)
+        rawMiqScores = numpy.empty((countMatrix.shape[0], len(self.targets)), dtype=numpy.float64)
+        for row, rowErrors in enumerate(adjustedPercentErrors.tolist()):
+            for target in range(len(self.targets)):
+                targetErrors = rowErrors[self.columnStarts[target]:self.columnStarts[target + 1]]
+                rawMiqScores[row, target] = 100 - readCountMatrixOperations.calculateExactMean([value ** 2 for value in targetErrors]) ** 0.5
+        miqScores = readCountMatrixOperations.applyFloor(rawMiqScores, self.floor)
+        return MultiTargetScores(self, miqScores, rawMiqScores, referenceCounts, samplePercentages, samplePercentOfExpected, convertedMatrices, list(sampleIDs))
+
+    def scoreSample(self, sampleData:dict, sampleID:str=None):
+        '''Scores one sample's count dictionary against every target.  Returns a MultiTargetScores with one row.'''
+        return self.score([sampleData], sampleIDs=[sampleID])
+
+    def getTargetIndex(self, analysisMethod:str, standardReference:[str, referenceHandler.StandardReference]=None):
+        '''
+        Column of a target in the score matrices.  The reference can be left out when only one reference has the method, or given
+        as a StandardReference or the name used in targetNames.
+        '''
+        matches = []
+        for target, (targetReference, targetMethod) in enumerate(self.targets):
+            if not targetMethod == analysisMethod:
+                continue
+            if standardReference is None or standardReference is targetReference or standardReference == self.targetNames[target][0]:
+                matches.append(target)
+        if not matches:
+            raise ValueError("No target for analysis method %s and reference %s. Targets: %s" %(analysisMethod, standardReference, self.targetNames))
+        if len(matches) > 1:
+            raise ValueError("Analysis method %s is scored against several references. Choose one of %s" %(analysisMethod, [self.targetNames[target][0] for target in matches]))
+        return matches[0]
+
+
+class MultiTargetScores(object):
+    '''
+    Scores of a batch of samples against every target of a MultiTargetScorer.  miqScores and rawMiqScores are samples x targets
+    arrays with columns in the order of targetNames.  makeBatch gives the full MiqScoreBatch for any one target.
+    '''
+
+    __slots__ = ["scorer",
+                 "miqScores",
+                 "rawMiqScores",
+                 "referenceCounts",
+                 "samplePercentages",
+                 "samplePercentagesOfExpected",
+                 "convertedMatrices",
+                 "sampleIDs"]
+
+    def __init__(self, scorer:MultiTargetScorer, miqScores, rawMiqScores, referenceCounts, samplePercentages, samplePercentagesOfExpected, convertedMatrices:dict, sampleIDs:list):
+        self.scorer = scorer
+        self.miqScores = miqScores
+        self.rawMiqScores = rawMiqScores
+        self.referenceCounts = referenceCounts
+        self.samplePercentages = samplePercentages
+        self.samplePercentagesOfExpected = samplePercentagesOfExpected
+        self.convertedMatrices = convertedMatrices
+        self.sampleIDs = sampleIDs
+
+    def __len__(self):
+        return len(self.sampleIDs)
+
+    @property
+    def targetNames(self):
+        return self.scorer.targetNames
+
+    def getScores(self, analysisMethod:str, standardReference:[str, referenceHandler.StandardReference]=None):
+        '''MIQ scores of every sample for one target'''
+        return self.miqScores[:, self.scorer.getTargetIndex(analysisMethod, standardReference)]
+
+    def scoreTable(self):
+        '''
+        Returns a dictionary of sampleID:{referenceName:{analysisMethod:miqScore}} (sample index is used for samples without an ID)
+        '''
+        scoreTable = {}
+        for index, sampleID in enumerate(self.sampleIDs):
+            if sampleID is None:
+                sampleID = index
+            sampleScores = {}
+            for (referenceName, analysisMethod), miqScore in zip(self.targetNames, self.miqScores[index].tolist()):
+                if not referenceName in sampleScores:
+                    sampleScores[referenceName] = {}
+                sampleScores[referenceName][analysisMethod] = miqScore
+            scoreTable[sampleID] = sampleScores
+        return scoreTable
+
+    def makeBatch(self, analysisMethod:str, standardReference:[str, referenceHandler.StandardReference]=None):
+        '''MiqScoreBatch for one target, the same as MiqScoreCalculator.calculateMiqBatch would give for it'''
+        from . import MiqScoreBatch
+        target = self.scorer.getTargetIndex(analysisMethod, standardReference)
+        targetReference, targetMethod = self.scorer.targets[target]
+        start, end = self.scorer.columnStarts[target], self.scorer.columnStarts[target + 1]
+        expectedReadSources = self.scorer.expectedReadSources[target]
+        convertedMatrix, convertedReadSources = self.convertedMatrices[id(targetReference)]
+        expectedSet = set(expectedReadSources)
+        nonreferenceColumns = [column for column, readSource in enumerate(convertedReadSources) if not readSource in expectedSet]
+        nonreferenceReadSources = [convertedReadSources[column] for column in nonreferenceColumns]
+        return MiqScoreBatch(self.miqScores[:, target].copy(), self.rawMiqScores[:, target].copy(), expectedReadSources, self.referenceCounts[:, start:end], nonreferenceReadSources, convertedMatrix[:, nonreferenceColumns], self.samplePercentages[:, start:end], self.samplePercentagesOfExpected[:, start:end], self.scorer.percentToleranceInStandard, targetMethod, targetReference, self.sampleIDs)
@@ -1,8 +1,64 @@
 #from . import fiftyYardlinePlot
-from . import radarMaker
-from . import readFateChart
-from . import stackedBars
+import threading
+from . import plotEncoding
+from . import plotCache
+from . import plotData
+from . import svgRendering
 
-__all__ = ["radarMaker",
+_lazyModules = ("figureRendering",
+                "radarMaker",
+                "rarefactionCurve",
+                "readFateChart",
+                "stackedBars")
+_importLock = threading.RLock()  # matplotlib can not be imported by two threads at once
+
+__all__ = ["plotEncoding",
+           "figureRendering",
+           "radarMaker",
+           "rarefactionCurve",
            "readFateChart",
-           "stackedBars"]
\ No newline at end of file
+           "stackedBars",
+           "plotCache",
+           "plotData",
+           "svgRendering"]
+
+
+def useHeadlessBackend():
+    '''
+    Selects matplotlib's Agg backend before pyplot is first loaded, for callers that draw their own plots with pyplot.  The plots
+    made by this package never go through pyplot (see figureRendering).  An explicit MPLBACKEND setting or an already loaded pyplot
+    is left alone.
+    '''
+    import os
+    import sys
+    if "matplotlib.pyplot" in sys.modules or os.environ.get("MPLBACKEND"):
+        return
+    import matplotlib
+    matplotlib.use("Agg")
+
+
+def getDrawingModule(moduleName:str, format:str="png"):
+    '''
+    Module to draw a plot with in a format: svgRendering for native formats such as "nativesvg" (so matplotlib is never imported for
+    them), otherwise the named matplotlib drawing module.  svgRendering has the same plot functions as the modules it stands in for.
+    '''
+    if plotEncoding.isNativeFormat(format):
+        return svgRendering
+    return __getattr__(moduleName)
+
+
+def importPlottingModules():
+    '''Imports every plot drawing module now, such as when a worker starts, instead of on the first plot'''
+    import importlib
+    with _importLock:
+        for name in _lazyModules:
+            importlib.import_module("." + name, __name__)
+
+
+def __getattr__(name:str):
+    '''The plot drawing modules (and so matplotlib) are only imported the first time one of them is used'''
+    if name in _lazyModules:
+        import importlib
+        with _importLock:
+            return importlib.import_module("." + name, __name__)
+    raise AttributeError("module %s has no attribute %s" %(__name__, name))
@@ -0,0 +1,32 @@
+import io
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.gridspec import GridSpec
+from .. import instrumentation
+
+
+def makeFigure(figsize:tuple=None, dpi:int=300):
+    '''
+    Returns a new Figure with its own Agg canvas.  Figures made here are never registered with pyplot, so drawing and saving them
+    touches no global state and separate figures can be rendered on separate threads at the same time.
+    '''
+    figure = Figure(figsize=figsize, dpi=dpi)
+    FigureCanvasAgg(figure)
+    return figure
+
+
+def addGridSubplot(figure: Figure, shape:tuple, location:tuple, rowspan:int=1, colspan:int=1, **kwargs):
+    '''Object-oriented equivalent of pyplot.subplot2grid for a figure made by makeFigure'''
+    grid = GridSpec(shape[0], shape[1], figure=figure)
+    row, column = location
+    return figure.add_subplot(grid[row:row + rowspan, column:column + colspan], **kwargs)
+
+
+def saveFigure(figure: Figure, format:str="png", **kwargs):
+    '''Saves the figure into a new BytesIO (recorded as the plotting.savefig stage) and releases its artists'''
+    byteStream = io.BytesIO()
+    with instrumentation.stage("plotting.savefig") as timer:
+        figure.savefig(byteStream, format=format, **kwargs)
+        timer.addBytes(byteStream.tell())
+    figure.clear()
+    return byteStream
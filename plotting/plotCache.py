@@ -0,0 +1,185 @@
+import os
+from . import plotEncoding
+from .. import instrumentation
+
+plotVersion = "1"  # bump whenever plot drawing code changes so old cache entries stop matching
+_defaultPlotCache = None
+_matplotlibVersion = None
+_newFileMode = None
+
+
+def getNewFileMode():
+    '''
+    Permissions open() would give a new file under the process umask (0o666 & ~umask).  tempfile.mkstemp always makes its files
+    0600, so files written through one and moved into place get these first.  Read once per process, since reading the umask
+    means setting it.
+    '''
+    global _newFileMode
+    if _newFileMode is None:
+        umask = os.umask(0o022)
+        os.umask(umask)
+        _newFileMode = 0o666 & ~umask
+    return _newFileMode
+
+
+def makeKeyValue(value):
+    '''JSON stand-in for plot inputs json can not encode: read-only mappings (such as reference tables) as dictionaries, anything else as its repr'''
+    import collections.abc
+    if isinstance(value, collections.abc.Mapping):
+        return dict(value)
+    return repr(value)
+
+
+def getMatplotlibVersion():
+    '''Installed matplotlib version for cache keys, read from the package metadata once per process so a cache hit never has to import matplotlib'''
+    global _matplotlibVersion
+    if _matplotlibVersion is None:
+        try:
+            import importlib.metadata
+            _matplotlibVersion = importlib.metadata.version("matplotlib")
+        except ImportError:
+            # importlib.metadata is new in Python 3.8, and its PackageNotFoundError (an ImportError) covers matplotlib
+            # not being installed as a distribution, such as a source checkout on the path
+            import matplotlib
+            _matplotlibVersion = matplotlib.__version__
+    return _matplotlibVersion
+
+
+class PlotCache(object):
+    '''
+    On-disk plot cache keyed by a hash of everything that goes into a plot (data, ordering, labels, format and library versions).
+    Plots are stored as their image files, written atomically so several processes can share one cache directory, and the least
+    recently used entries are removed once the directory grows past maxBytes.
+    '''
+
+    def __init__(self, cacheDirectory:str, maxBytes:int=1024 ** 3):
+        self.cacheDirectory = cacheDirectory
+        self.maxBytes = maxBytes
+        self.estimatedBytes = None
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(cacheDirectory, exist_ok=True)
+
+    def makeKey(self, plotType:str, format:str, **plotInputs):
+        import json
+        import hashlib
+        if plotEncoding.isNativeFormat(format):
+            from . import svgRendering
+            rendererVersion = "svgRendering " + svgRendering.rendererVersion  # drawn without matplotlib
+        else:
+            rendererVersion = getMatplotlibVersion()
+        keyData = {"plotType": plotType,
+                   "format": format,
+                   "plotVersion": plotVersion,
+                   "matplotlibVersion": rendererVersion,
+                   "plotInputs": plotInputs}
+        keyString = json.dumps(keyData, default=makeKeyValue)  # not sorted, since dictionary order can change the plot
+        return hashlib.sha256(keyString.encode()).hexdigest()
+
+    def getPath(self, key:str, format:str):
+        return os.path.join(self.cacheDirectory, key[:2], "%s.%s" %(key, plotEncoding.getFileFormat(format)))
+
+    def get(self, key:str, format:str, output:str="base64"):
+        '''Returns the plot for a key as the requested output type (see plotEncoding), or None if it is not cached'''
+        path = self.getPath(key, format)
+        try:
+            file = open(path, 'rb')
+        except FileNotFoundError:
+            self.misses += 1
+            instrumentation.count("plotCache.misses")
+            return None
+        plotData = file.read()
+        file.close()
+        try:
+            os.utime(path)  # mark as recently used
+        except FileNotFoundError:
+            pass
+        self.hits += 1
+        instrumentation.count("plotCache.hits")
+        return plotEncoding.convertPlotOutput(plotData, plotEncoding.getFileFormat(format), output)
+
+    def put(self, key:str, format:str, encodedPlot:[str, bytes, plotEncoding.EncodedPlot]):
+        import tempfile
+        path = self.getPath(key, format)
+        folder = os.path.dirname(path)
+        os.makedirs(folder, exist_ok=True)
+        plotData = plotEncoding.getPlotBytes(encodedPlot)
+        fileDescriptor, temporaryPath = tempfile.mkstemp(dir=folder, prefix=".tmp")
+        try:
+            file = os.fdopen(fileDescriptor, 'wb')
+            file.write(plotData)
+            file.close()
+            os.chmod(temporaryPath, getNewFileMode())
+            os.replace(temporaryPath, path)
+        except BaseException:
+            if os.path.exists(temporaryPath):
+                os.remove(temporaryPath)
+            raise
+        if self.estimatedBytes is None:
+            self.estimatedBytes = self.calculateSize()
+        else:
+            self.estimatedBytes += len(plotData)
+        if self.estimatedBytes > self.maxBytes:
+            self.evict()
+
+    def listEntries(self):
+        entries = []
+        for folder, subfolders, fileNames in os.walk(self.cacheDirectory):
+            for fileName in fileNames:
+                if fileName.startswith(".tmp"):
+                    continue
+                path = os.path.join(folder, fileName)
+                try:
+                    fileStats = os.stat(path)
+                except FileNotFoundError:  # removed by another process
+                    continue
+                entries.append((fileStats.st_mtime, fileStats.st_size, path))
+        return entries
+
+    def calculateSize(self):
+        return sum(entry[1] for entry in self.listEntries())
+
+    def evict(self):
+        '''Removes the least recently used plots until the cache is under maxBytes'''
+        entries = sorted(self.listEntries())
+        totalBytes = sum(entry[1] for entry in entries)
+        for modificationTime, size, path in entries:
+            if totalBytes <= self.maxBytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            totalBytes -= size
+        self.estimatedBytes = totalBytes
+
+    def getOrMake(self, plotType:str, makePlot, format:str="png", output:str="base64", **plotInputs):
+        '''Returns the cached plot for these inputs, calling makePlot() and storing its result on a miss.  makePlot should return the requested output type.'''
+        key = self.makeKey(plotType, format, **plotInputs)
+        encodedPlot = self.get(key, format, output)
+        if encodedPlot is None:
+            encodedPlot = makePlot()
+            self.put(key, format, encodedPlot)
+        return encodedPlot
+
+
+def setDefaultPlotCache(plotCache:PlotCache):
+    '''Sets a process-wide plot cache used whenever a plot method is not given one. Pass None to turn it off.'''
+    global _defaultPlotCache
+    _defaultPlotCache = plotCache
+
+
+def getDefaultPlotCache():
+    '''Returns the process-wide plot cache, creating one from the MIQ_PLOT_CACHE_DIR environment variable if it is set'''
+    global _defaultPlotCache
+    if _defaultPlotCache is None and os.environ.get("MIQ_PLOT_CACHE_DIR"):
+        _defaultPlotCache = PlotCache(os.environ["MIQ_PLOT_CACHE_DIR"])
+    return _defaultPlotCache
+
+
+def makeCachedPlot(plotCache:PlotCache, plotType:str, makePlot, format:str="png", output:str="base64", **plotInputs):
+    if plotCache is None:
+        plotCache = getDefaultPlotCache()
+    if plotCache is None:
+        return makePlot()
+    return plotCache.getOrMake(plotType, makePlot, format, output, **plotInputs)
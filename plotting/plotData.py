@@ -0,0 +1,145 @@
+from math import pi
+
+
+def makePrettyForPrint(label:str):
+    label = label.replace("_like", "-like")
+    label = label.replace("_Like", "-like")
+    label = label.replace("_", " ")
+    label = list(label)
+    label[0] = label[0].upper()
+    return "".join(label)
+
+
+def orderReadFates(readFates:dict, explodeCell:[str, list] = None, explodeCellSize:float = 0.1):
+    '''
+    Read fates in pie order ("Aligned To Reference" first, then the rest as given).  Returns (print labels, explode distances, sizes).
+    '''
+    if not explodeCell:
+        explodeCell = []
+    else:
+        if type(explodeCell) == str:
+            explodeCell = [explodeCell]
+    orderedReadFateLabels = []
+    if "Aligned To Reference" in readFates:
+        orderedReadFateLabels.append("Aligned To Reference")
+    for label in readFates:
+        if not label == "Aligned To Reference":
+            orderedReadFateLabels.append(label)
+    labels = []
+    explodeCellTable = []
+    size = []
+    for label in orderedReadFateLabels:
+        labels.append(makePrettyForPrint(label))
+        if label in explodeCell:
+            explodeCellTable.append(explodeCellSize)
+        else:
+            explodeCellTable.append(0)
+        size.append(readFates[label])
+    return labels, explodeCellTable, size
+
+
+def makeTopDownList(orderedList:list):
+    reverseOrderedList = list(orderedList)[::-1]
+    topDownList = []
+    addToEnd = True
+    while reverseOrderedList:
+        itemToAdd = reverseOrderedList.pop(0)
+        if addToEnd:
+            topDownList.append(itemToAdd)
+        else:
+            topDownList.insert(0, itemToAdd)
+        addToEnd = not addToEnd
+    return topDownList
+
+
+def getSamplesAndVariables(data:dict):
+    samples = list(data.keys())
+    variables = set(data[samples[0]].keys())
+    for sample in samples:
+        if not set(data[sample].keys()) == variables:
+            raise ValueError("All samples must have the same strains present. Sample %s appears to be incorrect" %sample)
+    return (samples, variables)
+
+
+def getListOfAngles(variableCount:int):
+    angles = [angle / float(variableCount) * 2 * pi for angle in range(variableCount)]
+    angles.append(angles[0])
+    return angles
+
+
+def getRadarLabels(displayOrderedVariables:list, printNames:dict = None):
+    if printNames:
+        return [printNames[name] for name in displayOrderedVariables]
+    return list(displayOrderedVariables)
+
+
+def getStackedBarSpacing(sampleCount:int):
+    '''Empty grid cells (top, bottom, left, right) around a stacked bar plot on its 20 x 20 grid, leaving room for the sample names'''
+    if sampleCount >= 11:
+        return 0, 5, 0, 7
+    elif sampleCount >= 4:
+        return 0, 3, 1, 7
+    elif sampleCount == 3:
+        return 0, 1, 2, 7
+    else:
+        return 0, 0, 1, 7
+
+
+def getSampleNameRotation(sampleCount:int):
+    '''Rotation and horizontal alignment of the sample names under a stacked bar plot'''
+    if sampleCount >= 11:
+        return 80, 'center'
+    elif sampleCount >= 4:
+        return 40, 'right'
+    elif sampleCount == 3:
+        return 20, 'right'
+    else:
+        return 0, 'center'
+
+
+def makeStackedBarMatrix(sampleDataTable:dict, valueOrderList:[list, tuple] = (), sampleOrderList:[list, tuple] = ()):
+    '''
+    Checks the value and sample order against the data and returns (plot data matrix, value order, sample order) with one row of
+    values per sample in sample order.  Values missing from a sample are 0.
+    '''
+    taxaSpace = set()
+    for sample in sampleDataTable:
+        for taxa in sampleDataTable[sample]:
+            taxaSpace.add(taxa)
+    if not valueOrderList:
+        valueOrderList = list(taxaSpace)
+    if not sampleOrderList:
+        sampleOrderList = list(sampleDataTable.keys())
+    valueOrderSet = set(valueOrderList)
+    if not len(valueOrderSet) == len(valueOrderList):
+        raise ValueError("Value order list was given with duplicate entries. %s" %valueOrderList)
+    if not taxaSpace.issubset(valueOrderSet):
+        missingTaxa = valueOrderSet.difference(taxaSpace)
+        raise ValueError("Value order list is missing some values relative to data given.\nMissing values: %s\nValue set given: %s\nValues found in data: %s" %(missingTaxa, valueOrderList, taxaSpace))
+    sampleSpace = set(sampleDataTable.keys())
+    orderedSampleSet = set(sampleOrderList)
+    if not sampleSpace == orderedSampleSet:
+        missingSamples = sampleSpace.difference(orderedSampleSet).union(orderedSampleSet.difference(sampleSpace))
+        raise ValueError("Different samples in sample order list and provided sample names.\nMissing: %s\nGiven samples: %s\nSample order: %s" %(missingSamples, sampleSpace, sampleOrderList))
+    plotDataMatrix = []
+    for index, sample in enumerate(sampleOrderList):
+        plotDataMatrix.append([])
+        for value in valueOrderList:
+            if value in sampleDataTable[sample]:
+                plotDataMatrix[index].append(sampleDataTable[sample][value])
+            else:
+                plotDataMatrix[index].append(0)
+    return plotDataMatrix, valueOrderList, sampleOrderList
+
+
+def getPrintValueOrder(valueOrderList:[list, tuple], printNameTable:dict = None):
+    '''Print names of the values in value order (as a new list)'''
+    if printNameTable:
+        printValueOrderList = []
+        for value in valueOrderList:
+            if value in printNameTable:
+                printValueOrderList.append(printNameTable[value])
+            else:
+                printValueOrderList.append(value)
+        return printValueOrderList
+    return list(valueOrderList)
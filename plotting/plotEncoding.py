@@ -0,0 +1,162 @@
+import base64
+from .. import instrumentation
+
+outputTypes = ("base64", "bytes", "handle")
+nativeFormats = {"nativesvg": "svg"}  # formats drawn without matplotlib (see svgRendering) and the file format they produce
+mimeTypes = {"svg": "image/svg+xml", "jpg": "image/jpeg"}
+
+
+def isNativeFormat(format:str):
+    return format.lower() in nativeFormats
+
+
+def getFileFormat(format:str):
+    '''File format (and extension) of plots drawn in a format, so "nativesvg" plots are "svg"'''
+    return nativeFormats.get(format.lower(), format)
+
+
+def getMimeType(format:str):
+    format = getFileFormat(format)
+    return mimeTypes.get(format, "image/" + format)
+
+
+def getPlotFormat(plot):
+    '''File format of a plot given as an EncodedPlot, raw bytes or base64 string when it can be told (SVG text, PNG, JPEG), otherwise None'''
+    if isinstance(plot, EncodedPlot):
+        return getFileFormat(plot.format)
+    if isinstance(plot, str):
+        try:
+            plot = base64.b64decode(plot[:8])
+        except ValueError:  # not a base64 plot
+            return None
+    header = bytes(plot[:8])
+    if header.startswith(b"<"):
+        return "svg"
+    if header.startswith(b"\x89PNG"):
+        return "png"
+    if header.startswith(b"\xff\xd8"):
+        return "jpg"
+    return None
+
+
+class EncodedPlot(object):
+    '''
+    Holds a rendered plot's raw image bytes and only base64 encodes them when asked.  str() gives the base64 text (encoded again on
+    every call and not kept), and iterateBase64Chunks and writeBase64 stream the encoding in chunks so a report or JSON writer never
+    needs a full base64 copy of the plot.  Handles compare and hash by their image bytes.
+    '''
+
+    __slots__ = ["plotBytes",
+                 "format"]
+
+    chunkSize = 3 * 65536  # a multiple of 3 so chunks encode without padding
+
+    def __init__(self, plotBytes:bytes, format:str="png"):
+        self.plotBytes = plotBytes
+        self.format = format
+
+    def __str__(self):
+        with instrumentation.stage("plotEncoding.base64") as timer:
+            base64Text = base64.b64encode(self.plotBytes).decode('ascii')
+            timer.addBytes(len(base64Text))
+        return base64Text
+
+    def __len__(self):
+        return len(self.plotBytes)
+
+    def __eq__(self, other):
+        if isinstance(other, EncodedPlot):
+            return self.plotBytes == other.plotBytes
+        return NotImplemented
+
+    def __hash__(self):
+        return hash(bytes(self.plotBytes))
+
+    def iterateBase64Chunks(self):
+        plotBytes = memoryview(self.plotBytes)
+        for start in range(0, len(plotBytes), self.chunkSize):
+            yield base64.b64encode(plotBytes[start:start + self.chunkSize]).decode('ascii')
+
+    def writeBase64(self, stream):
+        for chunk in self.iterateBase64Chunks():
+            stream.write(chunk)
+
+    def decode(self):
+        '''Same as str(), so code written for base64 strings from bytes.decode() keeps working'''
+        return str(self)
+
+
+def encodePlotOutput(byteStream, format:str="png", output:str="base64"):
+    '''
+    Turns a BytesIO that a figure was saved into the requested output without extra copies of the image:
+    "base64" for a base64 string, "bytes" for the raw image, or "handle" for an EncodedPlot that encodes lazily.
+    '''
+    if output == "base64":
+        with instrumentation.stage("plotEncoding.base64") as timer:
+            encodedPlot = base64.b64encode(byteStream.getbuffer()).decode('ascii')
+            timer.addBytes(len(encodedPlot))
+        return encodedPlot
+    if output == "bytes":
+        return byteStream.getvalue()
+    if output == "handle":
+        return EncodedPlot(byteStream.getvalue(), format)
+    raise ValueError("Plot output must be one of %s. Got %s" %(outputTypes, output))
+
+
+def getPlotBytes(plot:[str, bytes, EncodedPlot]):
+    '''Raw image bytes from any of the plot output types'''
+    if isinstance(plot, EncodedPlot):
+        return plot.plotBytes
+    if isinstance(plot, (bytes, bytearray, memoryview)):
+        return bytes(plot)
+    return base64.b64decode(plot)
+
+
+def convertPlotOutput(plotBytes:bytes, format:str="png", output:str="base64"):
+    '''Converts raw image bytes into one of the plot output types'''
+    if output == "base64":
+        return base64.b64encode(plotBytes).decode('ascii')
+    if output == "bytes":
+        return plotBytes
+    if output == "handle":
+        return EncodedPlot(plotBytes, format)
+    raise ValueError("Plot output must be one of %s. Got %s" %(outputTypes, output))
+
+
+def iterateJSONChunks(value, indent:int=None):
+    '''
+    Same text as json.dumps(value, indent=indent, default=convertToJSONValue), in chunks.  Plots given as raw bytes or EncodedPlot
+    handles are left out of the dump as placeholders and written in their place from iterateBase64Chunks, so no plot's full base64
+    text is ever built.
+    '''
+    import json
+    import re
+    import uuid
+    marker = uuid.uuid4().hex
+    plots = []
+
+    def makePlaceholder(plot):
+        if isinstance(plot, (bytes, bytearray, memoryview)):
+            plot = EncodedPlot(plot)
+        if not isinstance(plot, EncodedPlot):
+            raise TypeError("Object of type %s is not JSON serializable" %type(plot).__name__)
+        plots.append(plot)
+        return "%s:%s" %(marker, len(plots) - 1)
+
+    text = json.dumps(value, indent=indent, default=makePlaceholder)
+    position = 0
+    for placeholder in re.finditer('"%s:([0-9]+)"' %marker, text):
+        yield text[position:placeholder.start()] + '"'
+        yield from plots[int(placeholder.group(1))].iterateBase64Chunks()  # base64 text needs no JSON escaping
+        yield '"'
+        position = placeholder.end()
+    yield text[position:]
+
+
+def convertToJSONValue(value):
+    '''json.dumps default for plots that are not base64 strings yet'''
+    if isinstance(value, EncodedPlot):
+        return str(value)
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return base64.b64encode(value).decode('ascii')
+    raise TypeError("Object of type %s is not JSON serializable" %type(value).__name__)
@@ -1,59 +1,36 @@
-import matplotlib.pyplot as plt
+import threading
 from math import pi
 import matplotlib.patches
-
-
-def makeTopDownList(orderedList:list):
-    reverseOrderedList = orderedList[::-1]
-    topDownList = []
-    addToEnd = True
-    while reverseOrderedList:
-        itemToAdd = reverseOrderedList.pop(0)
-        if addToEnd:
-            topDownList.append(itemToAdd)
-        else:
-            topDownList.insert(0, itemToAdd)
-        addToEnd = not addToEnd
-    return topDownList
-
-
-def getSamplesAndVariables(data:dict):
-    samples = list(data.keys())
-    variables = set(data[samples[0]].keys())
-    for sample in samples:
-        if not set(data[sample].keys()) == variables:
-            raise ValueError("All samples must have the same strains present. Sample %s appears to be incorrect" %sample)
-    return (samples, variables)
-
-
-def getListOfAngles(variableCount:int):
-    angles = [angle / float(variableCount) * 2 * pi for angle in range(variableCount)]
-    angles.append(angles[0])
-    return angles
-
-
-def makeRadarPlot(data:dict, dataRankOrder:list, orderedFeature:str, topHigh = True, sampleRestriction = None, titleAppend="", format:str="png", printNames:dict = None):
-    import io
-    import base64
-    plt.figure(dpi=300)
+from . import plotEncoding
+from . import figureRendering
+from .plotData import makeTopDownList, getSamplesAndVariables, getListOfAngles, getRadarLabels
+from .. import instrumentation
+
+
+@instrumentation.timed("plotting.radarPlot")
+def makeRadarPlot(data:dict, dataRankOrder:list, orderedFeature:str, topHigh = True, sampleRestriction = None, titleAppend="", format:str="png", printNames:dict = None, output:str="base64"):
+    if plotEncoding.isNativeFormat(format):
+        from . import svgRendering
+        return svgRendering.makeRadarPlot(data, dataRankOrder, orderedFeature, topHigh, sampleRestriction, titleAppend, format, printNames, output)
+    figure = figureRendering.makeFigure(dpi=300)
     #Setting up the triangle plot on the left
-    trianglePlotAxes = plt.subplot2grid((4, 5), (0, 0), rowspan = 4)
-    plt.xlim(0, 1.5)
-    plt.ylim(0, 5)
+    trianglePlotAxes = figureRendering.addGridSubplot(figure, (4, 5), (0, 0), rowspan = 4)
+    trianglePlotAxes.set_xlim(0, 1.5)
+    trianglePlotAxes.set_ylim(0, 5)
     topHighTriangle = ((0,0), (0,5), (1,5))
     bottomHighTriangle = ((0,0), (0,5), (1,0))
     if topHigh:
         triangleCoordinates = topHighTriangle
     else:
         triangleCoordinates = bottomHighTriangle
-    triangle = plt.Polygon(triangleCoordinates, color=(0, 1, 0))
-    plt.gca().add_patch(triangle)
+    triangle = matplotlib.patches.Polygon(triangleCoordinates, color=(0, 1, 0))
+    trianglePlotAxes.add_patch(triangle)
     trianglePlotAxes.set_title(" " + orderedFeature)
     trianglePlotAxes.axis('off')
 
 
     #Setting up radar plot on the right (starting with the background)
-    radarPlotAxes = plt.subplot2grid((4, 5), (0, 1), rowspan = 4, colspan = 4, polar = True)
+    radarPlotAxes = figureRendering.addGridSubplot(figure, (4, 5), (0, 1), rowspan = 4, colspan = 4, polar = True)
     samples, variables = getSamplesAndVariables(data)
     for variable in dataRankOrder:
         if not variable in variables:
@@ -67,13 +44,15 @@ def makeRadarPlot(data:dict, dataRankOrder:list, orderedFeature:str, topHigh = T
     radarPlotAxes.set_theta_direction(-1)
 
     # Draw one axis per variable and add labels to them
-    plt.xticks(angles[:-1], list(data)[1:])
+    radarPlotAxes.set_xticks(angles[:-1])
+    radarPlotAxes.set_xticklabels(list(data)[1:])
 
     # Setup our y-values and axes
     radialAxes = [0, 50, 100, 150, 200]
     radarPlotAxes.set_rlabel_position(0)
-    plt.yticks(radialAxes, [str(mark) for mark in radialAxes], color="grey", size=7)
-    plt.ylim(min(radialAxes), max(radialAxes))
+    radarPlotAxes.set_yticks(radialAxes)
+    radarPlotAxes.set_yticklabels([str(mark) for mark in radialAxes], color="grey", size=7)
+    radarPlotAxes.set_ylim(min(radialAxes), max(radialAxes))
 
     # Make a dark circle around the 100% axis to mark our target value
     targetCircleResolution = 720 #number of points to use in drawing the circle
@@ -101,13 +80,7 @@ def makeRadarPlot(data:dict, dataRankOrder:list, orderedFeature:str, topHigh = T
         values.append(values[0])
         radarPlotAxes.plot(angles, values, linewidth=1, linestyle='solid', label=sample)
         radarPlotAxes.fill(angles, values, 'b', alpha=0.1)
-    if printNames:
-        xTickList = []
-        for name in displayOrderedVariables:
-            xTickList.append(printNames[name])
-    else:
-        xTickList = displayOrderedVariables
-    radarPlotAxes.set_xticklabels(xTickList)
+    radarPlotAxes.set_xticklabels(getRadarLabels(displayOrderedVariables, printNames))
     if displayedSamples:
         if len(displayedSamples) > 1:
             legend = radarPlotAxes.legend(displayedSamples)
@@ -116,12 +89,154 @@ def makeRadarPlot(data:dict, dataRankOrder:list, orderedFeature:str, topHigh = T
             if titleAppend:
                 title += " " + titleAppend
             radarPlotAxes.set_title(title)
-    plt.tight_layout()
-    byteStream = io.BytesIO()
-    plt.savefig(byteStream, format=format, bbox_extra_artists=radarPlotAxes)
-    byteStream.seek(0)
-    encodedImage = base64.b64encode(byteStream.read())
-    plt.clf()
-    plt.close()
-    return encodedImage.decode()
-
+    with instrumentation.stage("plotting.layout"):
+        figure.tight_layout()
+    byteStream = figureRendering.saveFigure(figure, format, bbox_extra_artists=radarPlotAxes)
+    return plotEncoding.encodePlotOutput(byteStream, format, output)
+
+
+
+class RadarPlotRenderer(object):
+    '''
+    Renders single-sample radar plots from reusable figure templates.  The triangle, polar grid, labels and 100% target circle are
+    set up, laid out and rasterized once for each (ordered feature, direction, variable labels) combination, and each sample only
+    blits its polygon and title over a copy of that background.  The layout is fixed when the template is made (with a one line
+    placeholder title), so a title too wide for the figure runs past its edge instead of shrinking the plot, and the sample's fill
+    is drawn over the grid rather than under it; otherwise the output matches makeRadarPlot's.  Only PNG is blitted, other formats
+    are drawn by makeRadarPlot.  At most maxTemplates templates (each a dpi-sized figure and its background) are kept, least recently
+    used first out.  Templates are reused between calls, so a renderer should only be used from one thread at a time.
+    '''
+
+    blitFormats = ("png",)
+
+    def __init__(self, dpi:int=300, maxTemplates:int=4):
+        self.dpi = dpi
+        self.maxTemplates = maxTemplates
+        self.templates = {}
+
+    def getTemplate(self, orderedFeature:str, topHigh:bool, xTickLabels:tuple):
+        templateKey = (orderedFeature, topHigh, xTickLabels)
+        template = self.templates.pop(templateKey, None)
+        if template is None:
+            with instrumentation.stage("plotting.radarTemplate"):
+                template = self.makeTemplate(orderedFeature, topHigh, xTickLabels)
+            while self.templates and len(self.templates) >= self.maxTemplates:
+                del self.templates[next(iter(self.templates))]
+        self.templates[templateKey] = template  # reinserted so the dictionary stays in least recently used order
+        return template
+
+    def makeTemplate(self, orderedFeature:str, topHigh:bool, xTickLabels:tuple):
+        figure = figureRendering.makeFigure(dpi=self.dpi)
+        trianglePlotAxes = figureRendering.addGridSubplot(figure, (4, 5), (0, 0), rowspan = 4)
+        trianglePlotAxes.set_xlim(0, 1.5)
+        trianglePlotAxes.set_ylim(0, 5)
+        if topHigh:
+            triangleCoordinates = ((0,0), (0,5), (1,5))
+        else:
+            triangleCoordinates = ((0,0), (0,5), (1,0))
+        trianglePlotAxes.add_patch(matplotlib.patches.Polygon(triangleCoordinates, color=(0, 1, 0)))
+        trianglePlotAxes.set_title(" " + orderedFeature)
+        trianglePlotAxes.axis('off')
+        radarPlotAxes = figureRendering.addGridSubplot(figure, (4, 5), (0, 1), rowspan = 4, colspan = 4, polar=True)
+        angles = getListOfAngles(len(xTickLabels))
+        radarPlotAxes.set_theta_offset(pi / 2)
+        radarPlotAxes.set_theta_direction(-1)
+        radarPlotAxes.set_xticks(angles[:-1])
+        radarPlotAxes.set_xticklabels(xTickLabels)
+        radialAxes = [0, 50, 100, 150, 200]
+        radarPlotAxes.set_rlabel_position(0)
+        radarPlotAxes.set_yticks(radialAxes)
+        radarPlotAxes.set_yticklabels([str(mark) for mark in radialAxes], color="grey", size=7)
+        radarPlotAxes.set_ylim(min(radialAxes), max(radialAxes))
+        targetCircleResolution = 720
+        radarPlotAxes.plot(getListOfAngles(targetCircleResolution), [100] * (targetCircleResolution + 1), 'k-', linewidth = 2)
+        sampleLine = radarPlotAxes.plot(angles, [0] * len(angles), linewidth=1, linestyle='solid', color="C0")[0]
+        sampleFill = radarPlotAxes.fill(angles, [0] * len(angles), 'b', alpha=0.1)[0]
+        title = radarPlotAxes.set_title("Sample")
+        with instrumentation.stage("plotting.layout"):
+            figure.tight_layout()
+        dynamicArtists = (sampleFill, sampleLine, title)
+        # animated artists are left out of a full draw, so the background is everything but the sample
+        for artist in dynamicArtists:
+            artist.set_animated(True)
+        figure.canvas.draw()
+        return {"figure": figure,
+                "angles": angles,
+                "dynamicArtists": dynamicArtists,
+                "background": figure.canvas.copy_from_bbox(figure.bbox)}
+
+    def render(self, sampleName:str, values:dict, dataRankOrder:list, orderedFeature:str, topHigh:bool=True, titleAppend:str="", format:str="png", printNames:dict=None, output:str="base64"):
+        import io
+        import numpy
+        import matplotlib.image
+        for variable in dataRankOrder:
+            if not variable in values:
+                raise ValueError("Got a variable in the rank order that is missing from the data: %s" %variable)
+        if not len(values) == len(dataRankOrder):
+            raise ValueError("Rank order has %s variables but the data has %s" %(len(dataRankOrder), len(values)))
+        if not format.lower() in self.blitFormats:
+            return makeRadarPlot({sampleName: values}, dataRankOrder, orderedFeature, topHigh, titleAppend=titleAppend, format=format, printNames=printNames, output=output)
+        displayOrderedVariables = makeTopDownList(dataRankOrder)
+        xTickLabels = tuple(getRadarLabels(displayOrderedVariables, printNames))
+        template = self.getTemplate(orderedFeature, topHigh, xTickLabels)
+        canvas = template["figure"].canvas
+        angles = template["angles"]
+        sampleFill, sampleLine, title = template["dynamicArtists"]
+        plotValues = [values[variable] for variable in displayOrderedVariables]
+        plotValues.append(plotValues[0])
+        sampleLine.set_data(angles, plotValues)
+        sampleFill.set_xy(list(zip(angles, plotValues)))
+        if titleAppend:
+            title.set_text(sampleName + " " + titleAppend)
+        else:
+            title.set_text(sampleName)
+        canvas.restore_region(template["background"])
+        renderer = canvas.get_renderer()
+        for artist in template["dynamicArtists"]:
+            artist.draw(renderer)
+        byteStream = io.BytesIO()
+        with instrumentation.stage("plotting.savefig") as timer:
+            width, height = canvas.get_width_height()
+            image = numpy.frombuffer(canvas.buffer_rgba(), dtype=numpy.uint8).reshape(height, width, 4)
+            matplotlib.image.imsave(byteStream, image, format=format, dpi=self.dpi)
+            timer.addBytes(byteStream.tell())
+        return plotEncoding.encodePlotOutput(byteStream, format, output)
+
+
+maxIdleRenderers = 4
+_idleRenderers = []
+_idleRenderersLock = threading.Lock()
+
+
+def takeRadarPlotRenderer():
+    '''Takes an idle RadarPlotRenderer from the shared pool (or makes a new one) for the calling thread to use on its own'''
+    with _idleRenderersLock:
+        if _idleRenderers:
+            return _idleRenderers.pop()
+    return RadarPlotRenderer()
+
+
+def returnRadarPlotRenderer(renderer: RadarPlotRenderer):
+    '''Puts a renderer back in the shared pool, or drops it (and its figures) if maxIdleRenderers are already waiting there'''
+    with _idleRenderersLock:
+        if len(_idleRenderers) < maxIdleRenderers:
+            _idleRenderers.append(renderer)
+
+
+def releaseRadarPlotRenderers():
+    '''Drops every idle renderer in the shared pool so their figures can be freed, for example once a batch of plots is done'''
+    with _idleRenderersLock:
+        _idleRenderers.clear()
+
+
+@instrumentation.timed("plotting.singleSampleRadarPlot")
+def makeSingleSampleRadarPlot(sampleName:str, values:dict, dataRankOrder:list, orderedFeature:str, topHigh = True, titleAppend="", format:str="png", printNames:dict = None, output:str="base64"):
+    '''makeRadarPlot({sampleName: values}, ...) blitted from a cached figure template (see RadarPlotRenderer for the differences)'''
+    if plotEncoding.isNativeFormat(format):
+        from . import svgRendering
+        return svgRendering.makeSingleSampleRadarPlot(sampleName, values, dataRankOrder, orderedFeature, topHigh, titleAppend, format, printNames, output)
+    renderer = takeRadarPlotRenderer()
+    try:
+        return renderer.render(sampleName, values, dataRankOrder, orderedFeature, topHigh, titleAppend, format, printNames, output)
+    finally:
+        returnRadarPlotRenderer(renderer)
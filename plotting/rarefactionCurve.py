@@ -0,0 +1,34 @@
+from . import plotEncoding
+from . import figureRendering
+from .. import instrumentation
+
+
+@instrumentation.timed("plotting.rarefactionCurve")
+def makeRarefactionCurve(depths:list, meanScores:list, lowerScores:list, upperScores:list, fullDepthScore:float=None, stableDepth:int=None, sampleID:str=None, confidenceLevel:float=0.95, format:str="png", output:str="base64"):
+    '''
+    Draws expected MIQ score against read depth with the confidence band around it.  The full depth score is drawn as a dashed
+    line and the depth at which the score becomes stable, if there is one, as a dotted line.
+    :return: base-64 encoded string of the image (or the requested output type, see plotEncoding)
+    '''
+    figure = figureRendering.makeFigure(figsize=(7,5), dpi=300)
+    axes = figure.add_subplot(1, 1, 1)
+    axes.fill_between(depths, lowerScores, upperScores, color="b", alpha=0.2, linewidth=0, label="%.0f%% of subsamples" %(confidenceLevel * 100))
+    axes.plot(depths, meanScores, "b-", marker="o", markersize=3, linewidth=1.5, label="Mean MIQ score")
+    if fullDepthScore is not None:
+        axes.axhline(fullDepthScore, color="k", linestyle="--", linewidth=1, label="Full depth (%.1f)" %fullDepthScore)
+    if stableDepth is not None:
+        axes.axvline(stableDepth, color="g", linestyle=":", linewidth=1.5, label="Stable from %s reads" %stableDepth)
+    if len(depths) > 1 and depths[-1] >= 10 * depths[0]:
+        axes.set_xscale("log")
+    axes.set_ylim(0, 100)
+    axes.set_xlabel("Reads")
+    axes.set_ylabel("MIQ Score")
+    if sampleID:
+        axes.set_title("%s MIQ SCORE BY READ DEPTH" %sampleID)
+    else:
+        axes.set_title("MIQ SCORE BY READ DEPTH")
+    axes.legend(loc="lower right")
+    with instrumentation.stage("plotting.layout"):
+        figure.tight_layout()
+    byteStream = figureRendering.saveFigure(figure, format)
+    return plotEncoding.encodePlotOutput(byteStream, format, output)
@@ -1,76 +1,37 @@
-import matplotlib.pyplot as canvas
-import io
-import base64
+from . import plotEncoding
+from . import figureRendering
+from . import plotData
+from .. import instrumentation
 
-def makeStackedBar(sampleDataTable:dict, valueOrderList:[list, tuple] = (), sampleOrderList:[list, tuple] = (), sampleName:str = "", format:str = "png", printNameTable:dict = None):
+@instrumentation.timed("plotting.stackedBar")
+def makeStackedBar(sampleDataTable:dict, valueOrderList:[list, tuple] = (), sampleOrderList:[list, tuple] = (), sampleName:str = "", format:str = "png", printNameTable:dict = None, output:str = "base64"):
     '''
     :param sampleDataTable: Expecting a dictionary where keys are sample names and values are dictionaries of taxa:proportion
     :param valueOrderList:  How to order the values when plotting for consistency between plots
     :param sampleOrderList: How to order the samples from left to right
-    :return: base-64 encoded string of the image
+    :param output: "base64" for a base-64 encoded string, "bytes" for the raw image or "handle" for a lazily encoded EncodedPlot
+    :return: base-64 encoded string of the image (or the requested output type)
     '''
-    canvas.figure(figsize=(7,5), dpi=300)
-    if len(sampleDataTable) >= 11:
-        topSpace = 0
-        bottomSpace = 5
-        leftSpace = 0
-        rightSpace = 7
-    elif len(sampleDataTable) >= 4:
-        topSpace = 0
-        bottomSpace = 3
-        leftSpace = 1
-        rightSpace = 7
-    elif len(sampleDataTable) == 3:
-        topSpace = 0
-        bottomSpace = 1
-        leftSpace = 2
-        rightSpace = 7
-    else:
-        topSpace = 0
-        bottomSpace = 0
-        leftSpace = 1
-        rightSpace = 7
+    if plotEncoding.isNativeFormat(format):
+        from . import svgRendering
+        return svgRendering.makeStackedBar(sampleDataTable, valueOrderList, sampleOrderList, sampleName, format, printNameTable, output)
+    figure = figureRendering.makeFigure(figsize=(7,5), dpi=300)
+    topSpace, bottomSpace, leftSpace, rightSpace = plotData.getStackedBarSpacing(len(sampleDataTable))
     if leftSpace:
-        leftVertBar = canvas.subplot2grid((20, 20), (0, 0), rowspan=20, colspan= leftSpace)
+        leftVertBar = figureRendering.addGridSubplot(figure, (20, 20), (0, 0), rowspan=20, colspan= leftSpace)
         leftVertBar.axis('off')
     if rightSpace:
-        rightVertBar = canvas.subplot2grid((20, 20), (0, 20 - rightSpace), rowspan=20, colspan= rightSpace)
+        rightVertBar = figureRendering.addGridSubplot(figure, (20, 20), (0, 20 - rightSpace), rowspan=20, colspan= rightSpace)
         rightVertBar.axis('off')
     if topSpace:
-        topHorizBar = canvas.subplot2grid((20, 20), (0, leftSpace), rowspan=topSpace, colspan = 20 - leftSpace - rightSpace)
+        topHorizBar = figureRendering.addGridSubplot(figure, (20, 20), (0, leftSpace), rowspan=topSpace, colspan = 20 - leftSpace - rightSpace)
         topHorizBar.axis('off')
     if bottomSpace:
-        bottomHorizBar = canvas.subplot2grid((20, 20), (20 - bottomSpace, leftSpace), rowspan= bottomSpace, colspan = 20 - leftSpace - rightSpace)
+        bottomHorizBar = figureRendering.addGridSubplot(figure, (20, 20), (20 - bottomSpace, leftSpace), rowspan= bottomSpace, colspan = 20 - leftSpace - rightSpace)
         bottomHorizBar.axis('off')
-    plt = canvas.subplot2grid((20, 20), (topSpace, leftSpace), rowspan = 20 - topSpace - bottomSpace, colspan = 20 - leftSpace - rightSpace)
+    axes = figureRendering.addGridSubplot(figure, (20, 20), (topSpace, leftSpace), rowspan = 20 - topSpace - bottomSpace, colspan = 20 - leftSpace - rightSpace)
 
-    taxaSpace = set()
-    for sample in sampleDataTable:
-        for taxa in sampleDataTable[sample]:
-            taxaSpace.add(taxa)
-    if not valueOrderList:
-        valueOrderList = list(taxaSpace)
-    if not sampleOrderList:
-        sampleOrderList = list(sampleDataTable.keys())
-    valueOrderSet = set(valueOrderList)
-    if not len(valueOrderSet) == len(valueOrderList):
-        raise ValueError("Value order list was given with duplicate entries. %s" %valueOrderList)
-    if not taxaSpace.issubset(valueOrderSet):
-        missingTaxa = valueOrderSet.difference(taxaSpace)
-        raise ValueError("Value order list is missing some values relative to data given.\nMissing values: %s\nValue set given: %s\nValues found in data: %s" %(missingTaxa, valueOrderList, taxaSpace))
-    sampleSpace = set(sampleDataTable.keys())
-    orderedSampleSet = set(sampleOrderList)
-    if not sampleSpace == orderedSampleSet:
-        missingSamples = sampleSpace.difference(orderedSampleSet).union(orderedSampleSet.difference(sampleSpace))
-        raise ValueError("Different samples in sample order list and provided sample names.\nMissing: %s\nGiven samples: %s\nSample order: %s" %(missingSamples, sampleSpace, sampleOrderList))
-    plotDataMatrix = []
-    for index, sample in enumerate(sampleOrderList):
-        plotDataMatrix.append([])
-        for value in valueOrderList:
-            if value in sampleDataTable[sample]:
-                plotDataMatrix[index].append(sampleDataTable[sample][value])
-            else:
-                plotDataMatrix[index].append(0)
+    plotDataMatrix, valueOrderList, sampleOrderList = plotData.makeStackedBarMatrix(sampleDataTable, valueOrderList, sampleOrderList)
     plotBarInfo = []
     width = 0.5
     for index, data in enumerate(plotDataMatrix):
@@ -78,48 +39,119 @@ def makeStackedBar(sampleDataTable:dict, valueOrderList:[list, tuple] = (), samp
         for colorIndex, element in enumerate(data):
             if index == 0:
                 plotBarInfo.append(
-                    plt.bar(index, element, width, bottom=bottomValue)
+                    axes.bar(index, element, width, bottom=bottomValue)
                 )
             else:
-                plt.bar(index, element, width, bottom=bottomValue, color = plotBarInfo[colorIndex][0]._facecolor)
+                axes.bar(index, element, width, bottom=bottomValue, color = plotBarInfo[colorIndex][0].get_facecolor())
             bottomValue += element
-    plt.set_ylabel("Relative Abundance (%)")
+    axes.set_ylabel("Relative Abundance (%)")
     if sampleName:
-        plt.set_title(sampleName)
-    plt.set_yticks(range(0, 101, 10))
-    plt.set_xticks(range(len(sampleOrderList)))
-    if len(sampleOrderList) >= 11:
-        rotation = 80
-        alignment = 'center'
-    elif len(sampleOrderList) >= 4:
-        rotation = 40
-        alignment = 'right'
-    elif len(sampleOrderList) == 3:
-        rotation = 20
-        alignment = 'right'
-    else:
-        rotation = 0
-        alignment = 'center'
-    plt.set_xticklabels(sampleOrderList, rotation=rotation, ha=alignment)
+        axes.set_title(sampleName)
+    axes.set_yticks(range(0, 101, 10))
+    axes.set_xticks(range(len(sampleOrderList)))
+    rotation, alignment = plotData.getSampleNameRotation(len(sampleOrderList))
+    axes.set_xticklabels(sampleOrderList, rotation=rotation, ha=alignment)
     orderedColorList = [barInfo[0] for barInfo in plotBarInfo]
-    if printNameTable:
-        printValueOrderList = []
-        for value in valueOrderList:
-            if value in printNameTable:
-                printValueOrderList.append(printNameTable[value])
-            else:
-                printValueOrderList.append(value)
-    else:
-        printValueOrderList = valueOrderList
+    printValueOrderList = plotData.getPrintValueOrder(valueOrderList, printNameTable)
     printValueOrderList.reverse()
     orderedColorList.reverse()
-    plt.legend(orderedColorList, printValueOrderList, loc='center left', bbox_to_anchor=(1, 0.5))
-    #canvas.tight_layout()
-    byteStream = io.BytesIO()
-    canvas.savefig(byteStream, format=format)
-    byteStream.seek(0)
-    encodedImage = base64.b64encode(byteStream.read())
-    canvas.clf()
-    plt.clear()
-    canvas.close()
-    return encodedImage.decode()
+    axes.legend(orderedColorList, printValueOrderList, loc='center left', bbox_to_anchor=(1, 0.5))
+    #figure.tight_layout()
+    byteStream = figureRendering.saveFigure(figure, format)
+    return plotEncoding.encodePlotOutput(byteStream, format, output)
+
+
+defaultPalette = ("#1f77b4", "#ff7f0e", "#2ca02c", "#d62728", "#9467bd", "#8c564b", "#e377c2", "#7f7f7f", "#bcbd22", "#17becf",
+                  "#aec7e8", "#ffbb78", "#98df8a", "#ff9896", "#c5b0d5", "#c49c94", "#f7b6d2", "#c7c7c7", "#dbdb8d", "#9edae5")
+
+
+def makeTaxonColorTable(standardReference, sortingName:str="Lysis Difficulty", palette:[list, tuple]=defaultPalette):
+    '''
+    Returns a dictionary of readSource:color that stays the same for every plot made from a standard reference: colors follow the
+    order of read sources in one of the reference's sortings (then any other read sources in the reference) around the palette.
+    '''
+    orderedReadSources = list(standardReference.sortings[sortingName][1])
+    for readSource in standardReference.compiledReference.readSourceIDs:
+        if not readSource in orderedReadSources:
+            orderedReadSources.append(readSource)
+    return {readSource: palette[index % len(palette)] for index, readSource in enumerate(orderedReadSources)}
+
+
+@instrumentation.timed("plotting.runCompositionPlot")
+def makeRunCompositionPlots(percentageMatrix, sampleNames:[list, tuple], valueNames:[list, tuple], title:str = "", samplesPerPage:int = 96, format:str = "png", printNameTable:dict = None, colorTable:dict = None, referencePercentages:[list, tuple] = None, referenceName:str = "Theoretical", output:str = "base64"):
+    '''
+    Run-level composition plot for many samples.  Each taxon is drawn as a single collection of rectangles built from the cumulative
+    sum of the percentage matrix, so drawing time grows with the number of taxa rather than the number of samples x taxa cells.
+    Samples are split into pages of at most samplesPerPage bars.
+    :param percentageMatrix: samples x values array (or nested lists) of relative abundance in percent
+    :param sampleNames: Name of each row, in plotting order from left to right
+    :param valueNames: Name of each column, stacked from the bottom up
+    :param colorTable: Dictionary of value:color (see makeTaxonColorTable) so colors are stable between plots.  Values without a color are grey.
+    :param referencePercentages: Optional row of percentages (such as the expected composition) drawn as the first bar of every page
+    :return: list with one plot per page, each as the requested output type (see plotEncoding)
+    '''
+    import numpy
+    from matplotlib.collections import PolyCollection
+    from matplotlib.patches import Patch
+    percentageMatrix = numpy.asarray(percentageMatrix, dtype=numpy.float64)
+    if not percentageMatrix.ndim == 2 or not percentageMatrix.shape == (len(sampleNames), len(valueNames)):
+        raise ValueError("Percentage matrix must be samples x values. Got shape %s for %s samples and %s values" %(numpy.shape(percentageMatrix), len(sampleNames), len(valueNames)))
+    if referencePercentages is not None:
+        referencePercentages = numpy.asarray(referencePercentages, dtype=numpy.float64).reshape(1, len(valueNames))
+    if samplesPerPage < 1:
+        raise ValueError("Samples per page must be at least 1. Got %s" %samplesPerPage)
+    if not colorTable:
+        colorTable = {value: defaultPalette[index % len(defaultPalette)] for index, value in enumerate(valueNames)}
+    printNames = [printNameTable.get(value, value) if printNameTable else value for value in valueNames]
+    legendHandles = [Patch(facecolor=colorTable.get(value, "#d9d9d9"), label=printName) for value, printName in zip(valueNames, printNames)]
+    legendHandles.reverse()  # top of the stack first, like makeStackedBar
+    pageCount = max(1, -(-len(sampleNames) // samplesPerPage))
+    plots = []
+    width = 0.8
+    for page in range(pageCount):
+        pageStart = page * samplesPerPage
+        pageMatrix = percentageMatrix[pageStart:pageStart + samplesPerPage]
+        pageSampleNames = list(sampleNames[pageStart:pageStart + samplesPerPage])
+        if referencePercentages is not None:
+            pageMatrix = numpy.vstack((referencePercentages, pageMatrix))
+            pageSampleNames.insert(0, referenceName)
+        sampleCount = len(pageSampleNames)
+        figureWidth = max(7, 3.5 + 0.1 * sampleCount)
+        figure = figureRendering.makeFigure(figsize=(figureWidth, 5), dpi=300)
+        # fixed margins in inches (labels below, legend to the right) instead of tight_layout, which would draw the figure twice
+        figure.subplots_adjust(left=0.8 / figureWidth, right=1 - 2.4 / figureWidth, bottom=0.25, top=0.92)
+        axes = figure.add_subplot(1, 1, 1)
+        tops = numpy.cumsum(pageMatrix, axis=1)
+        bottoms = tops - pageMatrix
+        positions = numpy.arange(sampleCount, dtype=numpy.float64)
+        lefts = positions - width / 2
+        rights = positions + width / 2
+        for column, value in enumerate(valueNames):
+            rectangles = numpy.empty((sampleCount, 4, 2), dtype=numpy.float64)
+            rectangles[:, 0, 0] = lefts
+            rectangles[:, 1, 0] = lefts
+            rectangles[:, 2, 0] = rights
+            rectangles[:, 3, 0] = rights
+            rectangles[:, 0, 1] = bottoms[:, column]
+            rectangles[:, 1, 1] = tops[:, column]
+            rectangles[:, 2, 1] = tops[:, column]
+            rectangles[:, 3, 1] = bottoms[:, column]
+            axes.add_collection(PolyCollection(rectangles[pageMatrix[:, column] > 0], facecolors=colorTable.get(value, "#d9d9d9"), edgecolors="none"))
+        axes.set_xlim(-0.5, sampleCount - 0.5)
+        axes.set_ylim(0, 100)
+        axes.set_yticks(range(0, 101, 10))
+        axes.set_ylabel("Relative Abundance (%)")
+        axes.set_xticks(positions)
+        if sampleCount > 48:
+            axes.set_xticklabels(pageSampleNames, rotation=90, fontsize=max(2, 8 - sampleCount // 48))
+        else:
+            axes.set_xticklabels(pageSampleNames, rotation=80, ha='center')
+        pageTitle = title
+        if pageCount > 1:
+            pageTitle = "%s (%s of %s)" %(title, page + 1, pageCount) if title else "Page %s of %s" %(page + 1, pageCount)
+        if pageTitle:
+            axes.set_title(pageTitle)
+        axes.legend(handles=legendHandles, loc='center left', bbox_to_anchor=(1, 0.5), fontsize=7)
+        byteStream = figureRendering.saveFigure(figure, format)
+        plots.append(plotEncoding.encodePlotOutput(byteStream, format, output))
+    return plots
@@ -0,0 +1,284 @@
+from math import pi, sin, cos
+from . import plotData
+from . import plotEncoding
+from .. import instrumentation
+
+rendererVersion = "1"  # bump whenever the drawing below changes so plot cache entries stop matching
+colorCycle = ("#1f77b4", "#ff7f0e", "#2ca02c", "#d62728", "#9467bd", "#8c564b", "#e377c2", "#7f7f7f", "#bcbd22", "#17becf")  # matplotlib's default colors
+fontFamily = "DejaVu Sans, Arial, Helvetica, sans-serif"
+characterWidth = 0.62  # average glyph width as a fraction of the font size, for laying out legends
+gridColor = "#b0b0b0"
+
+
+def formatNumber(value:float):
+    text = ("%.2f" %value).rstrip("0").rstrip(".")
+    if text == "-0":
+        return "0"
+    return text
+
+
+def estimateTextWidth(text:str, fontSize:float=10):
+    return len(text) * fontSize * characterWidth
+
+
+class SvgCanvas(object):
+    '''
+    Collects SVG elements for one plot.  Sizes and coordinates are in points (1/72 inch, y pointing down) so a canvas is the same
+    size as the matplotlib figure it stands in for.
+    '''
+
+    def __init__(self, width:float, height:float):
+        self.width = width
+        self.height = height
+        self.elements = []
+        self.clipPaths = 0
+
+    def addRectangle(self, x:float, y:float, width:float, height:float, fill:str="none", stroke:str=None, strokeWidth:float=0.8, extra:str=""):
+        self.elements.append('<rect x="%s" y="%s" width="%s" height="%s" fill="%s"%s%s/>' %(formatNumber(x), formatNumber(y), formatNumber(width), formatNumber(height), fill, self.makeStroke(stroke, strokeWidth), extra))
+
+    def addLine(self, x1:float, y1:float, x2:float, y2:float, stroke:str="#000000", strokeWidth:float=0.8):
+        self.elements.append('<line x1="%s" y1="%s" x2="%s" y2="%s"%s/>' %(formatNumber(x1), formatNumber(y1), formatNumber(x2), formatNumber(y2), self.makeStroke(stroke, strokeWidth)))
+
+    def addCircle(self, x:float, y:float, radius:float, fill:str="none", stroke:str=None, strokeWidth:float=0.8):
+        self.elements.append('<circle cx="%s" cy="%s" r="%s" fill="%s"%s/>' %(formatNumber(x), formatNumber(y), formatNumber(radius), fill, self.makeStroke(stroke, strokeWidth)))
+
+    def addPolygon(self, points:list, fill:str="none", stroke:str=None, strokeWidth:float=0.8, opacity:float=None, clipPath:str=None):
+        pointText = " ".join("%s,%s" %(formatNumber(x), formatNumber(y)) for x, y in points)
+        extra = ""
+        if opacity is not None:
+            extra += ' fill-opacity="%s"' %formatNumber(opacity)
+        if clipPath:
+            extra += ' clip-path="url(#%s)"' %clipPath
+        self.elements.append('<polygon points="%s" fill="%s"%s%s/>' %(pointText, fill, self.makeStroke(stroke, strokeWidth), extra))
+
+    def addPath(self, pathData:str, fill:str="none", stroke:str=None, strokeWidth:float=0.8):
+        self.elements.append('<path d="%s" fill="%s"%s/>' %(pathData, fill, self.makeStroke(stroke, strokeWidth)))
+
+    def addText(self, x:float, y:float, text:str, fontSize:float=10, anchor:str="start", baseline:str="auto", color:str="#000000", rotation:float=0):
+        from xml.sax.saxutils import escape
+        transform = ""
+        if rotation:
+            transform = ' transform="rotate(%s %s %s)"' %(formatNumber(-rotation), formatNumber(x), formatNumber(y))
+        self.elements.append('<text x="%s" y="%s" font-size="%s" text-anchor="%s" dominant-baseline="%s" fill="%s"%s>%s</text>' %(formatNumber(x), formatNumber(y), formatNumber(fontSize), anchor, baseline, color, transform, escape(str(text))))
+
+    def addCircleClipPath(self, x:float, y:float, radius:float):
+        '''Adds a circular clip path and returns its id'''
+        self.clipPaths += 1
+        clipPathID = "clip%s" %self.clipPaths
+        self.elements.append('<clipPath id="%s"><circle cx="%s" cy="%s" r="%s"/></clipPath>' %(clipPathID, formatNumber(x), formatNumber(y), formatNumber(radius)))
+        return clipPathID
+
+    def makeStroke(self, stroke:str, strokeWidth:float):
+        if not stroke:
+            return ""
+        return ' stroke="%s" stroke-width="%s" stroke-linejoin="round"' %(stroke, formatNumber(strokeWidth))
+
+    def toBytes(self):
+        header = '<svg xmlns="http://www.w3.org/2000/svg" width="%spt" height="%spt" viewBox="0 0 %s %s" font-family="%s">' %(formatNumber(self.width), formatNumber(self.height), formatNumber(self.width), formatNumber(self.height), fontFamily)
+        background = '<rect width="100%" height="100%" fill="#ffffff"/>'
+        return "\n".join([header, background] + self.elements + ["</svg>\n"]).encode("utf-8")
+
+    def encode(self, output:str="base64"):
+        '''The finished SVG as the requested output type (see plotEncoding), recorded as the plotting.svgSave stage'''
+        import io
+        with instrumentation.stage("plotting.svgSave") as timer:
+            byteStream = io.BytesIO(self.toBytes())
+            timer.addBytes(len(byteStream.getbuffer()))
+        return plotEncoding.encodePlotOutput(byteStream, "svg", output)
+
+
+def addLegend(canvas:SvgCanvas, x:float, y:float, labels:list, colors:list, patches:bool=True, fontSize:float=10):
+    '''Legend box with its top left corner at (x, y), drawn like matplotlib's: color patches (or lines) beside each label'''
+    borderPad = 0.4 * fontSize
+    rowHeight = fontSize
+    rowSpacing = 0.5 * fontSize
+    handleLength = 2 * fontSize
+    handleTextPad = 0.8 * fontSize
+    width = 2 * borderPad + handleLength + handleTextPad + max([estimateTextWidth(label, fontSize) for label in labels] + [0])
+    height = 2 * borderPad + len(labels) * rowHeight + max(len(labels) - 1, 0) * rowSpacing
+    canvas.addRectangle(x, y, width, height, fill="#ffffff", stroke="#cccccc", extra=' rx="%s" fill-opacity="0.8"' %formatNumber(0.2 * fontSize))
+    for index, (label, color) in enumerate(zip(labels, colors)):
+        rowCenter = y + borderPad + index * (rowHeight + rowSpacing) + rowHeight / 2
+        handleX = x + borderPad
+        if patches:
+            canvas.addRectangle(handleX, rowCenter - 0.35 * fontSize, handleLength, 0.7 * fontSize, fill=color)
+        else:
+            canvas.addLine(handleX, rowCenter, handleX + handleLength, rowCenter, stroke=color, strokeWidth=1.5)
+        canvas.addText(handleX + handleLength + handleTextPad, rowCenter, label, fontSize, baseline="central")
+    return width, height
+
+
+@instrumentation.timed("plotting.svgReadFateChart")
+def makeReadFateChart(readFates:dict, sampleID:str=None, explodeCell:[str, list] = None, explodeCellSize:float = 0.1, saveFormat:str='nativesvg', output:str="base64"):
+    '''
+    Read fate pie chart drawn straight to SVG, with the same order, labels, exploded cells and percentages as readFateChart.makeReadFateChart.
+    '''
+    labels, explodeCellTable, size = plotData.orderReadFates(readFates, explodeCell, explodeCellSize)
+    total = sum(size)
+    if not total > 0:
+        raise ValueError("Read fates must add up to more than 0 to draw a pie chart. Got %s" %readFates)
+    canvas = SvgCanvas(460.8, 345.6)
+    centerX, centerY, radius = 230.4, 180, 135
+    startFraction = 0.25  # start at 90 degrees and go counterclockwise, as matplotlib does with startangle=90
+    wedgeText = []
+    for index, value in enumerate(size):
+        if value < 0:
+            raise ValueError("Read fate percentages can not be negative. Got %s for %s" %(value, labels[index]))
+        fraction = value / total
+        endFraction = startFraction + fraction
+        middleAngle = pi * (startFraction + endFraction)
+        wedgeX = centerX + explodeCellTable[index] * radius * cos(middleAngle)
+        wedgeY = centerY - explodeCellTable[index] * radius * sin(middleAngle)
+        color = colorCycle[index % len(colorCycle)]
+        if fraction >= 1:
+            canvas.addCircle(wedgeX, wedgeY, radius, fill=color)
+        elif fraction > 0:
+            startAngle = 2 * pi * startFraction
+            endAngle = 2 * pi * endFraction
+            pathData = "M%s,%s L%s,%s A%s,%s 0 %s 0 %s,%s Z" %(formatNumber(wedgeX), formatNumber(wedgeY),
+                                                             formatNumber(wedgeX + radius * cos(startAngle)), formatNumber(wedgeY - radius * sin(startAngle)),
+                                                             formatNumber(radius), formatNumber(radius), 1 if fraction > 0.5 else 0,
+                                                             formatNumber(wedgeX + radius * cos(endAngle)), formatNumber(wedgeY - radius * sin(endAngle)))
+            canvas.addPath(pathData, fill=color)
+        labelX = wedgeX + 1.1 * radius * cos(middleAngle)
+        labelY = wedgeY - 1.1 * radius * sin(middleAngle)
+        wedgeText.append((labelX, labelY, labels[index], "start" if labelX > wedgeX else "end"))
+        wedgeText.append((wedgeX + 0.6 * radius * cos(middleAngle), wedgeY - 0.6 * radius * sin(middleAngle), "%1.1f%%" %(fraction * 100), "middle"))
+        startFraction = endFraction
+    for x, y, text, anchor in wedgeText:  # text goes over every wedge
+        canvas.addText(x, y, text, anchor=anchor, baseline="central")
+    if sampleID:
+        title = "%s READ FATES" %sampleID
+    else:
+        title = "READ FATES"
+    canvas.addText(centerX, 20, title, 12, anchor="middle")
+    return canvas.encode(output)
+
+
+def drawRadarPlot(samples:list, data:dict, dataRankOrder:list, orderedFeature:str, topHigh:bool, title:str, printNames:dict, output:str):
+    displayOrderedVariables = plotData.makeTopDownList(dataRankOrder)
+    angles = plotData.getListOfAngles(len(displayOrderedVariables))[:-1]
+    canvas = SvgCanvas(460.8, 345.6)
+    # ordered feature triangle on the left
+    triangleLeft, triangleWidth, triangleTop, triangleHeight = 10.8, 50, 45, 270.8
+    if topHigh:
+        triangleCoordinates = ((0,0), (0,5), (1,5))
+    else:
+        triangleCoordinates = ((0,0), (0,5), (1,0))
+    canvas.addPolygon([(triangleLeft + x / 1.5 * triangleWidth, triangleTop + triangleHeight - y / 5 * triangleHeight) for x, y in triangleCoordinates], fill="#00ff00")
+    canvas.addText(triangleLeft + triangleWidth / 2, triangleTop - 6, " " + orderedFeature, 12, anchor="middle")
+    # polar grid: 0 to 200% of expected, the first variable pointing straight up and the rest clockwise
+    centerX, centerY, radius = 257.4, 180.4, 135.4
+    radialAxes = [0, 50, 100, 150, 200]
+    scale = radius / max(radialAxes)
+    for mark in radialAxes[1:-1]:
+        canvas.addCircle(centerX, centerY, mark * scale, stroke=gridColor)
+    for angle in angles:
+        canvas.addLine(centerX, centerY, centerX + radius * sin(angle), centerY - radius * cos(angle), stroke=gridColor)
+    canvas.addCircle(centerX, centerY, radius, stroke="#000000")
+    for mark in radialAxes[1:]:
+        canvas.addText(centerX + 1, centerY - mark * scale - 1, str(mark), 7, color="#808080")
+    for angle, label in zip(angles, plotData.getRadarLabels(displayOrderedVariables, printNames)):
+        labelDistance = radius + 14
+        canvas.addText(centerX + labelDistance * sin(angle), centerY - labelDistance * cos(angle), label, anchor="middle", baseline="central")
+    canvas.addCircle(centerX, centerY, 100 * scale, stroke="#000000", strokeWidth=2)
+    clipPath = canvas.addCircleClipPath(centerX, centerY, radius)
+    for index, sample in enumerate(samples):
+        points = []
+        for angle, variable in zip(angles, displayOrderedVariables):
+            distance = data[sample][variable] * scale
+            points.append((centerX + distance * sin(angle), centerY - distance * cos(angle)))
+        canvas.addPolygon(points, fill="#0000ff", opacity=0.1, clipPath=clipPath)
+        canvas.addPolygon(points, stroke=colorCycle[index % len(colorCycle)], strokeWidth=1, clipPath=clipPath)
+    if len(samples) > 1:
+        legendWidth = 2 * 4 + 20 + 8 + max(estimateTextWidth(sample) for sample in samples)
+        addLegend(canvas, min(centerX + radius, canvas.width - legendWidth - 2), triangleTop - 20, samples, colorCycle, patches=False)
+    elif title:
+        canvas.addText(centerX, 20, title, 12, anchor="middle")
+    return canvas.encode(output)
+
+
+@instrumentation.timed("plotting.svgRadarPlot")
+def makeRadarPlot(data:dict, dataRankOrder:list, orderedFeature:str, topHigh = True, sampleRestriction = None, titleAppend="", format:str="nativesvg", printNames:dict = None, output:str="base64"):
+    '''Radar plot drawn straight to SVG from the same inputs as radarMaker.makeRadarPlot'''
+    samples, variables = plotData.getSamplesAndVariables(data)
+    for variable in dataRankOrder:
+        if not variable in variables:
+            raise ValueError("Got a variable in the rank order that is missing from the data: %s" %variable)
+    if len(samples) > 4:
+        raise ValueError("More samples present than colors listed for plotting.  Please either limit the number of samples per plot or increase the number of colors in use.  Suggest more plots with fewer samples, since too many samples on one plot is unreadable.")
+    if not sampleRestriction == None:
+        if type(sampleRestriction) == str:
+            sampleRestriction = [sampleRestriction]
+        samples = [sample for sample in samples if sample in sampleRestriction]
+    title = ""
+    if len(samples) == 1:
+        title = samples[0]
+        if titleAppend:
+            title += " " + titleAppend
+    return drawRadarPlot(samples, data, dataRankOrder, orderedFeature, topHigh, title, printNames, output)
+
+
+@instrumentation.timed("plotting.svgRadarPlot")
+def makeSingleSampleRadarPlot(sampleName:str, values:dict, dataRankOrder:list, orderedFeature:str, topHigh = True, titleAppend="", format:str="nativesvg", printNames:dict = None, output:str="base64"):
+    '''Radar plot of one sample drawn straight to SVG, from the same inputs as radarMaker.makeSingleSampleRadarPlot'''
+    for variable in dataRankOrder:
+        if not variable in values:
+            raise ValueError("Got a variable in the rank order that is missing from the data: %s" %variable)
+    if not len(values) == len(dataRankOrder):
+        raise ValueError("Rank order has %s variables but the data has %s" %(len(dataRankOrder), len(values)))
+    title = sampleName
+    if titleAppend:
+        title += " " + titleAppend
+    return drawRadarPlot([sampleName], {sampleName: values}, dataRankOrder, orderedFeature, topHigh, title, printNames, output)
+
+
+def getGridSpan(first:int, count:int, start:float, length:float, cells:int=20, spacing:float=0.2):
+    '''Start and length of count cells from first on a matplotlib GridSpec with cells cells between start and start + length'''
+    cellLength = length / (cells + spacing * (cells - 1))
+    return start + first * cellLength * (1 + spacing), count * cellLength + (count - 1) * cellLength * spacing
+
+
+@instrumentation.timed("plotting.svgStackedBar")
+def makeStackedBar(sampleDataTable:dict, valueOrderList:[list, tuple] = (), sampleOrderList:[list, tuple] = (), sampleName:str = "", format:str = "nativesvg", printNameTable:dict = None, output:str = "base64"):
+    '''Stacked bar plot drawn straight to SVG from the same inputs (and in the same layout) as stackedBars.makeStackedBar'''
+    canvas = SvgCanvas(504, 360)
+    topSpace, bottomSpace, leftSpace, rightSpace = plotData.getStackedBarSpacing(len(sampleDataTable))
+    plotDataMatrix, valueOrderList, sampleOrderList = plotData.makeStackedBarMatrix(sampleDataTable, valueOrderList, sampleOrderList)
+    axesLeft, axesWidth = getGridSpan(leftSpace, 20 - leftSpace - rightSpace, 0.125 * canvas.width, 0.775 * canvas.width)
+    axesTop, axesHeight = getGridSpan(topSpace, 20 - topSpace - bottomSpace, 0.12 * canvas.height, 0.77 * canvas.height)
+    width = 0.5
+    barCount = len(plotDataMatrix)
+    xMargin = 0.05 * (barCount - 1 + width)
+    xMinimum = -width / 2 - xMargin
+    xScale = axesWidth / (barCount - 1 + width + 2 * xMargin)
+    yMaximum = max([sum(data) for data in plotDataMatrix] + [0]) * 1.05
+    yScale = axesHeight / max(yMaximum, 100)
+    axesBottom = axesTop + axesHeight
+    for index, data in enumerate(plotDataMatrix):
+        bottomValue = 0
+        barLeft = axesLeft + (index - width / 2 - xMinimum) * xScale
+        for colorIndex, element in enumerate(data):
+            if element:
+                canvas.addRectangle(barLeft, axesBottom - (bottomValue + element) * yScale, width * xScale, element * yScale, fill=colorCycle[colorIndex % len(colorCycle)])
+            bottomValue += element
+    canvas.addRectangle(axesLeft, axesTop, axesWidth, axesHeight, stroke="#000000")
+    for tick in range(0, 101, 10):
+        tickY = axesBottom - tick * yScale
+        canvas.addLine(axesLeft - 3.5, tickY, axesLeft, tickY)
+        canvas.addText(axesLeft - 7, tickY, str(tick), anchor="end", baseline="central")
+    canvas.addText(axesLeft - 33, axesTop + axesHeight / 2, "Relative Abundance (%)", anchor="middle", rotation=90)
+    rotation, alignment = plotData.getSampleNameRotation(len(sampleOrderList))
+    for index, sample in enumerate(sampleOrderList):
+        tickX = axesLeft + (index - xMinimum) * xScale
+        canvas.addLine(tickX, axesBottom, tickX, axesBottom + 3.5)
+        canvas.addText(tickX, axesBottom + 7, sample, anchor="end" if alignment == "right" else "middle", baseline="hanging", rotation=rotation)
+    if sampleName:
+        canvas.addText(axesLeft + axesWidth / 2, axesTop - 7, sampleName, 12, anchor="middle")
+    printValueOrderList = plotData.getPrintValueOrder(valueOrderList, printNameTable)
+    colors = [colorCycle[index % len(colorCycle)] for index in range(len(valueOrderList))]
+    printValueOrderList.reverse()
+    colors.reverse()
+    legendHeight = 2 * 4 + len(printValueOrderList) * 10 + max(len(printValueOrderList) - 1, 0) * 5
+    addLegend(canvas, axesLeft + axesWidth + 5, axesTop + (axesHeight - legendHeight) / 2, printValueOrderList, colors)
+    return canvas.encode(output)
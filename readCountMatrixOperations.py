@@ -0,0 +1,285 @@
+import numpy as np
+
+
+def buildCountMatrix(sampleDataList:[list, tuple], standardReference, readSources:[list, tuple]=()):
+    '''
+    :param sampleDataList: Iterable of dictionaries of readSource:count (keys may be aliases from the standard reference)
+    :param standardReference: StandardReference used to convert aliases to standard identifiers, or None to keep the names as given
+    :param readSources: Read sources that should always get a column, even if never observed
+    :return: tuple of (count matrix, list of read source names for each column)
+    '''
+    countMatrix, columnNames, columnOrders = buildCountMatrixWithColumnOrders(sampleDataList, standardReference, readSources)
+    return countMatrix, columnNames
+
+
+def buildCountMatrixWithColumnOrders(sampleDataList:[list, tuple], standardReference, readSources:[list, tuple]=()):
+    '''
+    buildCountMatrix that also returns each sample's columns in the order they were first seen in its dictionary, which is the order
+    calculateMiq adds its reads in (see calculateReadSums).
+    :return: tuple of (count matrix, list of read source names for each column, list of column orders with one list per sample)
+    '''
+    aliasLookup = standardReference.compiledReference.aliasLookup if standardReference is not None else {}
+    columnIndex = {}
+    columnNames = []
+    for readSource in readSources:
+        if not readSource in columnIndex:
+            columnIndex[readSource] = len(columnNames)
+            columnNames.append(readSource)
+    sampleRows = []
+    for sampleData in sampleDataList:
+        row = {}
+        for rawName in sampleData:
+            newName = aliasLookup.get(rawName, rawName)
+            if not newName in columnIndex:
+                columnIndex[newName] = len(columnNames)
+                columnNames.append(newName)
+            column = columnIndex[newName]
+            row[column] = row.get(column, 0) + sampleData[rawName]
+        sampleRows.append(row)
+    countMatrix = np.zeros((len(sampleRows), len(columnNames)), dtype=np.float64)
+    for rowIndex, row in enumerate(sampleRows):
+        if row:
+            countMatrix[rowIndex, list(row.keys())] = list(row.values())
+    return countMatrix, columnNames, [list(row.keys()) for row in sampleRows]
+
+
+def convertColumnsToStandardIdentifiers(countMatrix:np.ndarray, readSources:[list, tuple], standardReference):
+    '''
+    Matrix equivalent of referenceHandler.convertKeysToStandardIdentifiers. Columns whose names are aliases of the same read source are summed together.
+    :return: tuple of (count matrix, list of standard read source names for each column)
+    '''
+    aliasLookup = standardReference.compiledReference.aliasLookup
+    columnGroups = {}
+    for column, rawName in enumerate(readSources):
+        newName = aliasLookup.get(rawName, rawName)
+        if not newName in columnGroups:
+            columnGroups[newName] = []
+        columnGroups[newName].append(column)
+    if all(len(columns) == 1 for columns in columnGroups.values()):
+        return countMatrix, list(columnGroups.keys())
+    convertedMatrix = np.zeros((countMatrix.shape[0], len(columnGroups)), dtype=np.float64)
+    for newColumn, columns in enumerate(columnGroups.values()):
+        for column in columns:
+            convertedMatrix[:, newColumn] += countMatrix[:, column]
+    return convertedMatrix, list(columnGroups.keys())
+
+
+def separateReferenceAndNonreferenceColumns(countMatrix:np.ndarray, readSources:[list, tuple], expectedReads:[list, tuple]):
+    '''
+    Matrix equivalent of generalDictOperations.separateReferenceAndNonreferenceReads.  Reference columns are returned in the order of expectedReads, with expected sources missing from the input filled in as zeros.
+    :return: tuple of (reference count matrix, nonreference count matrix, list of nonreference read source names)
+    '''
+    columnIndex = {readSource: column for column, readSource in enumerate(readSources)}
+    referenceMatrix = np.zeros((countMatrix.shape[0], len(expectedReads)), dtype=np.float64)
+    for referenceColumn, readSource in enumerate(expectedReads):
+        if readSource in columnIndex:
+            referenceMatrix[:, referenceColumn] = countMatrix[:, columnIndex[readSource]]
+    expectedSet = set(expectedReads)
+    nonreferenceColumns = [column for column, readSource in enumerate(readSources) if not readSource in expectedSet]
+    nonreferenceReadSources = [readSources[column] for column in nonreferenceColumns]
+    nonreferenceMatrix = countMatrix[:, nonreferenceColumns]
+    return referenceMatrix, nonreferenceMatrix, nonreferenceReadSources
+
+
+def getReferenceColumnOrders(columnOrders:[list, tuple], readSources:[list, tuple], expectedReads:[list, tuple], standardReference=None):
+    '''
+    Converts each row's column order (indices into readSources in the order calculateMiq first sees them) into positions in
+    expectedReads for calculateReadSums.  With a standardReference, readSources may be aliases, which count as their standard
+    identifier.  Expected read sources that a row never saw go last, since their counts are zero.  Rows sharing one order object
+    (such as [range(columns)] * rows for a count matrix) are only converted once.
+    '''
+    aliasLookup = standardReference.compiledReference.aliasLookup if standardReference is not None else {}
+    expectedIndex = {readSource: position for position, readSource in enumerate(expectedReads)}
+    columnPositions = [expectedIndex.get(aliasLookup.get(readSource, readSource)) for readSource in readSources]
+    convertedOrders = {}
+    referenceOrders = []
+    for order in columnOrders:
+        if not id(order) in convertedOrders:
+            positions = {}
+            for column in order:
+                if columnPositions[column] is not None:
+                    positions[columnPositions[column]] = True
+            for position in range(len(expectedReads)):
+                positions.setdefault(position, True)
+            convertedOrders[id(order)] = list(positions)
+        referenceOrders.append(convertedOrders[id(order)])
+    return referenceOrders
+
+
+def calculateReadSums(countMatrix:np.ndarray, columnOrders:[list, tuple]=None):
+    '''
+    Read total of each row of a samples x read sources matrix, added the way calculateMiq adds a sample's reads (sumDictionary): one
+    at a time in the order they were first seen, given for each row by columnOrders (left to right by default).  NumPy's pairwise
+    summation rounds fractional counts differently in the last bit.  Rows of whole counts totalling less than 2 ** 53 add up exactly
+    in any order, so only the other rows are added in Python.  Returns a column of totals for convertMatrixToPercentages.
+    '''
+    readSums = countMatrix.sum(axis=-1, keepdims=True)
+    exactRows = (countMatrix == np.floor(countMatrix)).all(axis=-1) & (np.abs(countMatrix).sum(axis=-1) < 2.0 ** 53)
+    for row in np.flatnonzero(~exactRows).tolist():
+        counts = countMatrix[row].tolist()
+        readSum = 0
+        for column in (range(len(counts)) if columnOrders is None else columnOrders[row]):
+            readSum += counts[column]
+        readSums[row, 0] = readSum
+    return readSums
+
+
+def convertMatrixToPercentages(countMatrix:np.ndarray, readSums:np.ndarray=None):
+    '''
+    Matrix equivalent of absoluteReadCountDictOperations.convertDictToPercentages.  Rows with no reads are left as all zeros.
+    Read sources are the last axis, so stacks of matrices (such as bootstrap resamples) work as well.  readSums can give the row
+    totals (see calculateReadSums, which matches calculateMiq for fractional counts); otherwise they are summed in NumPy.
+    '''
+    if readSums is None:
+        readSums = countMatrix.sum(axis=-1, keepdims=True)
+    percentageMatrix = np.zeros(countMatrix.shape, dtype=np.float64)
+    np.divide(countMatrix, readSums, out=percentageMatrix, where=readSums != 0)
+    percentageMatrix *= 100
+    return percentageMatrix
+
+
+def calculateObservedPercentOfExpected(percentageMatrix:np.ndarray, expectedPercentages:np.ndarray):
+    '''
+    Matrix equivalent of percentReadCountDictOperations.calculateObservedPercentOfExpected.  Columns of the percentage matrix must line up with the expected percentages.
+    '''
+    return (percentageMatrix / expectedPercentages) * 100
+
+
+def calculateAdjustedPercentErrors(percentOfExpectedMatrix:np.ndarray, percentToleranceInStandard:[int, float]=0):
+    '''
+    Returns the deviation from 100% of expected for each value, reduced by the manufacturing tolerance of the standard (deviations inside the tolerance become zero).
+    '''
+    unadjustedPercentErrors = 100 - percentOfExpectedMatrix
+    if not percentToleranceInStandard:
+        return unadjustedPercentErrors
+    absolutePercentErrors = np.abs(unadjustedPercentErrors)
+    return np.where(absolutePercentErrors <= percentToleranceInStandard, 0.0, absolutePercentErrors - percentToleranceInStandard)
+
+
+def calculateExactMean(values:[list, tuple]):
+    '''
+    Correctly rounded mean of floats, giving the same result as statistics.mean without going through Fraction objects.
+    '''
+    ratios = [value.as_integer_ratio() for value in values]
+    denominator = max(ratio[1] for ratio in ratios)
+    total = sum(numerator * (denominator // valueDenominator) for numerator, valueDenominator in ratios)
+    return total / (denominator * len(ratios))
+
+
+def calculateExactRowMeans(valueMatrix:np.ndarray):
+    '''
+    Correctly rounded mean of each row, identical to calculateExactMean on the row, but vectorized.  Rows are summed with error-free
+    transformations (TwoSum, and a Dekker product for the division remainder) into a quotient with a correction term, and the rounded
+    quotient is accepted when the correction keeps it clear of the midpoint to either neighbour by far more than the remaining error.
+    The rare rows that can not be decided that way (or that are near overflow or underflow) are done with calculateExactMean.
+    '''
+    valueMatrix = np.asarray(valueMatrix, dtype=np.float64)
+    rowCount, valueCount = valueMatrix.shape
+    means = np.empty(rowCount, dtype=np.float64)
+    if not valueCount or not rowCount:
+        for row, values in enumerate(valueMatrix.tolist()):
+            means[row] = calculateExactMean(values)
+        return means
+    with np.errstate(all="ignore"):
+        total = valueMatrix[:, 0].copy()
+        correction = np.zeros(rowCount, dtype=np.float64)
+        for column in range(1, valueCount):
+            value = valueMatrix[:, column]
+            newTotal = total + value
+            valuePart = newTotal - total
+            correction += (total - (newTotal - valuePart)) + (value - valuePart)
+            total = newTotal
+        quotient = total / valueCount
+        product = quotient * valueCount
+        quotientHigh = quotient * 134217729.0  # Veltkamp split; valueCount fits in 26 bits, so it needs no split
+        quotientHigh = quotientHigh - (quotientHigh - quotient)
+        productError = (quotientHigh * valueCount - product) + (quotient - quotientHigh) * valueCount
+        quotientCorrection = (((total - product) - productError) + correction) / valueCount
+        means[:] = quotient + quotientCorrection
+        offset = (quotient - means) + quotientCorrection
+        halfStepUp = (np.nextafter(means, np.inf) - means) / 2
+        halfStepDown = (means - np.nextafter(means, -np.inf)) / 2
+        margin = np.minimum(halfStepUp, halfStepDown) * 2.0 ** -30
+        magnitudes = np.abs(valueMatrix)
+        largest = magnitudes.max(axis=1)
+        smallest = np.where(magnitudes > 0, magnitudes, np.inf).min(axis=1)
+        decided = (offset > margin - halfStepDown) & (offset < halfStepUp - margin)
+        decided &= (largest < 2.0 ** 900) & ((smallest > 2.0 ** -900) | (largest == 0))
+        decided &= magnitudes.sum(axis=1) <= np.abs(total) * 2  # little cancellation between values of opposite signs
+    for row in np.flatnonzero(~decided).tolist():
+        means[row] = calculateExactMean(valueMatrix[row].tolist())
+    return means
+
+
+def calculateRawMiqScores(adjustedPercentErrorMatrix:np.ndarray):
+    '''
+    Reduces each row of adjusted percent errors to a raw MIQ score (100 - RMSE).
+    The squaring, mean and root give the same results as MiqScoreCalculator.calculateMiq (the power operator and a correctly rounded
+    mean, see calculateExactRowMeans) because NumPy's vectorized power and summation round differently in the last bit.
+    '''
+    squaredErrors = np.array([value ** 2 for value in adjustedPercentErrorMatrix.ravel().tolist()], dtype=np.float64).reshape(adjustedPercentErrorMatrix.shape)
+    meanDeviationsSquared = calculateExactRowMeans(squaredErrors)
+    return np.array([100 - meanDeviationSquared ** 0.5 for meanDeviationSquared in meanDeviationsSquared.tolist()], dtype=np.float64)
+
+
+def calculateVectorizedRawMiqScores(adjustedPercentErrorMatrix:np.ndarray):
+    '''
+    Raw MIQ scores (100 - RMSE) over the last axis, computed entirely in NumPy.  Can differ from calculateRawMiqScores in the last bit,
+    so it is meant for large numbers of resampled scores (such as bootstrap replicates) rather than reported scores.
+    '''
+    return 100 - np.sqrt(np.mean(np.square(adjustedPercentErrorMatrix), axis=-1))
+
+
+def drawMultinomialResamples(referenceCountMatrix:np.ndarray, replicates:int, random:[np.random.Generator, list, tuple]=None):
+    '''
+    Resamples each row of a samples x read sources count matrix: every replicate draws the row's total reads (rounded to a whole
+    number) from a multinomial with the row's observed proportions.  Rows with no reads resample to all zeros.
+    :param random: Generator for all rows, or a list with one Generator per row so each sample's resamples can be seeded separately
+    :return: samples x replicates x read sources matrix of resampled counts
+    '''
+    if random is None:
+        random = np.random.default_rng()
+    if isinstance(random, (list, tuple)):
+        randomForRows = random
+    else:
+        randomForRows = [random] * len(np.atleast_2d(referenceCountMatrix))
+    referenceCountMatrix = np.atleast_2d(np.asarray(referenceCountMatrix, dtype=np.float64))
+    resamples = np.zeros((referenceCountMatrix.shape[0], replicates, referenceCountMatrix.shape[1]), dtype=np.float64)
+    readTotals = referenceCountMatrix.sum(axis=1)
+    for row, readTotal in enumerate(readTotals.tolist()):
+        readCount = int(round(readTotal))
+        if readCount <= 0:
+            continue
+        resamples[row] = randomForRows[row].multinomial(readCount, referenceCountMatrix[row] / readTotal, size=replicates)
+    return resamples
+
+
+def drawHypergeometricSubsamples(readCounts:[list, tuple, np.ndarray], depths:[list, tuple], replicates:int, random:np.random.Generator=None):
+    '''
+    Rarefies one sample: for each depth, replicates subsamples of that many reads are drawn without replacement from the sample's
+    reads (a multivariate hypergeometric draw over whole-number counts).
+    :return: depths x replicates x read sources matrix of subsampled counts
+    '''
+    if random is None:
+        random = np.random.default_rng()
+    readCounts = np.rint(np.asarray(readCounts, dtype=np.float64)).astype(np.int64)
+    subsamples = np.empty((len(depths), replicates, len(readCounts)), dtype=np.float64)
+    for index, depth in enumerate(depths):
+        subsamples[index] = random.multivariate_hypergeometric(readCounts, depth, size=replicates)
+    return subsamples
+
+
+def makeRarefactionDepths(readTotal:int, points:int=20, minimumDepth:int=100):
+    '''Geometrically spaced whole read depths from minimumDepth (or readTotal if that is smaller) up to readTotal'''
+    readTotal = int(readTotal)
+    if readTotal <= 0:
+        return []
+    minimumDepth = min(minimumDepth, readTotal)
+    depths = np.unique(np.rint(np.geomspace(minimumDepth, readTotal, points)).astype(np.int64))
+    return depths.tolist()
+
+
+def applyFloor(rawMiqScores:np.ndarray, floor:[int, float]=0):
+    if floor is None:
+        return rawMiqScores.copy()
+    return np.maximum(rawMiqScores, floor)
@@ -1,3 +1,6 @@
+_compiledReferenceCache = {}
+_restoredReferenceCache = {}  # compiled references unpickled from another process, by content hash
+
 
 class StandardReference(object):
 
@@ -6,15 +9,19 @@ class StandardReference(object):
                  "itemIDs",
                  "sortings",
                  "expectedValues",
-                 "analysisMethods"]
+                 "analysisMethods",
+                 "compiledReference"]
 
     def __init__(self, standardDataPath:str):
         import os
         if os.path.isfile(standardDataPath):
-            rawData = self.loadDictionary(standardDataPath)
+            compiledReference = compileStandardReference(standardDataPath)
         else:
             raise FileNotFoundError("Unable to find standard reference dictionary at %s" %standardDataPath)
-        self.processRawData(rawData)
+        self.processRawData(compiledReference.rawData, compiledReference)
+
+    def __reduce__(self):
+        return restoreStandardReference, (self.compiledReference,)
 
     def loadDictionary(self, path:str):
         import json
@@ -29,37 +36,175 @@ class StandardReference(object):
         path = os.path.join(referenceFolder, fileName)
         return self.loadDictionary(path)
 
-    def processRawData(self, rawData:dict):
-        self.nameLookup = rawData["nameLookup"]
-        self.printNames = rawData["printNames"]
-        self.itemIDs = rawData["itemIDs"]
-        self.sortings = rawData["sortings"]
-        self.expectedValues = rawData["expectedValues"]
+    def processRawData(self, rawData:dict, compiledReference=None):
+        '''
+        Sets the reference up from raw reference data (the parsed JSON).  The tables are read-only views shared with the compiled
+        reference that scoring uses, so to change a reference, edit a copy of its raw data (makeRawData) and process that.
+        '''
+        import copy
+        if compiledReference is None:
+            compiledReference = CompiledStandardReference(copy.deepcopy(rawData))  # its own copy, so later changes to rawData can not make the two disagree
+        self.nameLookup = compiledReference.tables["nameLookup"]
+        self.printNames = compiledReference.tables["printNames"]
+        self.itemIDs = compiledReference.tables["itemIDs"]
+        self.sortings = compiledReference.tables["sortings"]
+        self.expectedValues = compiledReference.tables["expectedValues"]
         self.analysisMethods = list(self.expectedValues.keys())
+        self.compiledReference = compiledReference
+
+    def makeRawData(self):
+        '''An editable copy of the reference's raw data for processRawData'''
+        import copy
+        return copy.deepcopy(self.compiledReference.rawData)
+
+
+def makeStandardReference(rawData:dict):
+    '''StandardReference from raw reference data (such as an edited copy from makeRawData) instead of a file'''
+    standardReference = StandardReference.__new__(StandardReference)
+    standardReference.processRawData(rawData)
+    return standardReference
+
+
+def restoreStandardReference(compiledReference):
+    standardReference = StandardReference.__new__(StandardReference)
+    standardReference.processRawData(compiledReference.rawData, compiledReference)
+    return standardReference
+
+
+class CompiledStandardReference(object):
+    '''
+    Read-only array layout of a standard reference.  Every read source gets an integer index (itemIDs first, in order), and
+    aliases, expected values and sortings are stored against those indices so they never need to be walked again.
+    Objects loaded from the same file are shared within a process (see compileStandardReference), so nothing here should be modified.
+    tables holds read-only views of the raw data tables for StandardReference, and contentHash identifies the reference by content.
+    '''
+
+    __slots__ = ["rawData",
+                 "standardDataPath",
+                 "modificationTime",
+                 "contentHash",
+                 "tables",
+                 "readSourceIDs",
+                 "readSourceIndex",
+                 "aliasIndex",
+                 "aliasLookup",
+                 "printNames",
+                 "analysisMethods",
+                 "expectedValueVectors",
+                 "expectedReadSourceIndices",
+                 "sortingPermutations"]
+
+    def __init__(self, rawData:dict, standardDataPath:str=None, modificationTime:int=None):
+        import json
+        import types
+        import hashlib
+        import numpy
+        self.rawData = rawData
+        self.standardDataPath = standardDataPath
+        self.modificationTime = modificationTime
+        self.contentHash = hashlib.sha256(json.dumps(rawData).encode()).hexdigest()  # not sorted, since table order is part of the reference
+        self.tables = types.MappingProxyType({"nameLookup": types.MappingProxyType(dict(rawData["nameLookup"])),
+                                              "printNames": types.MappingProxyType(dict(rawData["printNames"])),
+                                              "itemIDs": tuple(rawData["itemIDs"]),
+                                              "sortings": types.MappingProxyType({sortingMethod: (orderType, tuple(orderedList)) for sortingMethod, (orderType, orderedList) in rawData["sortings"].items()}),
+                                              "expectedValues": types.MappingProxyType({analysisMethod: types.MappingProxyType(dict(expectedValues)) for analysisMethod, expectedValues in rawData["expectedValues"].items()})})
+        readSourceIDs = []
+        readSourceIndex = {}
+        sortingSources = [source for orderType, orderedList in rawData["sortings"].values() for source in orderedList]
+        expectedSources = [source for expectedValues in rawData["expectedValues"].values() for source in expectedValues]
+        for source in rawData["itemIDs"] + list(rawData["nameLookup"].values()) + expectedSources + sortingSources:
+            if not source in readSourceIndex:
+                readSourceIndex[source] = len(readSourceIDs)
+                readSourceIDs.append(source)
+        aliasIndex = dict(readSourceIndex)
+        for alias, source in rawData["nameLookup"].items():
+            aliasIndex[alias] = readSourceIndex[source]
+        self.readSourceIDs = tuple(readSourceIDs)
+        self.readSourceIndex = types.MappingProxyType(readSourceIndex)
+        self.aliasIndex = types.MappingProxyType(aliasIndex)
+        self.aliasLookup = types.MappingProxyType({alias: readSourceIDs[index] for alias, index in aliasIndex.items()})
+        self.printNames = tuple(rawData["printNames"].get(source, source) for source in readSourceIDs)
+        self.analysisMethods = tuple(rawData["expectedValues"].keys())
+        expectedValueVectors = {}
+        expectedReadSourceIndices = {}
+        for analysisMethod, expectedValues in rawData["expectedValues"].items():
+            expectedVector = numpy.zeros(len(readSourceIDs), dtype=numpy.float64)
+            expectedIndices = []
+            for source, value in expectedValues.items():
+                if value:
+                    expectedVector[readSourceIndex[source]] = value
+                    expectedIndices.append(readSourceIndex[source])
+            expectedValueVectors[analysisMethod] = self.makeReadOnly(expectedVector)
+            expectedReadSourceIndices[analysisMethod] = self.makeReadOnly(numpy.array(expectedIndices, dtype=numpy.intp))
+        self.expectedValueVectors = types.MappingProxyType(expectedValueVectors)
+        self.expectedReadSourceIndices = types.MappingProxyType(expectedReadSourceIndices)
+        sortingPermutations = {}
+        for sortingMethod, (orderType, orderedList) in rawData["sortings"].items():
+            permutation = numpy.array([readSourceIndex[source] for source in orderedList], dtype=numpy.intp)
+            sortingPermutations[sortingMethod] = (orderType, self.makeReadOnly(permutation))
+        self.sortingPermutations = types.MappingProxyType(sortingPermutations)
+
+    def __reduce__(self):
+        return restoreCompiledReference, (self.rawData, self.standardDataPath, self.modificationTime, self.contentHash)
+
+    @staticmethod
+    def makeReadOnly(array):
+        array.setflags(write=False)
+        return array
+
+    def expectedReadSources(self, analysisMethod:str):
+        return [self.readSourceIDs[index] for index in self.expectedReadSourceIndices[analysisMethod].tolist()]
+
+    def lookupIndex(self, name:str):
+        '''Returns the read source index for any alias or identifier, or None if it is not part of the standard'''
+        return self.aliasIndex.get(name)
+
+
+def compileStandardReference(standardDataPath:str):
+    '''
+    Parses and compiles a standard reference file once per process.  Results are memoized by absolute path and modification time, so an edited file will be picked up again.
+    '''
+    import os
+    import json
+    path = os.path.abspath(standardDataPath)
+    modificationTime = os.stat(path).st_mtime_ns
+    cacheKey = (path, modificationTime)
+    if cacheKey in _compiledReferenceCache:
+        return _compiledReferenceCache[cacheKey]
+    file = open(path, 'r')
+    rawData = json.load(file)
+    file.close()
+    compiledReference = CompiledStandardReference(rawData, path, modificationTime)
+    for staleKey in [key for key in _compiledReferenceCache if key[0] == path]:
+        del _compiledReferenceCache[staleKey]
+    _compiledReferenceCache[cacheKey] = compiledReference
+    return compiledReference
+
+
+def restoreCompiledReference(rawData:dict, standardDataPath:str, modificationTime:int, contentHash:str):
+    '''
+    Unpickles a CompiledStandardReference.  The copy compiled from the same file in this process is used if it has the same content,
+    otherwise the reference is compiled once from the pickled raw data and shared by later unpickled copies.
+    '''
+    compiledReference = _compiledReferenceCache.get((standardDataPath, modificationTime))
+    if compiledReference is not None and compiledReference.contentHash == contentHash:
+        return compiledReference
+    if not contentHash in _restoredReferenceCache:
+        _restoredReferenceCache[contentHash] = CompiledStandardReference(rawData, standardDataPath, modificationTime)
+    return _restoredReferenceCache[contentHash]
 
 
 def determineExpectedReadSources(analysisMethod:str, standardReference:StandardReference):
     if not analysisMethod in standardReference.analysisMethods:
         raise KeyError("%s is not a valid analysis method in the reference" %analysisMethod)
-    sampleSpace = set()
-    for sampleItem in standardReference.expectedValues[analysisMethod]:
-        if not standardReference.expectedValues[analysisMethod][sampleItem]:
-            continue
-        else:
-            if not sampleItem in sampleSpace:
-                sampleSpace.add(sampleItem)
-            else:
-                raise ValueError("Duplicate entry found for sample item %s.  This should never be able to happen if you are loading JSON and needs to be debugged." %sampleItem)
-    return sampleSpace
+    return set(standardReference.compiledReference.expectedReadSources(analysisMethod))
 
 
 def convertKeysToStandardIdentifiers(readCountDict:dict, standardReference:StandardReference):
     convertedDict = {}
+    aliasLookup = standardReference.compiledReference.aliasLookup
     for rawName in readCountDict:
-        if rawName in standardReference.nameLookup:
-            newName = standardReference.nameLookup[rawName]
-        else:
-            newName = rawName
+        newName = aliasLookup.get(rawName, rawName)
         if not newName in convertedDict:
             convertedDict[newName] = 0
         convertedDict[newName] += readCountDict[rawName]
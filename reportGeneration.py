@@ -1,3 +1,7 @@
+from . import plotting
+from . import instrumentation
+
+
 def performReplacement(template:str, replacementTable:dict):
     import re
     for target in replacementTable:
@@ -6,6 +10,353 @@ def performReplacement(template:str, replacementTable:dict):
     return template
 
 
-def generateReport(template:str, replacementTable):
-    report = performReplacement(template, replacementTable)
+class ReportTemplate(object):
+    '''
+    HTML template with %%NAME%% placeholders parsed once into a list of literal segments and placeholder names.
+    Rendering is a single pass over the segments and can write straight to an open file or stream, so a filled-in report
+    (with its large base64 plots) never has to be built up as a whole string.  Plots given as raw bytes or EncodedPlot handles are
+    base64 encoded in chunks as they are written.  Placeholders without a replacement are left in place.  When a plot embedded as a
+    data URL is in another format than the URL says (such as an SVG plot in data:image/png), the URL's image type is corrected.
+    '''
+
+    placeholderPattern = "%%([A-Za-z0-9_]+)%%"
+    dataURLPattern = "data:(image/[A-Za-z0-9.+-]+);base64,$"
+
+    def __init__(self, template:str):
+        import re
+        self.segments = []  # literal strings at even positions, placeholder names at odd positions
+        self.placeholders = []
+        self.dataURLTypes = {}  # position of each placeholder written inside a data URL: the image type given in the URL
+        position = 0
+        for match in re.finditer(self.placeholderPattern, template):
+            literal = template[position:match.start()]
+            dataURL = re.search(self.dataURLPattern, literal)
+            if dataURL:
+                self.dataURLTypes[len(self.segments) + 1] = dataURL.group(1)
+            self.segments.append(literal)
+            self.segments.append(match.group(1))
+            if not match.group(1) in self.placeholders:
+                self.placeholders.append(match.group(1))
+            position = match.end()
+        self.segments.append(template[position:])
+
+    def iterateChunks(self, replacementTable:dict):
+        for index, segment in enumerate(self.segments):
+            if index % 2 == 0:
+                if index + 1 in self.dataURLTypes and self.segments[index + 1] in replacementTable:
+                    segment = self.correctDataURLType(segment, self.dataURLTypes[index + 1], replacementTable[self.segments[index + 1]])
+                yield segment
+            elif segment in replacementTable:
+                value = replacementTable[segment]
+                if isinstance(value, (bytes, bytearray)):
+                    value = plotting.plotEncoding.EncodedPlot(value)
+                if isinstance(value, plotting.plotEncoding.EncodedPlot):
+                    yield from value.iterateBase64Chunks()  # plots are encoded piece by piece as they are written
+                else:
+                    yield str(value)
+            else:
+                yield "%%" + segment + "%%"
+
+    def correctDataURLType(self, literal:str, imageType:str, plot):
+        plotFormat = plotting.plotEncoding.getPlotFormat(plot)
+        if plotFormat is None:
+            return literal
+        plotImageType = plotting.plotEncoding.getMimeType(plotFormat)
+        if plotImageType == imageType:
+            return literal
+        return literal[:literal.rindex(imageType)] + plotImageType + ";base64,"
+
+    def render(self, replacementTable:dict):
+        return "".join(self.iterateChunks(replacementTable))
+
+    def renderTo(self, stream, replacementTable:dict):
+        '''Writes the report to stream and returns the number of characters written'''
+        characterCount = 0
+        for chunk in self.iterateChunks(replacementTable):
+            stream.write(chunk)
+            characterCount += len(chunk)
+        return characterCount
+
+    def missingPlaceholders(self, replacementTable:dict):
+        '''Placeholders in the template with no value in the replacement table'''
+        return [placeholder for placeholder in self.placeholders if not placeholder in replacementTable]
+
+    def unusedReplacements(self, replacementTable:dict):
+        '''Values in the replacement table that have no placeholder in the template'''
+        return [target for target in replacementTable if not target in self.placeholders]
+
+
+_compiledTemplates = {}
+
+
+def compileTemplate(template:[str, ReportTemplate]):
+    '''Returns a ReportTemplate for a template string, reusing the parsed template for strings seen before'''
+    if type(template) == ReportTemplate:
+        return template
+    if not template in _compiledTemplates:
+        if len(_compiledTemplates) >= 16:
+            _compiledTemplates.clear()
+        with instrumentation.stage("reportGeneration.compileTemplate"):
+            _compiledTemplates[template] = ReportTemplate(template)
+    return _compiledTemplates[template]
+
+
+def generateReport(template:[str, ReportTemplate], replacementTable):
+    with instrumentation.stage("reportGeneration.generateReport") as timer:
+        report = compileTemplate(template).render(replacementTable)
+        timer.addBytes(len(report))
     return report
+
+
+def writeReport(outputPath:str, template:[str, ReportTemplate], replacementTable):
+    '''Renders a report straight into a file'''
+    with instrumentation.stage("reportGeneration.writeReport") as timer:
+        file = open(outputPath, 'w')
+        timer.addBytes(compileTemplate(template).renderTo(file, replacementTable))
+        file.close()
+
+
+def makeReadFateTableHTML(readFateTable:dict, readFatePrintNames:dict=None):
+    rows = ["<table>"]
+    for readFate in readFateTable:
+        printName = readFate
+        if readFatePrintNames and readFate in readFatePrintNames:
+            printName = readFatePrintNames[readFate]
+        rows.append("<tr><td>%s</td><td>%.1f%%</td></tr>" %(printName, readFateTable[readFate]))
+    rows.append("</table>")
+    return "\n".join(rows)
+
+
+@instrumentation.timed("reportGeneration.makeReplacementTable")
+def makeReplacementTable(sampleMiq, goodExampleMiq, badExampleMiq, radarSorting:str="Lysis Difficulty", readFatePrintNames:dict=None):
+    '''
+    Builds the replacement table for the example report template from MiqScoreData objects.  Plots already stored on the objects are reused.
+    If the sample has a rarefaction curve attached, RAREFACTIONPLOT and STABLEDEPTH are filled in as well.
+    '''
+    replacementTable = {"SAMPLENAME": str(sampleMiq.sampleID),
+                        "MIQSCORE": str(round(sampleMiq.miqScore)),
+                        "GOODRADARPLOT": goodExampleMiq.makeRadarPlots()[radarSorting],
+                        "BADRADARPLOT": badExampleMiq.makeRadarPlots()[radarSorting],
+                        "SAMPLERADARPLOT": sampleMiq.makeRadarPlots()[radarSorting],
+                        "COMPOSITIONBARPLOT": sampleMiq.plots.get("compositionPlot") or sampleMiq.makeCompositionBarPlot(),
+                        "READFATECHART": sampleMiq.makeReadFateChart(readFatePrintNames=readFatePrintNames),
+                        "READFATETABLE": makeReadFateTableHTML(sampleMiq.readFateTable, readFatePrintNames)}
+    if getattr(sampleMiq, "rarefactionCurve", None) is not None:
+        stableDepth = sampleMiq.rarefactionCurve.stableDepth()
+        replacementTable["RAREFACTIONPLOT"] = sampleMiq.makeRarefactionPlot()
+        replacementTable["STABLEDEPTH"] = "not reached" if stableDepth is None else "{:,}".format(stableDepth)
+    return replacementTable
+
+
+linkedPlotPattern = "data:image/([A-Za-z0-9.+-]+);base64,%%([A-Za-z0-9_]+)%%"
+imageFormats = {"svg+xml": "svg", "jpeg": "jpg"}
+
+bundleStyleSheet = '''body { font-family: Arial, Helvetica, sans-serif; margin: 2em; }
+table { border-collapse: collapse; }
+th, td { border: 1px solid #cccccc; padding: 0.25em 0.6em; text-align: right; }
+th { background: #f0f0f0; }
+td.sample { text-align: left; }
+tr.failed td { color: #b00000; }
+'''
+
+
+def makeLinkedTemplate(template:str):
+    '''
+    Turns plots embedded in a template as data URLs (data:image/png;base64,%%NAME%%) into plain placeholders that take a link to an
+    image file instead.  Returns (template text, dictionary of placeholder:image file extension).
+    '''
+    import re
+    linkedPlaceholders = {}
+    def replacePlot(match):
+        imageType = match.group(1).lower()
+        linkedPlaceholders[match.group(2)] = imageFormats.get(imageType, imageType)
+        return "%%" + match.group(2) + "%%"
+    return re.sub(linkedPlotPattern, replacePlot, template), linkedPlaceholders
+
+
+def writeFileAtomically(path:str, data):
+    '''
+    Writes text or bytes to a uniquely named temporary file next to path and moves it into place, so readers never see a partial
+    file and concurrent writers never share a temporary file.  data can also be a function that writes text to the open file.
+    '''
+    import os
+    import tempfile
+    fileDescriptor, temporaryPath = tempfile.mkstemp(dir=os.path.dirname(path) or ".", prefix=".tmp")
+    try:
+        file = os.fdopen(fileDescriptor, 'wb' if isinstance(data, bytes) else 'w')
+        if callable(data):
+            data(file)
+        else:
+            file.write(data)
+        file.close()
+        os.chmod(temporaryPath, plotting.plotCache.getNewFileMode())  # readable like any other output (mkstemp files are 0600), so the bundle can be served
+        os.replace(temporaryPath, path)
+    except BaseException:
+        if os.path.exists(temporaryPath):
+            os.remove(temporaryPath)
+        raise
+
+
+class ReportBundle(object):
+    '''
+    Writes a run's reports as one directory instead of self-contained files.  Every plot is written once to the assets folder under
+    the SHA-256 hash of its contents and reports link to it, so plots shared by every report (such as the good and bad example
+    radar plots) are stored once, and disk use and write time grow with the number of unique plots.  Plot objects already seen
+    are remembered, so shared plots are not even hashed again.  writeIndex adds a run-level index page with every sample's MIQ
+    score and read fates.  Several processes can write into the same bundle, since every file is written atomically.
+    '''
+
+    assetFolderName = "assets"
+    styleSheetName = "style.css"
+    maxKnownPlots = 64
+
+    def __init__(self, outputDirectory:str, template:str=None):
+        '''
+        :param template: Report template text.  Plots embedded in it as data URLs are linked to asset files instead (see makeLinkedTemplate).
+        '''
+        import os
+        import collections
+        self.outputDirectory = outputDirectory
+        self.assetDirectory = os.path.join(outputDirectory, self.assetFolderName)
+        os.makedirs(self.assetDirectory, exist_ok=True)
+        self.template = None
+        self.linkedPlaceholders = {}
+        if template is not None:
+            linkedTemplate, self.linkedPlaceholders = makeLinkedTemplate(template)
+            self.template = ReportTemplate(linkedTemplate)
+        self.knownPlots = collections.OrderedDict()  # id(plot): (plot, asset link), most recently used last
+        self.samples = []
+        self.assetsWritten = 0
+        self.assetsReused = 0
+        self.assetBytesWritten = 0
+        self.writeStaticAssets()
+
+    def writeStaticAssets(self):
+        import os
+        path = os.path.join(self.assetDirectory, self.styleSheetName)
+        if not os.path.exists(path):
+            writeFileAtomically(path, bundleStyleSheet)
+
+    def addPlot(self, plot:[str, bytes, plotting.plotEncoding.EncodedPlot], format:str="png"):
+        '''Stores a plot (base64 string, raw bytes or EncodedPlot) in the assets folder if it is not there yet and returns its link relative to the bundle'''
+        import os
+        import hashlib
+        known = self.knownPlots.get(id(plot))
+        if known is not None and known[0] is plot:
+            self.knownPlots.move_to_end(id(plot))
+            self.assetsReused += 1
+            return known[1]
+        with instrumentation.stage("reportGeneration.addPlot") as timer:
+            plotBytes = plotting.plotEncoding.getPlotBytes(plot)
+            if isinstance(plot, plotting.plotEncoding.EncodedPlot):
+                format = imageFormats.get(plot.format, plot.format)
+            else:
+                format = plotting.plotEncoding.getPlotFormat(plotBytes) or format  # such as SVG plots in a template written for PNG
+            fileName = "%s.%s" %(hashlib.sha256(plotBytes).hexdigest(), format)
+            path = os.path.join(self.assetDirectory, fileName)
+            if os.path.exists(path):
+                self.assetsReused += 1
+            else:
+                writeFileAtomically(path, plotBytes)
+                self.assetsWritten += 1
+                self.assetBytesWritten += len(plotBytes)
+                timer.addBytes(len(plotBytes))
+        link = self.assetFolderName + "/" + fileName
+        self.knownPlots[id(plot)] = (plot, link)
+        if len(self.knownPlots) > self.maxKnownPlots:
+            self.knownPlots.popitem(last=False)
+        return link
+
+    def linkPlots(self, plots:dict):
+        '''Copy of a plots dictionary (such as MiqScoreData.plots, with groups like radarPlots nested) with every plot stored as an asset and replaced by its link'''
+        linkedPlots = {}
+        for plotName, plot in plots.items():
+            if isinstance(plot, dict):
+                linkedPlots[plotName] = self.linkPlots(plot)
+            else:
+                linkedPlots[plotName] = self.addPlot(plot)
+        return linkedPlots
+
+    def linkReplacementTable(self, replacementTable:dict):
+        '''Copy of a replacement table with the plots for linked placeholders stored as assets and replaced by their links'''
+        linkedTable = dict(replacementTable)
+        for placeholder, format in self.linkedPlaceholders.items():
+            if placeholder in linkedTable:
+                linkedTable[placeholder] = self.addPlot(linkedTable[placeholder], format)
+        return linkedTable
+
+    def writeReport(self, reportFileName:str, replacementTable:dict):
+        '''Writes one report into the bundle with its plots linked as assets and returns its path'''
+        import os
+        if self.template is None:
+            raise ValueError("This report bundle was made without a template, so it can only write an index page")
+        path = os.path.join(self.outputDirectory, reportFileName)
+        linkedTable = self.linkReplacementTable(replacementTable)
+        def renderReport(file):
+            with instrumentation.stage("reportGeneration.writeReport") as timer:
+                timer.addBytes(self.template.renderTo(file, linkedTable))
+        writeFileAtomically(path, renderReport)
+        return path
+
+    def addSample(self, sampleID:str, miqScore:float=None, readFateTable:dict=None, reportFileName:str=None, error:str=None):
+        '''Adds a sample to the index page.  Failed samples are listed with their error instead of a score.'''
+        self.samples.append({"sampleID": sampleID,
+                             "miqScore": miqScore,
+                             "readFateTable": readFateTable or {},
+                             "reportFileName": reportFileName,
+                             "error": error})
+
+    def addResult(self, miqResult, reportFileName:str=None):
+        self.addSample(miqResult.sampleID, miqResult.miqScore, miqResult.readFateTable, reportFileName)
+
+    def makeIndexHTML(self, title:str="MIQ Run Summary", readFatePrintNames:dict=None):
+        import html
+        import statistics
+        readFates = ["Reference"]
+        for sample in self.samples:
+            for readFate in sample["readFateTable"]:
+                if not readFate in readFates:
+                    readFates.append(readFate)
+        scores = [sample["miqScore"] for sample in self.samples if sample["miqScore"] is not None]
+        failedCount = len([sample for sample in self.samples if sample["error"]])
+        lines = ["<!DOCTYPE html>",
+                 "<html>",
+                 "<head>",
+                 "<meta charset=\"utf-8\">",
+                 "<title>%s</title>" %html.escape(title),
+                 "<link rel=\"stylesheet\" href=\"%s/%s\">" %(self.assetFolderName, self.styleSheetName),
+                 "</head>",
+                 "<body>",
+                 "<h2>%s</h2>" %html.escape(title)]
+        summary = "%s samples, %s failed." %(len(self.samples), failedCount)
+        if scores:
+            summary += " MIQ score mean %.1f, median %.1f, range %.1f to %.1f." %(statistics.mean(scores), statistics.median(scores), min(scores), max(scores))
+        lines.append("<p>%s</p>" %summary)
+        headers = ["Sample", "MIQ Score"] + ["%s (%%)" %(readFatePrintNames or {}).get(readFate, readFate) for readFate in readFates]
+        lines.append("<table>")
+        lines.append("<tr>%s</tr>" %"".join("<th>%s</th>" %html.escape(header) for header in headers))
+        for sample in self.samples:
+            sampleName = html.escape(str(sample["sampleID"]))
+            if sample["reportFileName"]:
+                sampleName = "<a href=\"%s\">%s</a>" %(html.escape(sample["reportFileName"], quote=True), sampleName)
+            if sample["error"]:
+                cells = ["<td class=\"sample\">%s</td>" %sampleName, "<td colspan=\"%s\">failed</td>" %(len(readFates) + 1)]
+                lines.append("<tr class=\"failed\">%s</tr>" %"".join(cells))
+                continue
+            cells = ["<td class=\"sample\">%s</td>" %sampleName, "<td>%s</td>" %round(sample["miqScore"])]
+            for readFate in readFates:
+                value = sample["readFateTable"].get(readFate)
+                cells.append("<td>%s</td>" %("" if value is None else "%.1f" %value))
+            lines.append("<tr>%s</tr>" %"".join(cells))
+        lines.append("</table>")
+        lines.append("</body>")
+        lines.append("</html>")
+        return "\n".join(lines) + "\n"
+
+    @instrumentation.timed("reportGeneration.writeIndex")
+    def writeIndex(self, title:str="MIQ Run Summary", readFatePrintNames:dict=None, fileName:str="index.html"):
+        '''Writes the run-level index page and returns its path'''
+        import os
+        path = os.path.join(self.outputDirectory, fileName)
+        writeFileAtomically(path, self.makeIndexHTML(title, readFatePrintNames))
+        return path
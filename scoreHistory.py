@@ -0,0 +1,277 @@
+import os
+import time
+import json
+import sqlite3
+from . import plotting
+
+schemaVersion = 1
+secondsPerDay = 86400
+
+schema = '''
+CREATE TABLE IF NOT EXISTS runs (
+    runID INTEGER PRIMARY KEY,
+    runName TEXT,
+    instrument TEXT,
+    recordedAt REAL NOT NULL,
+    metadata TEXT
+);
+CREATE TABLE IF NOT EXISTS samples (
+    sampleRowID INTEGER PRIMARY KEY,
+    runID INTEGER REFERENCES runs(runID),
+    sampleID TEXT,
+    analysisMethod TEXT NOT NULL,
+    reference TEXT NOT NULL,
+    instrument TEXT,
+    recordedAt REAL NOT NULL,
+    miqScore REAL NOT NULL,
+    rawMiqScore REAL NOT NULL,
+    percentToleranceInStandard REAL,
+    referenceReadTotal REAL,
+    confidenceLower REAL,
+    confidenceUpper REAL,
+    metadata TEXT
+);
+CREATE TABLE IF NOT EXISTS readSources (
+    sampleRowID INTEGER NOT NULL REFERENCES samples(sampleRowID),
+    readSource TEXT NOT NULL,
+    readCount REAL NOT NULL,
+    percentage REAL NOT NULL,
+    percentOfExpected REAL NOT NULL,
+    PRIMARY KEY (sampleRowID, readSource)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS readFates (
+    sampleRowID INTEGER NOT NULL REFERENCES samples(sampleRowID),
+    readFate TEXT NOT NULL,
+    percentage REAL NOT NULL,
+    PRIMARY KEY (sampleRowID, readFate)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS plots (
+    sampleRowID INTEGER NOT NULL REFERENCES samples(sampleRowID),
+    plotName TEXT NOT NULL,
+    format TEXT NOT NULL,
+    image BLOB NOT NULL,
+    PRIMARY KEY (sampleRowID, plotName)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS samplesBySampleID ON samples (sampleID, recordedAt);
+CREATE INDEX IF NOT EXISTS samplesByAnalysisMethod ON samples (analysisMethod, recordedAt);
+CREATE INDEX IF NOT EXISTS samplesByReference ON samples (reference, recordedAt);
+CREATE INDEX IF NOT EXISTS samplesByInstrument ON samples (instrument, recordedAt);
+CREATE INDEX IF NOT EXISTS samplesByDate ON samples (recordedAt);
+CREATE INDEX IF NOT EXISTS samplesByRun ON samples (runID);
+CREATE INDEX IF NOT EXISTS readSourcesByReadSource ON readSources (readSource, sampleRowID);
+'''
+
+
+def getReferenceName(standardReference):
+    '''Name a standard reference is stored under: its file name without the extension'''
+    compiledReference = getattr(standardReference, "compiledReference", None)
+    if compiledReference is None or not compiledReference.standardDataPath:
+        return "unknown"
+    return os.path.splitext(os.path.basename(compiledReference.standardDataPath))[0]
+
+
+def convertTimestamp(timestamp):
+    '''Accepts None (now), seconds since the epoch or a datetime and returns seconds since the epoch'''
+    if timestamp is None:
+        return time.time()
+    if hasattr(timestamp, "timestamp"):
+        return timestamp.timestamp()
+    return float(timestamp)
+
+
+class ScoreHistory(object):
+    '''
+    Local SQLite store of MIQ results for trend and drift queries over many runs.  Each sample gets one indexed row with its scores
+    and run metadata, and its per-read-source counts, percentages and percent of expected and its read fate table are kept as rows
+    of their own, so queries never have to parse JSON output.  Plots are kept in a separate table and only read when asked for.
+    Samples are indexed by sample ID, analysis method, reference, instrument and date.  Several processes can add to the same
+    history, since the database is opened in write-ahead logging mode and waits on locks.
+    '''
+
+    def __init__(self, databasePath:str, timeout:float=60):
+        self.databasePath = databasePath
+        self.connection = sqlite3.connect(databasePath, timeout=timeout)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.executescript(schema)
+        storedVersion = self.connection.execute("PRAGMA user_version").fetchone()[0]
+        if storedVersion == 0:
+            self.connection.execute("PRAGMA user_version=%s" %schemaVersion)
+        elif storedVersion > schemaVersion:
+            raise ValueError("Score history %s has schema version %s, but this version of the package only reads up to %s" %(databasePath, storedVersion, schemaVersion))
+        self.connection.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exceptionType, exception, traceback):
+        self.close()
+        return False
+
+    def close(self):
+        self.connection.close()
+
+    def startRun(self, runName:str=None, instrument:str=None, recordedAt=None, metadata:dict=None):
+        '''Records a run (such as one sequencing run or batch of samples) and returns its runID for addResult'''
+        with self.connection:
+            cursor = self.connection.execute("INSERT INTO runs (runName, instrument, recordedAt, metadata) VALUES (?, ?, ?, ?)", (runName, instrument, convertTimestamp(recordedAt), json.dumps(metadata) if metadata else None))
+        return cursor.lastrowid
+
+    def getRun(self, runID:int):
+        row = self.connection.execute("SELECT * FROM runs WHERE runID = ?", (runID,)).fetchone()
+        if row is None:
+            raise ValueError("No run with ID %s in score history %s" %(runID, self.databasePath))
+        return dict(row)
+
+    def addResult(self, miqResult, runID:int=None, instrument:str=None, recordedAt=None, metadata:dict=None, referenceName:str=None, storePlots:bool=True):
+        '''
+        Adds one MiqScoreData or CompactMiqScoreData and returns its sampleRowID.  Instrument and date default to those of the run
+        if one is given.  Plots already made on the result are stored unless storePlots is False.
+        '''
+        return self.addResults([miqResult], runID, instrument, recordedAt, metadata, referenceName, storePlots)[0]
+
+    def addResults(self, miqResults, runID:int=None, instrument:str=None, recordedAt=None, metadata:dict=None, referenceName:str=None, storePlots:bool=True):
+        '''Adds many results in one transaction and returns their sampleRowIDs'''
+        if runID is not None:
+            run = self.getRun(runID)
+            if instrument is None:
+                instrument = run["instrument"]
+            if recordedAt is None:
+                recordedAt = run["recordedAt"]
+        recordedAt = convertTimestamp(recordedAt)
+        metadataJSON = json.dumps(metadata) if metadata else None
+        sampleRowIDs = []
+        with self.connection:
+            for miqResult in miqResults:
+                sampleReferenceName = referenceName or getReferenceName(miqResult.standardReference)
+                confidenceInterval = getattr(miqResult, "confidenceInterval", None)
+                referenceReadCounts = miqResult.referenceReadCounts
+                cursor = self.connection.execute("INSERT INTO samples (runID, sampleID, analysisMethod, reference, instrument, recordedAt, miqScore, rawMiqScore, percentToleranceInStandard, referenceReadTotal, confidenceLower, confidenceUpper, metadata) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                                 (runID, None if miqResult.sampleID is None else str(miqResult.sampleID), miqResult.analysisMethod, sampleReferenceName, instrument, recordedAt, float(miqResult.miqScore), float(miqResult.rawMiqScore), miqResult.percentToleranceInStandard, float(sum(referenceReadCounts.values())),
+                                                  confidenceInterval.miqScoreLower if confidenceInterval is not None else None, confidenceInterval.miqScoreUpper if confidenceInterval is not None else None, metadataJSON))
+                sampleRowID = cursor.lastrowid
+                samplePercentages = miqResult.samplePercentages
+                samplePercentagesOfExpected = miqResult.samplePercentagesOfExpected
+                self.connection.executemany("INSERT INTO readSources (sampleRowID, readSource, readCount, percentage, percentOfExpected) VALUES (?, ?, ?, ?, ?)",
+                                            [(sampleRowID, readSource, float(referenceReadCounts[readSource]), float(samplePercentages.get(readSource, 0)), float(samplePercentagesOfExpected.get(readSource, 0))) for readSource in referenceReadCounts])
+                self.connection.executemany("INSERT INTO readFates (sampleRowID, readFate, percentage) VALUES (?, ?, ?)",
+                                            [(sampleRowID, readFate, float(percentage)) for readFate, percentage in miqResult.readFateTable.items()])
+                if storePlots:
+                    self.connection.executemany("INSERT INTO plots (sampleRowID, plotName, format, image) VALUES (?, ?, ?, ?)",
+                                                [(sampleRowID, plotName, plotFormat, plotBytes) for plotName, plotFormat, plotBytes in iteratePlots(miqResult.plots)])
+                sampleRowIDs.append(sampleRowID)
+        return sampleRowIDs
+
+    def addJSONOutput(self, jsonPath:str, analysisMethod:str, referenceName:str, runID:int=None, instrument:str=None, recordedAt=None, storePlots:bool=False):
+        '''
+        Imports a file written by MiqScoreData.jsonOutput, for moving existing results into the history.  The JSON does not say which
+        method and reference were used, so they have to be given.  Dates default to the file's modification time.
+        '''
+        file = open(jsonPath, 'r')
+        report = json.load(file)
+        file.close()
+        if recordedAt is None and runID is None:
+            recordedAt = os.path.getmtime(jsonPath)
+        result = StoredResult(report, analysisMethod)
+        return self.addResult(result, runID, instrument, recordedAt, None, referenceName, storePlots)
+
+    def makeFilters(self, sampleID:str=None, analysisMethod:str=None, referenceName:str=None, instrument:str=None, runID:int=None, days:float=None, since=None, until=None):
+        conditions = []
+        parameters = []
+        for column, value in (("sampleID", sampleID), ("analysisMethod", analysisMethod), ("reference", referenceName), ("instrument", instrument), ("runID", runID)):
+            if value is not None:
+                conditions.append("samples.%s = ?" %column)
+                parameters.append(value)
+        if days is not None:
+            since = max(convertTimestamp(since), time.time() - days * secondsPerDay) if since is not None else time.time() - days * secondsPerDay
+        if since is not None:
+            conditions.append("samples.recordedAt >= ?")
+            parameters.append(convertTimestamp(since))
+        if until is not None:
+            conditions.append("samples.recordedAt <= ?")
+            parameters.append(convertTimestamp(until))
+        if not conditions:
+            return "", parameters
+        return " WHERE " + " AND ".join(conditions), parameters
+
+    def scoreTrend(self, sampleID:str=None, analysisMethod:str=None, referenceName:str=None, instrument:str=None, runID:int=None, days:float=None, since=None, until=None):
+        '''
+        MIQ scores over time for the samples matching every filter given (for example instrument="MiSeq1", days=90), oldest first.
+        Returns a list of dictionaries with the sample row's columns.
+        '''
+        where, parameters = self.makeFilters(sampleID, analysisMethod, referenceName, instrument, runID, days, since, until)
+        query = "SELECT sampleRowID, runID, sampleID, analysisMethod, reference, instrument, recordedAt, miqScore, rawMiqScore, referenceReadTotal, confidenceLower, confidenceUpper FROM samples%s ORDER BY recordedAt, sampleRowID" %where
+        return [dict(row) for row in self.connection.execute(query, parameters)]
+
+    def readSourceDrift(self, readSource:str=None, sampleID:str=None, analysisMethod:str=None, referenceName:str=None, instrument:str=None, runID:int=None, days:float=None, since=None, until=None):
+        '''
+        Percent of expected for each read source over time, for the samples matching the filters, oldest first.  Returns a dictionary of
+        readSource:list of {"recordedAt", "sampleRowID", "sampleID", "percentage", "percentOfExpected"}.  Give readSource for just one.
+        '''
+        where, parameters = self.makeFilters(sampleID, analysisMethod, referenceName, instrument, runID, days, since, until)
+        if readSource is not None:
+            where = (where + " AND" if where else " WHERE") + " readSources.readSource = ?"
+            parameters.append(readSource)
+        query = "SELECT readSources.readSource, samples.recordedAt, samples.sampleRowID, samples.sampleID, readSources.percentage, readSources.percentOfExpected FROM samples JOIN readSources ON readSources.sampleRowID = samples.sampleRowID%s ORDER BY samples.recordedAt, samples.sampleRowID" %where
+        drift = {}
+        for row in self.connection.execute(query, parameters):
+            if not row[0] in drift:
+                drift[row[0]] = []
+            drift[row[0]].append({"recordedAt": row[1], "sampleRowID": row[2], "sampleID": row[3], "percentage": row[4], "percentOfExpected": row[5]})
+        return drift
+
+    def readSourceSummary(self, sampleID:str=None, analysisMethod:str=None, referenceName:str=None, instrument:str=None, runID:int=None, days:float=None, since=None, until=None):
+        '''Count, mean, minimum and maximum percent of expected of each read source over the matching samples, computed in SQLite'''
+        where, parameters = self.makeFilters(sampleID, analysisMethod, referenceName, instrument, runID, days, since, until)
+        query = "SELECT readSources.readSource, COUNT(*), AVG(readSources.percentOfExpected), MIN(readSources.percentOfExpected), MAX(readSources.percentOfExpected) FROM samples JOIN readSources ON readSources.sampleRowID = samples.sampleRowID%s GROUP BY readSources.readSource ORDER BY readSources.readSource" %where
+        return {row[0]: {"samples": row[1], "meanPercentOfExpected": row[2], "minimumPercentOfExpected": row[3], "maximumPercentOfExpected": row[4]} for row in self.connection.execute(query, parameters)}
+
+    def getSample(self, sampleRowID:int):
+        '''One stored sample with its read source values and read fate table (plots are left out, see getPlot)'''
+        row = self.connection.execute("SELECT * FROM samples WHERE sampleRowID = ?", (sampleRowID,)).fetchone()
+        if row is None:
+            raise ValueError("No sample with row ID %s in score history %s" %(sampleRowID, self.databasePath))
+        sample = dict(row)
+        if sample["metadata"]:
+            sample["metadata"] = json.loads(sample["metadata"])
+        sample["readSources"] = {readSource: {"readCount": readCount, "percentage": percentage, "percentOfExpected": percentOfExpected} for readSource, readCount, percentage, percentOfExpected in self.connection.execute("SELECT readSource, readCount, percentage, percentOfExpected FROM readSources WHERE sampleRowID = ?", (sampleRowID,))}
+        sample["readFateTable"] = {readFate: percentage for readFate, percentage in self.connection.execute("SELECT readFate, percentage FROM readFates WHERE sampleRowID = ?", (sampleRowID,))}
+        sample["plotNames"] = [row[0] for row in self.connection.execute("SELECT plotName FROM plots WHERE sampleRowID = ?", (sampleRowID,))]
+        return sample
+
+    def getPlot(self, sampleRowID:int, plotName:str, output:str="base64"):
+        '''Returns a stored plot (radar plots are named radarPlots/sortingMethod) as any plot output type, or None if it was not stored'''
+        row = self.connection.execute("SELECT format, image FROM plots WHERE sampleRowID = ? AND plotName = ?", (sampleRowID, plotName)).fetchone()
+        if row is None:
+            return None
+        return plotting.plotEncoding.convertPlotOutput(bytes(row[1]), row[0], output)
+
+
+def iteratePlots(plots:dict, prefix:str=""):
+    '''Yields (plotName, format, image bytes) for a plots dictionary, with nested groups of plots named group/plotName'''
+    for plotName, plot in plots.items():
+        if isinstance(plot, dict):
+            yield from iteratePlots(plot, prefix + plotName + "/")
+            continue
+        plotBytes = plotting.plotEncoding.getPlotBytes(plot)
+        plotFormat = plotting.plotEncoding.getPlotFormat(plot) or "png"  # the plot methods default to PNG
+        yield prefix + plotName, plotFormat, plotBytes
+
+
+class StoredResult(object):
+    '''Minimal stand-in for MiqScoreData built from a jsonOutput dictionary, for ScoreHistory.addJSONOutput'''
+
+    def __init__(self, report:dict, analysisMethod:str):
+        self.sampleID = report["sampleID"]
+        self.analysisMethod = analysisMethod
+        self.standardReference = None
+        self.miqScore = report["miqScore"]
+        self.rawMiqScore = report["rawMiq"]
+        self.percentToleranceInStandard = report["percentToleranceInStandard"]
+        self.referenceReadCounts = report["referenceReadCounts"]
+        self.samplePercentages = report["samplePercentages"]
+        self.samplePercentagesOfExpected = report["samplePercentagesOfExpected"]
+        self.readFateTable = report["readFateTable"]
+        self.plots = report.get("plots", {})
+        self.confidenceInterval = None
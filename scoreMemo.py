@@ -0,0 +1,227 @@
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+import collections
+from . import instrumentation
+
+memoVersion = 2  # bump whenever scoring or the stored record changes so old persisted entries stop matching
+
+schema = '''
+CREATE TABLE IF NOT EXISTS scores (
+    memoKey TEXT PRIMARY KEY,
+    record TEXT NOT NULL,
+    lastUsed REAL NOT NULL
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS scoresByLastUsed ON scores (lastUsed);
+'''
+
+
+def makeMemoKey(calculator, sampleData:dict, sampleID:str=None, compact:bool=False):
+    '''
+    Hash of everything a score depends on: the sample's read sources and counts as given (in their order and with the repr of each
+    count, since merging aliases and totalling reads add up in that order and an int and a float count can round differently), the
+    analysis method and its expected values, tolerance, floor and bootstrap settings.  The sample ID is left out (a hit for a
+    different sample ID gets a copy under the new ID) unless seeded bootstrap intervals make the result depend on it.
+    '''
+    expectedValues = calculator.standardReference.expectedValues[calculator.analysisMethod]
+    keyData = [memoVersion,
+               "compact" if compact else "full",
+               calculator.analysisMethod,
+               calculator.percentToleranceInStandard,
+               calculator.floor,
+               [[readSource, expectedValues[readSource]] for readSource in calculator.expectedReadSources],
+               [[rawName, repr(sampleData[rawName])] for rawName in sampleData]]
+    if calculator.bootstrapReplicates:
+        keyData.append([calculator.bootstrapReplicates, calculator.confidenceLevel, calculator.bootstrapSeed, None if calculator.bootstrapSeed is None else str(sampleID)])
+    return hashlib.sha256(json.dumps(keyData).encode()).hexdigest()
+
+
+def copyResult(miqResult, sampleID:str=None):
+    '''
+    Cheap copy of a memoized result for one caller.  Counts and percentages are shared with the memo, so they should be treated as
+    read only.  Plots are shared while the sample ID is the same (plot titles include it) and start empty otherwise.
+    '''
+    import copy
+    from . import CompactMiqScoreData
+    result = copy.copy(miqResult)
+    sameSample = miqResult.sampleID == sampleID
+    result.sampleID = sampleID
+    if isinstance(result, CompactMiqScoreData):
+        if not sameSample:
+            result.miqScoreData = None
+    else:
+        if not sameSample:
+            result.plots = {}
+        result.profile = instrumentation.startProfile(sampleID)  # plots and reports made from the copy are still profiled
+        result.rarefactionCurve = None
+    return result
+
+
+def makeRecord(miqResult):
+    '''JSON-ready record of a result for the persistent memo'''
+    from . import CompactMiqScoreData
+    confidenceInterval = miqResult.confidenceInterval.toDict() if miqResult.confidenceInterval is not None else None
+    if isinstance(miqResult, CompactMiqScoreData):
+        return {"kind": "compact",
+                "miqScore": miqResult.miqScore,
+                "rawMiqScore": miqResult.rawMiqScore,
+                "referenceCounts": miqResult.referenceCounts.tolist(),
+                "referenceReadTotal": miqResult.referenceReadTotal,
+                "nonreferenceReadSources": list(miqResult.nonreferenceReadSources),
+                "nonreferenceCounts": miqResult.nonreferenceCounts.tolist(),
+                "confidenceInterval": confidenceInterval}
+    return {"kind": "full",
+            "miqScore": miqResult.miqScore,
+            "rawMiqScore": miqResult.rawMiqScore,
+            "referenceReadCounts": miqResult.referenceReadCounts,
+            "nonreferenceReadCounts": miqResult.nonreferenceReadCounts,
+            "samplePercentages": miqResult.samplePercentages,
+            "samplePercentagesOfExpected": miqResult.samplePercentagesOfExpected,
+            "confidenceInterval": confidenceInterval}
+
+
+def makeResultFromRecord(record:dict, calculator, sampleID:str=None):
+    '''Rebuilds the MiqScoreData or CompactMiqScoreData stored by makeRecord.  Every stored value round trips exactly through JSON.'''
+    import numpy
+    from . import MiqScoreData, CompactMiqScoreData, MiqScoreInterval
+    if record["kind"] == "compact":
+        miqResult = CompactMiqScoreData(record["miqScore"], record["rawMiqScore"], calculator.expectedReadSources, numpy.array(record["referenceCounts"], dtype=numpy.float64), record["referenceReadTotal"], tuple(record["nonreferenceReadSources"]), numpy.array(record["nonreferenceCounts"], dtype=numpy.float64), calculator.percentToleranceInStandard, calculator.analysisMethod, calculator.standardReference, sampleID)
+    else:
+        miqResult = MiqScoreData(record["miqScore"], record["rawMiqScore"], record["referenceReadCounts"], record["nonreferenceReadCounts"], record["samplePercentages"], record["samplePercentagesOfExpected"], calculator.percentToleranceInStandard, calculator.analysisMethod, calculator.standardReference, sampleID)
+    if record["confidenceInterval"] is not None:
+        miqResult.confidenceInterval = MiqScoreInterval(**record["confidenceInterval"])
+    return miqResult
+
+
+class ScoreMemo(object):
+    '''
+    Bounded memo of MIQ results keyed by makeMemoKey, so samples that are submitted again (reruns, re-reports, example controls)
+    are not scored again.  The most recently used maxEntries results are kept in memory.  With persistencePath, results are also
+    written to a SQLite file that later processes can share, and entries missing from memory are looked up there (the least
+    recently used are removed once it holds more than maxPersistedEntries).  Hit and miss counts are kept for stats().
+    '''
+
+    def __init__(self, maxEntries:int=4096, persistencePath:str=None, maxPersistedEntries:int=1000000, timeout:float=60):
+        if maxEntries < 1:
+            raise ValueError("Score memo must hold at least one entry. Got %s" %maxEntries)
+        self.maxEntries = maxEntries
+        self.persistencePath = persistencePath
+        self.maxPersistedEntries = maxPersistedEntries
+        self.entries = collections.OrderedDict()
+        self.lock = threading.RLock()
+        self.hits = 0
+        self.persistentHits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.connection = None
+        self.persistedEntries = 0
+        if persistencePath:
+            self.connection = sqlite3.connect(persistencePath, timeout=timeout, check_same_thread=False)
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("PRAGMA synchronous=NORMAL")
+            self.connection.executescript(schema)
+            self.connection.commit()
+            self.persistedEntries = self.connection.execute("SELECT COUNT(*) FROM scores").fetchone()[0]
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exceptionType, exception, traceback):
+        self.close()
+        return False
+
+    def close(self):
+        with self.lock:
+            if self.connection is not None:
+                self.connection.close()
+                self.connection = None
+
+    def clear(self):
+        '''Empties the in-memory memo and resets the statistics.  Persisted entries are kept.'''
+        with self.lock:
+            self.entries.clear()
+            self.hits = 0
+            self.persistentHits = 0
+            self.misses = 0
+            self.evictions = 0
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {"entries": len(self.entries),
+                "maxEntries": self.maxEntries,
+                "hits": self.hits,
+                "persistentHits": self.persistentHits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hitRate": self.hits / lookups if lookups else None,
+                "persistedEntries": self.persistedEntries if self.connection is not None else None}
+
+    def get(self, key:str, calculator=None, sampleID:str=None):
+        '''
+        Returns the memoized result for a key (not a copy) or None.  Persisted entries can only be rebuilt when the calculator is
+        given, and are rebuilt under sampleID.
+        '''
+        with self.lock:
+            miqResult = self.entries.get(key)
+            if miqResult is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                instrumentation.count("scoreMemo.hits")
+                return miqResult
+            if self.connection is not None and calculator is not None:
+                row = self.connection.execute("SELECT record FROM scores WHERE memoKey = ?", (key,)).fetchone()
+                if row is not None:
+                    miqResult = makeResultFromRecord(json.loads(row[0]), calculator, sampleID)
+                    with self.connection:
+                        self.connection.execute("UPDATE scores SET lastUsed = ? WHERE memoKey = ?", (time.time(), key))
+                    self.addEntry(key, miqResult)
+                    self.hits += 1
+                    self.persistentHits += 1
+                    instrumentation.count("scoreMemo.persistentHits")
+                    return miqResult
+            self.misses += 1
+            instrumentation.count("scoreMemo.misses")
+            return None
+
+    def put(self, key:str, miqResult):
+        with self.lock:
+            self.addEntry(key, miqResult)
+            if self.connection is not None:
+                with self.connection:
+                    self.connection.execute("INSERT OR REPLACE INTO scores (memoKey, record, lastUsed) VALUES (?, ?, ?)", (key, json.dumps(makeRecord(miqResult)), time.time()))
+                self.persistedEntries += 1
+                if self.persistedEntries > self.maxPersistedEntries:
+                    self.prunePersisted()
+
+    def addEntry(self, key:str, miqResult):
+        self.entries[key] = miqResult
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxEntries:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def prunePersisted(self):
+        '''Removes the least recently used persisted entries, leaving 90% of maxPersistedEntries'''
+        keep = int(self.maxPersistedEntries * 0.9)
+        with self.connection:
+            self.connection.execute("DELETE FROM scores WHERE memoKey IN (SELECT memoKey FROM scores ORDER BY lastUsed LIMIT max(0, (SELECT COUNT(*) FROM scores) - ?))", (keep,))
+        self.persistedEntries = self.connection.execute("SELECT COUNT(*) FROM scores").fetchone()[0]
+
+    def getOrCalculate(self, calculator, sampleData:dict, sampleID:str=None, compact:bool=False, calculate=None):
+        '''
+        Returns a copy of the memoized result for this sample, calling calculate() (by default the calculator's own scoring) and
+        memoizing its result on a miss.
+        '''
+        key = makeMemoKey(calculator, sampleData, sampleID, compact)
+        miqResult = self.get(key, calculator, sampleID)
+        if miqResult is None:
+            if calculate is None:
+                calculate = lambda: calculator.calculateMiq(sampleData, sampleID, compact)
+            miqResult = calculate()
+            self.put(key, miqResult)
+        return copyResult(miqResult, sampleID)
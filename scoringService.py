@@ -0,0 +1,271 @@
+import time
+import asyncio
+import functools
+import concurrent.futures
+from . import instrumentation
+
+
+class ServiceBusyError(Exception):
+    '''Raised by a request made with wait=False when the scoring queue or plot pool of a ScoringService is full'''
+
+
+class ScoringService(object):
+    '''
+    asyncio front end for a MiqScoreCalculator, for use inside a web service or any other event loop.  Score requests are held for
+    up to batchWindow seconds (or until maxBatchSize are waiting) and scored together with calculateMiqBatch on a scoring thread,
+    so the event loop never runs scoring itself and scores are identical to calculateMiq.  Plots are drawn separately on a pool
+    of plotWorkers threads, so a score is returned as soon as it is ready and its plots follow later.  At most maxPendingScores
+    scores and maxPendingPlots plot jobs wait at a time: further requests wait for room, or raise ServiceBusyError when made with
+    wait=False.  Latency histograms for requests, queueing, batches and plots are kept for stats().
+    '''
+
+    def __init__(self, calculator, batchWindow:float=0.005, maxBatchSize:int=256, maxPendingScores:int=4096, plotWorkers:int=2, maxPendingPlots:int=32, plotFormat:str="png", plotOutput:str="base64", goodExample:dict=None, badExample:dict=None):
+        '''
+        :param calculator: MiqScoreCalculator (or MemoizedMiqScoreCalculator) used for every request
+        :param goodExample: Optional good example composition for composition plots (see MiqScoreData.makeCompositionBarPlot), likewise badExample
+        '''
+        if batchWindow < 0:
+            raise ValueError("Batch window can not be negative. Got %s" %batchWindow)
+        if maxBatchSize < 1 or maxPendingScores < 1 or plotWorkers < 1 or maxPendingPlots < 1:
+            raise ValueError("Batch size, pending scores, plot workers and pending plots must all be at least 1")
+        self.calculator = calculator
+        self.batchWindow = batchWindow
+        self.maxBatchSize = maxBatchSize
+        self.maxPendingScores = maxPendingScores
+        self.plotWorkers = plotWorkers
+        self.maxPendingPlots = maxPendingPlots
+        self.plotFormat = plotFormat
+        self.plotOutput = plotOutput
+        self.goodExample = goodExample
+        self.badExample = badExample
+        self.scoreQueue = None
+        self.batchReady = None
+        self.plotSlots = None
+        self.batchTask = None
+        self.plotTasks = set()
+        self.scoreExecutor = None
+        self.plotExecutor = None
+        self.requestLatency = instrumentation.LatencyHistogram()
+        self.queueLatency = instrumentation.LatencyHistogram()
+        self.batchLatency = instrumentation.LatencyHistogram()
+        self.plotLatency = instrumentation.LatencyHistogram()
+        self.scoredRequests = 0
+        self.failedRequests = 0
+        self.batches = 0
+        self.largestBatch = 0
+        self.renderedPlots = 0
+        self.rejectedScores = 0
+        self.rejectedPlots = 0
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, exceptionType, exception, traceback):
+        await self.stop()
+        return False
+
+    @property
+    def running(self):
+        return self.batchTask is not None
+
+    async def start(self):
+        '''Starts the batching task and worker threads on the running event loop.  Matplotlib is loaded here rather than by the first plot.'''
+        from . import plotting
+        if self.running:
+            return
+        self.scoreQueue = asyncio.Queue(maxsize=self.maxPendingScores)
+        self.batchReady = asyncio.Event()
+        self.plotSlots = asyncio.Semaphore(self.maxPendingPlots)
+        self.scoreExecutor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="miqScoring")
+        self.plotExecutor = concurrent.futures.ThreadPoolExecutor(max_workers=self.plotWorkers, thread_name_prefix="miqPlotting")
+        if not plotting.plotEncoding.isNativeFormat(self.plotFormat):
+            await asyncio.get_running_loop().run_in_executor(self.plotExecutor, plotting.importPlottingModules)
+        self.batchTask = asyncio.ensure_future(self.runBatches())
+
+    async def stop(self):
+        '''Finishes every queued score and plot job, then stops the batching task and worker threads'''
+        if not self.running:
+            return
+        await self.scoreQueue.join()
+        self.batchTask.cancel()
+        await asyncio.gather(self.batchTask, return_exceptions=True)
+        self.batchTask = None
+        if self.plotTasks:
+            await asyncio.gather(*self.plotTasks, return_exceptions=True)
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self.scoreExecutor.shutdown)
+        await loop.run_in_executor(None, self.plotExecutor.shutdown)
+
+    def checkRunning(self):
+        if not self.running:
+            raise ValueError("Scoring service is not running. Call start() first or use it with async with")
+
+    async def score(self, sampleData:dict, sampleID:str=None, wait:bool=True):
+        '''Returns a CompactMiqScoreData for one sample's absolute counts once its batch has been scored'''
+        self.checkRunning()
+        if not wait and self.scoreQueue.full():
+            self.rejectedScores += 1
+            raise ServiceBusyError("Scoring queue is full (%s samples waiting)" %self.maxPendingScores)
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        enqueueTime = time.perf_counter()
+        await self.scoreQueue.put((sampleData, sampleID, future, enqueueTime))
+        if self.scoreQueue.qsize() >= self.maxBatchSize:
+            self.batchReady.set()
+        return await future
+
+    async def scoreMany(self, samples:[list, tuple], sampleIDs:[list, tuple]=None, wait:bool=True):
+        '''Scores many samples concurrently and returns their results in order'''
+        if sampleIDs is None:
+            sampleIDs = [None] * len(samples)
+        return await asyncio.gather(*[self.score(sampleData, sampleID, wait) for sampleData, sampleID in zip(samples, sampleIDs)])
+
+    async def renderPlots(self, miqResult, wait:bool=True):
+        '''
+        Draws the read fate chart, radar plots and composition bar plot for a result on the plot pool and returns them as a
+        dictionary with the same keys as MiqScoreData.plots
+        '''
+        self.checkRunning()
+        if not wait and self.plotSlots.locked():
+            self.rejectedPlots += 1
+            raise ServiceBusyError("Plot pool is full (%s plot jobs waiting)" %self.maxPendingPlots)
+        async with self.plotSlots:
+            startTime = time.perf_counter()
+            loop = asyncio.get_running_loop()
+            miqScoreData = await loop.run_in_executor(self.plotExecutor, miqResult.toMiqScoreData) if hasattr(miqResult, "toMiqScoreData") else miqResult
+            plotCalls = {"readFates": functools.partial(miqScoreData.makeReadFateChart, format=self.plotFormat, output=self.plotOutput),
+                         "radarPlots": functools.partial(miqScoreData.makeRadarPlots, format=self.plotFormat, output=self.plotOutput),
+                         "compositionPlot": functools.partial(miqScoreData.makeCompositionBarPlot, self.goodExample, self.badExample, output=self.plotOutput, format=self.plotFormat)}
+            plots = await asyncio.gather(*[loop.run_in_executor(self.plotExecutor, plotCall) for plotCall in plotCalls.values()])
+            self.plotLatency.record(time.perf_counter() - startTime)
+            self.renderedPlots += 1
+        return dict(zip(plotCalls, plots))
+
+    async def scoreWithPlots(self, sampleData:dict, sampleID:str=None, wait:bool=True):
+        '''
+        Returns (result, plotTask) as soon as the score is ready.  plotTask is an asyncio task that gives the plots dictionary
+        from renderPlots once they are drawn.
+        '''
+        miqResult = await self.score(sampleData, sampleID, wait)
+        if not wait and self.plotSlots.locked():
+            self.rejectedPlots += 1
+            raise ServiceBusyError("Plot pool is full (%s plot jobs waiting)" %self.maxPendingPlots)
+        plotTask = asyncio.ensure_future(self.renderPlots(miqResult))
+        self.plotTasks.add(plotTask)
+        plotTask.add_done_callback(self.plotTasks.discard)
+        return miqResult, plotTask
+
+    async def runBatches(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            requests = [await self.scoreQueue.get()]
+            if self.scoreQueue.qsize() + 1 < self.maxBatchSize and self.batchWindow:
+                try:
+                    await asyncio.wait_for(self.batchReady.wait(), self.batchWindow)
+                except asyncio.TimeoutError:
+                    pass
+            self.batchReady.clear()
+            while len(requests) < self.maxBatchSize and not self.scoreQueue.empty():
+                requests.append(self.scoreQueue.get_nowait())
+            batchStart = time.perf_counter()
+            for request in requests:
+                self.queueLatency.record(batchStart - request[3])
+            try:
+                results = await loop.run_in_executor(self.scoreExecutor, self.scoreBatch, [request[0] for request in requests], [request[1] for request in requests])
+            except Exception as error:
+                results = [error] * len(requests)
+            finishTime = time.perf_counter()
+            self.batchLatency.record(finishTime - batchStart)
+            self.batches += 1
+            self.largestBatch = max(self.largestBatch, len(requests))
+            for (sampleData, sampleID, future, enqueueTime), result in zip(requests, results):
+                self.requestLatency.record(finishTime - enqueueTime)
+                if isinstance(result, Exception):
+                    self.failedRequests += 1
+                    if not future.done():
+                        future.set_exception(result)
+                else:
+                    self.scoredRequests += 1
+                    if not future.done():
+                        future.set_result(result)
+                self.scoreQueue.task_done()
+
+    def scoreBatch(self, samples:list, sampleIDs:list):
+        '''
+        Scores one batch on the scoring thread.  If the batch can not be scored as a whole (such as a sample with counts that are
+        not numbers), each sample is scored on its own so only the bad ones fail.  Returns one result or exception per sample.
+        '''
+        try:
+            miqScoreBatch = self.calculator.calculateMiqBatch(samples, sampleIDs=sampleIDs)
+            results = [miqScoreBatch[index] for index in range(len(miqScoreBatch))]
+            if self.calculator.bootstrapReplicates:
+                for result, confidenceInterval in zip(results, self.calculator.bootstrapMiqBatch(miqScoreBatch)):
+                    result.confidenceInterval = confidenceInterval
+            return results
+        except Exception:
+            pass
+        results = []
+        for sampleData, sampleID in zip(samples, sampleIDs):
+            try:
+                results.append(self.calculator.calculateMiq(sampleData, sampleID, compact=True))
+            except Exception as error:
+                results.append(error)
+        return results
+
+    def stats(self):
+        return {"scoredRequests": self.scoredRequests,
+                "failedRequests": self.failedRequests,
+                "batches": self.batches,
+                "meanBatchSize": (self.scoredRequests + self.failedRequests) / self.batches if self.batches else None,
+                "largestBatch": self.largestBatch,
+                "pendingScores": self.scoreQueue.qsize() if self.scoreQueue is not None else 0,
+                "pendingPlots": len(self.plotTasks),
+                "renderedPlots": self.renderedPlots,
+                "rejectedScores": self.rejectedScores,
+                "rejectedPlots": self.rejectedPlots,
+                "requestLatency": self.requestLatency.toDict(),
+                "queueLatency": self.queueLatency.toDict(),
+                "batchLatency": self.batchLatency.toDict(),
+                "plotLatency": self.plotLatency.toDict()}
+
+
+class InProcessClient(object):
+    '''
+    Sends JSON-style requests straight to a ScoringService the way a web handler would, so the service can be exercised and
+    load tested without a server.  Requests are dictionaries with "counts" and optionally "sampleID" and "plots" (true to wait for
+    plots as well).  Responses are dictionaries with an HTTP-like "status": 200 with the scores, 400 when the sample could not be
+    scored and 503 when the service is busy (requests are made with wait=False unless the client was made with wait=True).
+    '''
+
+    def __init__(self, service:ScoringService, wait:bool=False):
+        self.service = service
+        self.wait = wait
+
+    async def request(self, requestData:dict):
+        from . import plotting
+        sampleID = requestData.get("sampleID")
+        try:
+            miqResult = await self.service.score(requestData["counts"], sampleID, self.wait)
+            response = {"status": 200,
+                        "sampleID": sampleID,
+                        "miqScore": miqResult.miqScore,
+                        "rawMiqScore": miqResult.rawMiqScore}
+            if miqResult.confidenceInterval is not None:
+                response["miqScoreConfidenceInterval"] = miqResult.confidenceInterval.toDict()
+            if requestData.get("plots"):
+                response["plots"] = await self.service.renderPlots(miqResult, self.wait)
+                if not self.service.plotOutput == "base64":
+                    response["plots"] = convertPlotsToBase64(response["plots"], plotting.plotEncoding.convertToJSONValue)
+            return response
+        except ServiceBusyError as error:
+            return {"status": 503, "sampleID": sampleID, "error": str(error)}
+        except (KeyError, TypeError, ValueError, ZeroDivisionError) as error:
+            return {"status": 400, "sampleID": sampleID, "error": "%s: %s" %(type(error).__name__, error)}
+
+    async def requestMany(self, requests:[list, tuple]):
+        return await asyncio.gather(*[self.request(requestData) for requestData in requests])
+
+
+def convertPlotsToBase64(plots:dict, convertPlot):
+    return {plotName: convertPlotsToBase64(plot, convertPlot) if isinstance(plot, dict) else convertPlot(plot) for plotName, plot in plots.items()}